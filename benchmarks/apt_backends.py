@@ -0,0 +1,44 @@
+"""
+Compare the `apt list` subprocess backend against reading the dpkg database
+
+With systeminfo installed (`pip install -e .`), run from the repository root:
+
+    python3 benchmarks/apt_backends.py [--repeat N] [--root DIR]
+
+root can point at a mounted or extracted image to benchmark the dpkg backend
+against it, the apt backend always runs against the local system.
+"""
+import argparse
+import statistics
+import time
+import systeminfo
+
+
+def bench(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = len(list(func()))
+        times.append(time.perf_counter() - start)
+    return count, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--root', default=None)
+    args = parser.parse_args()
+
+    backends = (
+        ('apt list', systeminfo.System(apt_backend='apt').apt_list),
+        ('dpkg installed', systeminfo.System(apt_backend='dpkg', root=args.root).apt_installed),
+        ('dpkg list', systeminfo.System(apt_backend='dpkg', root=args.root).apt_list),
+    )
+    for name, func in backends:
+        count, times = bench(func, args.repeat)
+        print("{name:<20} {count:>7} packages  median {median:8.4f} s  min {min:8.4f} s".format(
+            name=name, count=count, median=statistics.median(times), min=min(times)))
+
+
+if __name__ == '__main__':
+    main()
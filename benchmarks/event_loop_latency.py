@@ -0,0 +1,68 @@
+"""
+Measure how long the event loop stalls while large inventories are parsed
+
+With systeminfo installed (`pip install -e .`), run from the repository root:
+
+    python3 benchmarks/event_loop_latency.py [--packages N] [--systems N] [--repeat N]
+
+Every system is a `fixtures.FakeImage` that returns a synthetic `apt list` and
+`pip list` of the given size instead of running anything, so only parsing is
+measured. A ticker that wants
+to wake up every millisecond records how late it was, which is how long a
+web request would have waited.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import systeminfo
+from fixtures import FakeImage
+
+
+async def ticker(lags, stop, interval=0.001):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(executor, packages, systems):
+    infos = [FakeImage(image, packages, executor=executor) for image in range(systems)]
+    lags = []
+    stop = asyncio.Event()
+    tick = asyncio.ensure_future(ticker(lags, stop))
+    start = time.perf_counter()
+    results = await asyncio.gather(*[info.async_get_dict() for info in infos])
+    duration = time.perf_counter() - start
+    stop.set()
+    await tick
+    return sum(len(d) for d in results), duration, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packages', type=int, default=50000)
+    parser.add_argument('--systems', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    systeminfo.info.logger.setLevel('ERROR')
+
+    for executor in (None, 'thread', 'process'):
+        if executor is not None:
+            # Start the workers before measuring
+            asyncio.run(run(executor, 10, 1))
+        lags = []
+        durations = []
+        for _ in range(args.repeat):
+            count, duration, run_lags = asyncio.run(run(executor, args.packages, args.systems))
+            lags.extend(run_lags)
+            durations.append(duration)
+        lags.sort()
+        print("{executor:<8} {count:>7} packages  total {duration:7.3f} s  "
+              "lag p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  max {max:7.2f} ms".format(
+                  executor=str(executor), count=count, duration=statistics.median(durations),
+                  p50=1000 * lags[len(lags) // 2], p99=1000 * lags[int(len(lags) * 0.99)], max=1000 * lags[-1]))
+
+
+if __name__ == '__main__':
+    main()
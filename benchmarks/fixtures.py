@@ -0,0 +1,127 @@
+"""
+Synthetic `apt list` and `pip list` output, and fake images that return it
+
+Everything is generated from the image number, so the same fixtures are
+produced on every machine and run.
+"""
+import asyncio
+import functools
+import json
+import random
+import systeminfo
+
+WORDS = ('core', 'utils', 'dev', 'data', 'common', 'tools', 'doc', 'bin', 'gtk', 'qt', 'ssl', 'xml', 'net', 'crypt',
+         'audio', 'video', 'font', 'perl', 'java', 'ruby', 'cuda', 'blas', 'mpi', 'hdf5', 'zlib', 'curl', 'git', 'vim')
+ARCHES = ('amd64', 'amd64', 'amd64', 'all')
+STATES = ('[installed]', '[installed,automatic]', '[installed,automatic]', '[installed,local]')
+# Names every image draws its packages from, so images share most of them like real ones do
+UNIVERSE = 8000
+
+
+@functools.lru_cache(maxsize=None)
+def apt_package(i):
+    """
+    Return the name, version parts, arch and state of the apt package at universe position i
+    """
+    rng = random.Random(i)
+    prefix = rng.choice(('lib', 'python3-', 'r-cran-', '', '', ''))
+    name = '{prefix}{first}{second}{i}'.format(prefix=prefix, first=rng.choice(WORDS), second=rng.choice(WORDS), i=i)
+    return name, (rng.randint(0, 9), rng.randint(0, 20), rng.randint(0, 99)), rng.choice(ARCHES), rng.choice(STATES)
+
+
+@functools.lru_cache(maxsize=None)
+def pip_package(i):
+    """
+    Return the name and version parts of the pip package at universe position i
+    """
+    rng = random.Random(-i)
+    return 'py{first}{i}'.format(first=rng.choice(WORDS), i=i), (rng.randint(0, 5), rng.randint(0, 30))
+
+
+def image_packages(image, packages):
+    """
+    Return the sorted universe positions of the packages in an image
+    """
+    # Huge images get a bigger universe, so they still have the packages asked for
+    return sorted(random.Random(image).sample(range(max(UNIVERSE, 2 * packages)), packages))
+
+
+def apt_list_text(image, packages=4500):
+    """
+    Return what `apt list --installed` would print on the image
+    """
+    lines = ['Listing...']
+    for i in image_packages(image, packages):
+        name, (major, minor, patch), arch, state = apt_package(i)
+        # A few packages differ in version between images
+        revision = (i + image) % 3 if i % 10 == 0 else 1
+        version = '{epoch}{major}.{minor}.{patch}-{revision}'.format(
+            epoch='1:' if i % 17 == 0 else '', major=major, minor=minor, patch=patch, revision=revision)
+        lines.append('{name}/stable,now {version} {arch} {state}'.format(name=name, version=version, arch=arch, state=state))
+    return '\n'.join(lines) + '\n'
+
+
+def pip_list_text(image, packages=500):
+    """
+    Return what `pip list --format json` would print on the image
+    """
+    apps = []
+    for i in image_packages(image + 1000003, packages):
+        name, (major, minor) = pip_package(i)
+        apps.append({'name': name, 'version': '{major}.{minor}.{patch}'.format(
+            major=major, minor=minor, patch=(i + image) % 4 if i % 7 == 0 else 0)})
+    return json.dumps(apps)
+
+
+class FakeImage(systeminfo.System):
+    """
+    A system whose `apt list` and `pip list` print synthetic output instead of running
+
+    packages: how many packages the image has, 90% from apt and 10% from pip
+    path: a file standing in for the image, so the inventory can be cached
+    delay: seconds every async command takes, like starting a container would
+    """
+    def __init__(self, image=0, packages=5000, *args, path=None, delay=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.image = image
+        self.path = path
+        self.delay = delay
+        self.apt_text = apt_list_text(image, packages - packages // 10)
+        self.pip_text = pip_list_text(image, packages // 10)
+
+    @property
+    def cache_path(self):
+        return self.path
+
+    def _text(self, command):
+        if command.startswith('apt list'):
+            return self.apt_text
+        if command.startswith('pip list'):
+            return self.pip_text
+        raise FileNotFoundError(command)
+
+    def get_command_text(self, command, shell=False, check=True):
+        return self._text(command)
+
+    async def async_get_command_text(self, command, check=True):
+        # Give the loop a turn like waiting on a real command would
+        await asyncio.sleep(self.delay)
+        return self._text(command)
+
+    def iter_command_chunks(self, command, shell=False, check=True, size=64 * 1024):
+        text = self._text(command)
+        for i in range(0, len(text), size):
+            yield text[i:i + size]
+
+    async def async_iter_command_chunks(self, command, check=True, size=64 * 1024):
+        await asyncio.sleep(self.delay)
+        for chunk in self.iter_command_chunks(command, size=size):
+            await asyncio.sleep(0)
+            yield chunk
+
+
+def fake_images(count, packages=5000, **kwargs):
+    """
+    Return a dictionary of `count` fake image names to `FakeImage`s
+    """
+    return {'/images/image{i:04}.img'.format(i=i): FakeImage(i, packages, **kwargs) for i in range(count)}
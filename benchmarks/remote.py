@@ -0,0 +1,53 @@
+"""
+Compare collecting from remote hosts with a connection per command and with persistent sessions
+
+With systeminfo installed (`pip install -e .`), run from the repository root:
+
+    python3 benchmarks/remote.py [--hosts N] [--handshake SECONDS] [--repeat N]
+
+No host is needed. Every host is this machine behind a fake transport that
+waits `--handshake` seconds before starting a shell, like an ssh handshake
+would. `pre_command` pays it for every command, a `Remote` once per
+session, which is kept for the next refresh.
+"""
+import argparse
+import asyncio
+import logging
+import time
+import systeminfo
+from systeminfo.refresh import refresh
+from systeminfo.remote import Fleet
+
+
+async def per_command(hosts, handshake):
+    systems = {'host{i}'.format(i=i): systeminfo.System(pre_command='sleep {handshake}; '.format(handshake=handshake))
+               for i in range(hosts)}
+    return await refresh(systems, concurrency=hosts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=8)
+    parser.add_argument('--handshake', type=float, default=1.0, help="seconds a connection takes to open")
+    parser.add_argument('--repeat', type=int, default=3, help="refreshes of each")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    async def run():
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            await per_command(args.hosts, args.handshake)
+            print("pre_command {seconds:8.3f} s".format(seconds=time.perf_counter() - start))
+        transport = ['sh', '-c', 'sleep {handshake}; exec sh'.format(handshake=args.handshake)]
+        fleet = Fleet(['host{i}'.format(i=i) for i in range(args.hosts)], concurrency=args.hosts, transport=transport)
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            await fleet.refresh()
+            # The first refresh opens the sessions, the others reuse them
+            print("Remote      {seconds:8.3f} s{note}".format(seconds=time.perf_counter() - start, note=' (connecting)' if i == 0 else ''))
+        await fleet.close()
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Measure how long imports take and how soon a started web server answers searches
+
+With systeminfo installed (`pip install -e .`), run from the repository root:
+
+    python3 benchmarks/startup.py [--images N] [--packages N] [--delay SECONDS] [--repeat N]
+
+Import times are the median over fresh interpreters, for the package and
+for the modules the web server uses on their own.
+
+The server is started twice on `fixtures.FakeImage`s whose commands take
+`--delay` seconds, each time in a fresh interpreter: `cold` with an empty
+inventory cache and `warm` with the cache the cold run left behind, like a
+restart. Both report the seconds from starting the server until `/ready`
+answers, until a search returns results and until the first refresh is
+done. This part needs aiohttp and the web server's dependencies.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULES = ('systeminfo', 'systeminfo.metrics', 'systeminfo.query', 'systeminfo.index', 'systeminfo.info')
+
+
+def import_time(module, repeat):
+    """
+    The median seconds `import module` takes in a fresh interpreter
+    """
+    code = 'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'.format(module=module)
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        times.append(float(output))
+    return statistics.median(times)
+
+
+def run_server(directory, images, packages, delay):
+    """
+    Start the web server on fake images and print when it became ready, searchable and refreshed, as JSON
+    """
+    import logging
+    sys.path.insert(0, HERE)
+    sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'web'))
+    from aiohttp.test_utils import TestClient, TestServer
+    from fixtures import FakeImage
+    import systeminfo
+    import app as webapp
+    import gen_images
+    from api import keys
+
+    paths = []
+    for i in range(images):
+        path = os.path.join(directory, 'image{i:04}.img'.format(i=i))
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write(path)
+        paths.append(path)
+
+    def discover_images(app):
+        previous = app[keys.STATE].images
+        return {path: previous.get(path) or FakeImage(i, packages, path=path, delay=delay, cache=app[keys.STATE].inventory_cache)
+                for i, path in enumerate(paths)}
+    # Both the startup and every refresh find the fake images
+    webapp.discover_images = gen_images.discover_images = discover_images
+
+    async def run():
+        application = webapp.create_app()
+        logging.disable(logging.WARNING)
+        application[keys.STATE].inventory_cache = systeminfo.InventoryCache(os.path.join(directory, 'inventory.sqlite3'))
+        times = {}
+        start = time.perf_counter()
+        async with TestClient(TestServer(application)) as client:
+            while 'refreshed' not in times:
+                elapsed = time.perf_counter() - start
+                if 'ready' not in times:
+                    response = await client.get('/ready')
+                    if response.status == 200:
+                        times['ready'] = elapsed
+                if 'searchable' not in times:
+                    response = await client.get('/api/search', params={'query': 'vim', 'format': 'json'})
+                    if response.status == 200 and (await response.json())['results']:
+                        times['searchable'] = elapsed
+                if application[keys.STATE].refreshed:
+                    times['refreshed'] = elapsed
+                await asyncio.sleep(0.01)
+        return times
+    print(json.dumps(asyncio.run(run())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--packages', type=int, default=5000, help="packages per image")
+    parser.add_argument('--delay', type=float, default=0.5, help="seconds every command of an image takes")
+    parser.add_argument('--repeat', type=int, default=10, help="interpreters to time every import in")
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return run_server(args.run, args.images, args.packages, args.delay)
+
+    for module in MODULES:
+        print("import {module:<24} {seconds:8.4f} s".format(module=module, seconds=import_time(module, args.repeat)))
+    with tempfile.TemporaryDirectory() as directory:
+        for start in ('cold', 'warm'):
+            process = subprocess.run([sys.executable, __file__, '--run', directory, '--images', str(args.images),
+                                      '--packages', str(args.packages), '--delay', str(args.delay)],
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            if process.returncode:
+                print("{start:<6} error: {error}".format(start=start, error=(process.stderr.strip().splitlines() or ['?'])[-1]))
+                continue
+            times = json.loads(process.stdout.strip().splitlines()[-1])
+            print("{start:<6} ready {ready:8.3f} s  searchable {searchable:8.3f} s  refreshed {refreshed:8.3f} s".format(
+                start=start, **{key: times.get(key, float('nan')) for key in ('ready', 'searchable', 'refreshed')}))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
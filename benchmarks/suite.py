@@ -0,0 +1,277 @@
+"""
+Benchmark parsing, collecting and searching on fake images, and compare against baselines
+
+With systeminfo installed (`pip install -e .`), run from the repository root:
+
+    python3 benchmarks/suite.py [--images 1,100] [--cases CASE,...] [--save]
+
+Every case runs once per number of images in a fresh interpreter, so the
+peak RSS it reports is its own. The images are `fixtures.FakeImage`s with
+5000 packages each. Results are compared against `benchmarks/baselines.json`:
+a case regresses when its throughput drops, or its p99 latency or peak RSS
+grows, by more than the tolerance. A case that regresses runs once more, and
+if it regresses again the exit status is 1. A case
+that has no baseline or fails to run, like one that runs out of memory,
+fails the suite too. `--save` replaces the baselines of the cases that ran
+with their new results. Baselines are only meaningful on the machine that
+recorded them.
+
+Only 1 and 100 images run by default. `--images 1000` is left to machines
+with more than 5 GB of memory, `search_helper` keeps a name index of its own
+for every image and runs out of memory below that.
+
+The `search_endpoint` cases need aiohttp and the web server's dependencies.
+They page through the results `PAGE` images at a time like a client would,
+a query for `lib` over every image is a body of hundreds of megabytes, more
+than the response cache holds. The cached case only times requests the
+response cache answers.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(HERE, 'baselines.json')
+QUERIES = (
+    [('vim', '')],
+    [('python3', '')],
+    [('lib', '')],
+    [('corecuda', '1')],
+    [('vim', ''), ('python3', '3')],
+    [('does-not-exist', '')],
+)
+# Images per page of `/api/search`
+PAGE = 100
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def result(count, unit, latencies, duration):
+    """
+    Summarize a case: count things done in duration seconds, with the latency of each operation
+    """
+    return {
+        'throughput': count / duration,
+        'unit': unit,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def rounds(images):
+    # Small scales are repeated so they are measured more than once
+    return max(1, 10 // images)
+
+
+def loaded_images(images, packages):
+    from fixtures import fake_images
+    infos = fake_images(images, packages, compact=True)
+    for info in infos.values():
+        info.get_dict()
+        # Like the web server, nothing needs the fixtures or the changes of the first load afterwards
+        info.apt_text = info.pip_text = None
+        info.changes = None
+    return infos
+
+
+def case_apt_list_helper(images, packages):
+    """
+    Parse the `apt list` output of every image
+    """
+    from fixtures import apt_list_text
+    import systeminfo
+    latencies = []
+    lines = 0
+    for image in range(images):
+        text = apt_list_text(image, packages - packages // 10)
+        for _ in range(rounds(images)):
+            start = time.perf_counter()
+            lines += len(list(systeminfo.System._apt_list_helper(text)))
+            latencies.append(time.perf_counter() - start)
+    return result(lines, 'lines/s', latencies, sum(latencies))
+
+
+def case_get_dict(images, packages):
+    """
+    Build the package dictionary of every image, one at a time
+    """
+    from fixtures import FakeImage
+    latencies = []
+    count = 0
+    for image in range(images):
+        info = FakeImage(image, packages)
+        for _ in range(rounds(images)):
+            info.invalidate()
+            start = time.perf_counter()
+            count += len(info.get_dict())
+            latencies.append(time.perf_counter() - start)
+    return result(count, 'packages/s', latencies, sum(latencies))
+
+
+def case_search_helper(images, packages):
+    """
+    Run every query against every image the way the web server does without a global index
+    """
+    infos = loaded_images(images, packages)
+    for info in infos.values():
+        # Name indexes are built on the first search, that isn't what is measured here
+        info.index
+    latencies = []
+    for _ in range(3):
+        for terms in QUERIES:
+            start = time.perf_counter()
+            for info in infos.values():
+                for name, version in terms:
+                    if not info._search_helper(name, info.dict, version=version):
+                        break
+            latencies.append(time.perf_counter() - start)
+    return result(len(latencies), 'queries/s', latencies, sum(latencies))
+
+
+def _search_endpoint(images, packages, cached):
+    sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'web'))
+    from aiohttp.test_utils import TestClient, TestServer
+    import app as webapp
+    from api import keys
+
+    infos = loaded_images(images, packages)
+    application = webapp.create_app()
+    # The images are published here instead of by the background refresh
+    application.on_startup.clear()
+    application.on_cleanup.clear()
+    webapp.publish(application, infos)
+
+    async def run():
+        latencies = []
+        async with TestClient(TestServer(application)) as client:
+            # The cached case fills the cache first, only answers from it are timed
+            for round in range(6 if cached else 5):
+                for terms in QUERIES:
+                    query = ','.join(name + ('=' + version if version else '') for name, version in terms)
+                    if not cached:
+                        application[keys.RESPONSE_CACHE].clear()
+                    start = time.perf_counter()
+                    response = await client.get('/api/search', params={'query': query, 'format': 'json', 'limit': str(PAGE)})
+                    await response.read()
+                    if not cached or round:
+                        latencies.append(time.perf_counter() - start)
+                    if response.status != 200:
+                        raise Exception("`{query}` returned {status}".format(query=query, status=response.status))
+        return latencies
+    latencies = asyncio.run(run())
+    if cached and application[keys.RESPONSE_CACHE].hits != len(latencies):
+        # Every timed request has to be a hit, or this measures searching
+        raise Exception("The response cache answered {hits} of {count} requests".format(
+            hits=application[keys.RESPONSE_CACHE].hits, count=len(latencies)))
+    return result(len(latencies), 'requests/s', latencies, sum(latencies))
+
+
+def case_search_endpoint(images, packages):
+    """
+    Request `/api/search` through an in-process aiohttp client, without the response cache
+    """
+    return _search_endpoint(images, packages, cached=False)
+
+
+def case_search_endpoint_cached(images, packages):
+    """
+    Request `/api/search` through an in-process aiohttp client, answered from the response cache
+    """
+    return _search_endpoint(images, packages, cached=True)
+
+
+CASES = {name[len('case_'):]: func for name, func in sorted(globals().items()) if name.startswith('case_')}
+
+
+def run_case(case, images, packages):
+    """
+    Run a single case in this interpreter and print its result as JSON
+    """
+    sys.path.insert(0, HERE)
+    logging.disable(logging.WARNING)
+    summary = CASES[case](images, packages)
+    # ru_maxrss is in KiB on Linux
+    summary['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(summary))
+
+
+def spawn_case(case, images, packages):
+    process = subprocess.run([sys.executable, __file__, '--run', case, '--images', str(images), '--packages', str(packages)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode:
+        return {'error': (process.stderr.strip().splitlines() or ['exit status {code}'.format(code=process.returncode)])[-1]}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def regressions(summary, baseline, tolerance):
+    """
+    Return a description of every way summary is worse than baseline
+    """
+    found = []
+    if summary['throughput'] < baseline['throughput'] * (1 - tolerance):
+        found.append('throughput {old:.4g} -> {new:.4g} {unit}'.format(
+            old=baseline['throughput'], new=summary['throughput'], unit=summary['unit']))
+    for key in ('p99', 'peak_rss_mb'):
+        if summary[key] > baseline[key] * (1 + tolerance):
+            found.append('{key} {old:.4g} -> {new:.4g}'.format(key=key, old=baseline[key], new=summary[key]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', default='1,100', help="comma separated numbers of images, see above for 1000")
+    parser.add_argument('--packages', type=int, default=5000, help="packages per image")
+    parser.add_argument('--cases', default=','.join(CASES), help="comma separated cases to run")
+    parser.add_argument('--baselines', default=BASELINES)
+    parser.add_argument('--tolerance', type=float, default=0.25, help="fraction a result may be worse than its baseline")
+    parser.add_argument('--save', action='store_true', help="store the results as the new baselines")
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return run_case(args.run, int(args.images), args.packages)
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    failed = False
+    for case in args.cases.split(','):
+        for images in (int(images) for images in args.images.split(',')):
+            key = '{case}/{images}x{packages}'.format(case=case, images=images, packages=args.packages)
+            summary = spawn_case(case, images, args.packages)
+            if 'error' not in summary and key in baselines and regressions(summary, baselines[key], args.tolerance):
+                # A busy machine makes single runs noisy, a regression has to show up twice
+                summary = spawn_case(case, images, args.packages)
+            if 'error' in summary:
+                failed = True
+                print("{key:<40} error: {error}".format(key=key, error=summary['error']))
+                continue
+            print("{key:<40} {throughput:12.1f} {unit:<11} p50 {p50:9.4f} s  p99 {p99:9.4f} s  peak RSS {peak_rss_mb:7.1f} MB".format(
+                key=key, **summary))
+            if key in baselines:
+                for regression in regressions(summary, baselines[key], args.tolerance):
+                    failed = True
+                    print("    REGRESSION {regression}".format(regression=regression))
+            elif not args.save:
+                failed = True
+                print("    NO BASELINE, record one with --save")
+            if args.save:
+                baselines[key] = summary
+    if args.save:
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,24 @@
-from .info import *
+import importlib
+
+# The classes are only imported when they are first used, so importing one
+# module, like `systeminfo.metrics`, doesn't load asyncio and subprocess too
+_LAZY = {
+    'Information': 'info',
+    'System': 'info',
+    'Singularity': 'info',
+    'InventoryCache': 'cache',
+    'Remote': 'remote',
+    'Fleet': 'remote',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module {module!r} has no attribute {name!r}".format(module=__name__, name=name))
+    value = getattr(importlib.import_module('.' + _LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class InventoryCache:
+    """
+    A persistent cache of package inventories, keyed by the image they came from
+
+    Every entry remembers the image's size, mtime, inode and a content hash.
+    As long as the stat information matches, the image is not read at all. A
+    new size or mtime means the image was written, and the inventory is
+    dropped. If only the inode changed, like when an image is copied over
+    with its mtime kept, a sampled hash of the image decides if the inventory
+    is still good. The hash only reads some blocks, enough to recognize a
+    copy but not an edit in place, which is why a new mtime is never hashed.
+
+    It can be used from any thread, one at a time goes through the connection.
+    """
+    def __init__(self, path=':memory:', block_size=64 * 1024, samples=16):
+        """
+        path: the sqlite database file, the default only lives as long as the process
+        block_size: how many bytes each sample of an image is
+        samples: how many blocks spread through the image are hashed
+        """
+        self.path = path
+        self.block_size = block_size
+        self.samples = samples
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS inventory (
+                path TEXT NOT NULL,
+                long INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                inventory TEXT NOT NULL,
+                PRIMARY KEY (path, long)
+            )''')
+        self.db.commit()
+
+    @property
+    def log(self):
+        return logger
+
+    def content_hash(self, path):
+        """
+        Hash the size and a fixed number of evenly spaced blocks of a file
+
+        The first and last blocks are always included, the cost doesn't grow
+        with the size of the image
+        """
+        size = os.path.getsize(path)
+        digest = hashlib.blake2b(str(size).encode(), digest_size=20)
+        with open(path, 'rb') as f:
+            if size <= self.block_size * self.samples:
+                digest.update(f.read())
+            else:
+                step = (size - self.block_size) // (self.samples - 1)
+                for i in range(self.samples):
+                    f.seek(i * step)
+                    digest.update(f.read(self.block_size))
+        return digest.hexdigest()
+
+    def _row(self, path, long):
+        with self.lock:
+            return self.db.execute('SELECT size, mtime, inode, hash, inventory FROM inventory WHERE path = ? AND long = ?',
+                                   (path, int(long))).fetchone()
+
+    def _write(self, statement, parameters=()):
+        with self.lock:
+            self.db.execute(statement, parameters)
+            self.db.commit()
+
+    def get(self, path, long=True):
+        """
+        Return the cached inventory of the image at path, or None if it is unknown or changed
+        """
+        inventory = self._get(path, long)
+        metrics.CACHE_REQUESTS.labels('inventory', 'miss' if inventory is None else 'hit').inc()
+        return inventory
+
+    def _get(self, path, long):
+        row = self._row(path, long)
+        if row is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        size, mtime, inode, content_hash, inventory = row
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+            self.log.info("Image changed, cache is stale: `{path}`".format(path=path))
+            return None
+        if stat.st_ino != inode:
+            if self.content_hash(path) != content_hash:
+                self.log.info("Image replaced, cache is stale: `{path}`".format(path=path))
+                return None
+            # Same content, remember the new inode so we don't hash again
+            self._write('UPDATE inventory SET inode = ? WHERE path = ? AND long = ?', (stat.st_ino, path, int(long)))
+        return json.loads(inventory)
+
+    def snapshot(self, path, long=True):
+        """
+        Return the last stored inventory of the image at path without checking the image, or None
+
+        Good enough to serve while the image is checked, it may be out of date
+        """
+        row = self._row(path, long)
+        return json.loads(row[4]) if row is not None else None
+
+    def put(self, path, inventory, long=True):
+        """
+        Store the inventory of the image at path
+        """
+        stat = os.stat(path)
+        row = self._row(path, long)
+        if row is not None and (stat.st_size, stat.st_mtime_ns, stat.st_ino) == row[:3]:
+            content_hash = row[3]
+        else:
+            content_hash = self.content_hash(path)
+        self._write('INSERT OR REPLACE INTO inventory VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (path, int(long), stat.st_size, stat.st_mtime_ns, stat.st_ino, content_hash, json.dumps(inventory)))
+
+    def hash(self, path):
+        """
+        Return the last known content hash of the image at path
+        """
+        with self.lock:
+            row = self.db.execute('SELECT hash FROM inventory WHERE path = ?', (path,)).fetchone()
+        return row[0] if row else None
+
+    def invalidate(self, path=None):
+        """
+        Forget the inventory of the image at path, or of every image if path is None
+        """
+        if path is None:
+            self._write('DELETE FROM inventory')
+        else:
+            self._write('DELETE FROM inventory WHERE path = ?', (path,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
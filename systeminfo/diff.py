@@ -0,0 +1,123 @@
+import collections
+import os
+from .store import PackageRow
+
+
+class Changes:
+    """
+    The differences between two package dictionaries
+    """
+    def __init__(self, added=None, removed=None, changed=None):
+        self.added = added or {}  # Name to the new app
+        self.removed = removed or {}  # Name to the old app
+        self.changed = changed or {}  # Name to (old app, new app)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return '<Changes added={added} removed={removed} changed={changed}>'.format(
+            added=len(self.added), removed=len(self.removed), changed=len(self.changed))
+
+    def entries(self, system_name):
+        """
+        Return the changes as a list of dictionaries, the format used by `ChangeLog`
+        """
+        entries = []
+        for name, app in self.added.items():
+            entries.append({'image': system_name, 'change': 'added', 'package': name, 'version': app.get('version')})
+        for name, app in self.removed.items():
+            entries.append({'image': system_name, 'change': 'removed', 'package': name, 'old_version': app.get('version')})
+        for name, (old, new) in self.changed.items():
+            entries.append({'image': system_name, 'change': 'changed', 'package': name,
+                            'old_version': old.get('version'), 'version': new.get('version')})
+        return entries
+
+
+def diff_inventories(old, new):
+    """
+    Compare two dictionaries of package names to their information
+
+    A package counts as changed if any of its fields changed, usually the version.
+    Old apps that are views into a compact inventory are copied, so they
+    still say what they were once the inventory is brought up to date.
+    """
+    old = old if old is not None else {}
+    added = {name: app for name, app in new.items() if name not in old}
+    removed = {name: _detached(app) for name, app in old.items() if name not in new}
+    changed = {}
+    for name, app in new.items():
+        if name in old and old[name] != app:
+            changed[name] = (_detached(old[name]), app)
+    return Changes(added, removed, changed)
+
+
+def _detached(app):
+    return app.to_dict() if isinstance(app, PackageRow) else app
+
+
+class ChangeLog:
+    """
+    A bounded history of changes, each tagged with the generation that published it
+
+    Consumers remember the last generation they saw and ask for what happened
+    since, instead of downloading everything again. Generations start over
+    with every new log, so each log has a random `epoch` too, and a
+    generation only means something together with the epoch it came from.
+    """
+    def __init__(self, max_entries=100000):
+        self.entries = collections.deque(maxlen=max_entries)
+        self.generation = 0
+        self.epoch = os.urandom(8).hex()
+        # Anything at or before this generation may have been dropped
+        self.oldest = 0
+
+    def record(self, generation, entries):
+        """
+        Add the entries published with generation
+        """
+        for entry in entries:
+            if len(self.entries) == self.entries.maxlen:
+                self.oldest = self.entries[0]['generation']
+            entry = dict(entry)
+            entry['generation'] = generation
+            self.entries.append(entry)
+        self.generation = generation
+
+    def since(self, generation, epoch=None):
+        """
+        Return the entries published after generation, or None if some of them were already dropped
+
+        generation: 0 for every entry, any other generation needs the epoch it
+            came with. One from another epoch is from before a restart, when
+            generations started over, so it gets None too
+        """
+        if generation and epoch != self.epoch:
+            return None
+        if generation < self.oldest or generation > self.generation:
+            return None
+        return [entry for entry in self.entries if entry['generation'] > generation]
+
+    def state(self, recent=None):
+        """
+        Return what the log holds as a dictionary JSON can encode, `from_state` makes it a log again
+
+        recent: keep only this many of the latest entries, a log made from
+            the state answers None for anything older
+        """
+        entries = list(self.entries)
+        oldest = self.oldest
+        if recent is not None and len(entries) > recent:
+            oldest = entries[-recent - 1]['generation']
+            entries = entries[len(entries) - recent:]
+        return {'entries': entries, 'generation': self.generation, 'oldest': oldest,
+                'max_entries': self.entries.maxlen, 'epoch': self.epoch}
+
+    @classmethod
+    def from_state(cls, state):
+        changelog = cls(max_entries=state['max_entries'])
+        changelog.entries.extend(state['entries'])
+        changelog.generation = state['generation']
+        changelog.oldest = state['oldest']
+        changelog.epoch = state['epoch']
+        return changelog
@@ -0,0 +1,232 @@
+import fnmatch
+
+
+def iter_stanzas(lines, fields=None):
+    """
+    Stream RFC822 style stanzas out of a dpkg database file
+
+    lines: an iterable of lines, typically an open file
+    fields: a set of lowercase field names to keep, None keeps all of them
+
+    Only the current stanza is held in memory. Continuation lines (starting
+    with a space or tab) are appended to the field they belong to.
+    """
+    stanza = {}
+    key = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip():
+            if stanza:
+                yield stanza
+            stanza = {}
+            key = None
+            continue
+        if line[0] in ' \t':
+            if key is not None:
+                stanza[key] += '\n' + line[1:]
+            continue
+        name, _, value = line.partition(':')
+        key = name.strip().lower()
+        if fields is not None and key not in fields:
+            key = None
+            continue
+        stanza[key] = value.strip()
+    if stanza:
+        yield stanza
+
+
+def _order(char):
+    """
+    Sort weight of a character in the non digit part of a debian version
+    """
+    if char == '~':
+        return -1
+    if char.isdigit():
+        return 0
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def _compare_part(a, b):
+    """
+    dpkg's verrevcmp for the upstream version or revision
+    """
+    i = j = 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i]) if i < len(a) else 0
+            bc = _order(b[j]) if j < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def split_version(version):
+    """
+    Split a debian version into (epoch, upstream, revision)
+    """
+    epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+    upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '0')
+    try:
+        epoch = int(epoch)
+    except ValueError:
+        epoch = 0
+    return epoch, upstream, revision
+
+
+def compare_versions(a, b):
+    """
+    Compare two debian versions the same way `dpkg --compare-versions` does
+
+    Returns a negative number, zero or a positive number if a is older than,
+    equal to or newer than b
+    """
+    a_epoch, a_upstream, a_revision = split_version(a)
+    b_epoch, b_upstream, b_revision = split_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    return _compare_part(a_upstream, b_upstream) or _compare_part(a_revision, b_revision)
+
+
+def _part_key(part):
+    """
+    Sort key of an upstream version or revision that orders like `_compare_part`
+
+    Non digit runs become their character weights, ended by the weight of
+    the end of the string, digit runs become numbers.
+    """
+    key = []
+    i = 0
+    while i < len(part):
+        start = i
+        while i < len(part) and not part[i].isdigit():
+            i += 1
+        key.append(tuple(_order(char) for char in part[start:i]) + (0,))
+        start = i
+        while i < len(part) and part[i].isdigit():
+            i += 1
+        key.append(int(part[start:i] or 0))
+    # Trailing empty runs compare like the end of the string, drop them so `0` equals ``
+    while key[-2:] == [(0,), 0]:
+        del key[-2:]
+    # Then an explicit end, so a longer version that continues with `~` sorts before it. Only
+    # the first pair can equal it (`0~`), so the end is repeated once to compare past that
+    return tuple(key) + ((0,), 0, (0,), 0)
+
+
+def version_key(version):
+    """
+    Return a sort key for a debian version, comparing keys is the same as `compare_versions`
+
+    Parse versions once and keep their keys when comparing them many times
+    """
+    epoch, upstream, revision = split_version(version)
+    return epoch, _part_key(upstream), _part_key(revision)
+
+
+def auto_installed(lines):
+    """
+    Get the set of (name, arch) marked as automatically installed in apt's extended_states
+    """
+    return {(stanza.get('package'), stanza.get('architecture'))
+            for stanza in iter_stanzas(lines, fields={'package', 'architecture', 'auto-installed'})
+            if stanza.get('auto-installed') == '1'}
+
+
+def available_versions(lines, apps=None):
+    """
+    Map (name, arch) to every version found in the Packages lists or dpkg's available file
+    """
+    versions = {}
+    for stanza in iter_stanzas(lines, fields={'package', 'architecture', 'version'}):
+        name = stanza.get('package')
+        if name is None or not _wanted(name, apps):
+            continue
+        versions.setdefault((name, stanza.get('architecture')), set()).add(stanza.get('version', ''))
+    return versions
+
+
+def _wanted(name, apps):
+    return not apps or any(fnmatch.fnmatchcase(name, app) for app in apps)
+
+
+def _state(installed, auto, versions):
+    """
+    Build the same `[...]` state string `apt list` prints for an installed version
+    """
+    if versions is not None:
+        if versions and compare_versions(max(versions, key=_VersionKey), installed) > 0:
+            return '[upgradable from: {installed}]'.format(installed=installed)
+        if installed not in versions:
+            return '[installed,local]'
+    if auto:
+        return '[installed,automatic]'
+    return '[installed]'
+
+
+class _VersionKey:
+    """
+    Lets `compare_versions` be used as a sort key
+    """
+    __slots__ = ('version',)
+
+    def __init__(self, version):
+        self.version = version
+
+    def __lt__(self, other):
+        return compare_versions(self.version, other.version) < 0
+
+
+def dpkg_list(status, extended_states=(), available=None, apps=None):
+    """
+    Generate the same dictionaries `System._apt_list_helper` makes from `apt list`
+
+    status: lines of /var/lib/dpkg/status
+    extended_states: lines of /var/lib/apt/extended_states, for the automatic flag
+    available: lines of the apt lists or dpkg's available file. When given,
+        upgradable and local packages are detected and packages that are only
+        available are listed as well, just like `apt list`
+    apps: optional list of package names or glob patterns to filter on
+    """
+    auto = auto_installed(extended_states)
+    versions = available_versions(available, apps) if available is not None else None
+    for stanza in iter_stanzas(status, fields={'package', 'status', 'architecture', 'version'}):
+        name = stanza.get('package')
+        if name is None or not _wanted(name, apps):
+            continue
+        arch = stanza.get('architecture', '')
+        current = stanza.get('status', '').split()
+        container = {'from': 'apt', 'name': name, 'version': stanza.get('version', ''), 'arch': arch}
+        if current[-1:] == ['installed']:
+            known = versions.pop((name, arch), set()) if versions is not None else None
+            container['state'] = _state(container['version'], (name, arch) in auto, known)
+        elif current[-1:] == ['config-files']:
+            if versions is not None:
+                versions.pop((name, arch), None)
+            container['state'] = '[residual-config]'
+        else:
+            continue
+        yield container
+    if versions:
+        # Whatever is left in the lists is not installed
+        for (name, arch), known in versions.items():
+            yield {'from': 'apt', 'name': name, 'version': max(known, key=_VersionKey), 'arch': arch}
@@ -0,0 +1,147 @@
+"""
+Read apt's history log, to know which packages were installed by hand
+
+Every apt run adds an entry like this to `/var/log/apt/history.log`:
+
+    Start-Date: 2018-10-01  12:00:00
+    Commandline: apt-get install -y vim
+    Install: vim:amd64 (2:8.0.1453-1ubuntu1), vim-runtime:amd64 (2:8.0.1453-1ubuntu1, automatic)
+    End-Date: 2018-10-01  12:00:05
+
+Packages installed without `automatic` were asked for, `Remove` and `Purge`
+take them away again. logrotate moves the log to `history.log.1.gz` and so
+on, those are read first, oldest first.
+"""
+import gzip
+import os
+import re
+import shlex
+from .dpkg import iter_stanzas
+
+HISTORY = '/var/log/apt/history.log'
+FIELDS = {'install', 'remove', 'purge'}
+
+_package = re.compile(r'([^\s,()]+) \(([^)]*)\)')
+_rotated = re.compile(r'\.(\d+)(?:\.gz)?$')
+
+
+def parse_packages(value):
+    """
+    Generate the (name, arch, version, automatic) of every package in a field like `Install`
+    """
+    for match in _package.finditer(value):
+        name, _, arch = match.group(1).partition(':')
+        version, _, flags = match.group(2).partition(', ')
+        yield name, arch, version, 'automatic' in flags
+
+
+def rotated_logs(path):
+    """
+    Return the rotated logs of path, like `history.log.2.gz` and `history.log.1`, oldest first
+    """
+    directory, name = os.path.split(path)
+    try:
+        files = os.listdir(directory or '.')
+    except OSError:
+        return []
+    logs = []
+    for file in files:
+        if not file.startswith(name + '.'):
+            continue
+        match = _rotated.match(file[len(name):])
+        if match:
+            logs.append((int(match.group(1)), os.path.join(directory, file)))
+    return [log for _, log in sorted(logs, reverse=True)]
+
+
+def open_log(path):
+    """
+    Open a log as text, rotated logs are decompressed as they are read
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace')
+
+
+class AptHistory:
+    """
+    The packages installed by hand according to apt's history, kept up to date from the end of the log
+
+    `update` only reads what was appended to the log since it last did, and
+    remembers the log's inode to notice when it was rotated. Logs that can't
+    be read directly are given to `feed` whole instead.
+    """
+    def __init__(self, path=HISTORY):
+        self.path = path
+        self.manual = {}  # Package name to the version it was installed with, in the order they were
+        self.inode = None
+        self.offset = 0  # Bytes of the log that were applied, always the end of an entry
+
+    def apply(self, entry):
+        """
+        Apply one entry of the log, a dictionary of its lowercase fields
+        """
+        for name, arch, version, automatic in parse_packages(entry.get('install', '')):
+            if not automatic:
+                self.manual[name] = version
+        for field in ('remove', 'purge'):
+            for name, arch, version, automatic in parse_packages(entry.get(field, '')):
+                self.manual.pop(name, None)
+
+    def feed(self, lines):
+        """
+        Apply every entry in an iterable of lines of the log
+        """
+        for entry in iter_stanzas(lines, FIELDS):
+            self.apply(entry)
+
+    def reset(self):
+        """
+        Forget everything and apply the rotated logs, the log itself is read from its start next
+        """
+        self.manual = {}
+        self.inode = None
+        self.offset = 0
+        for path in rotated_logs(self.path):
+            with open_log(path) as log:
+                self.feed(log)
+
+    def update(self):
+        """
+        Apply the entries appended to the log since the last update
+
+        If the log was rotated or truncated since, everything is read again
+        from the oldest rotated log on. An entry that is still being written
+        is left for the next update.
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            self.reset()
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.reset()
+                self.inode = stat.st_ino
+            f.seek(self.offset)
+            entry = []
+            for line in f:
+                entry.append(line)
+                if line.startswith(b'End-Date:') and line.endswith(b'\n'):
+                    # Applied an entry at a time, only the one being read is held
+                    self.feed(b''.join(entry).decode('utf-8', 'replace').splitlines())
+                    self.offset += sum(len(line) for line in entry)
+                    entry = []
+
+    def command(self):
+        """
+        Shell command that prints the rotated logs, oldest first, and then the log
+
+        For systems whose files can't be read directly, the output is given to `feed`
+        """
+        directory, name = os.path.split(self.path)
+        script = ('cd {directory} 2>/dev/null || exit 0; '
+                  'for f in $(ls {name}.* 2>/dev/null | sort -t . -k 3 -n -r) {name}; do '
+                  '[ -f "$f" ] && zcat -f "$f" && echo; done').format(directory=shlex.quote(directory or '.'), name=shlex.quote(name))
+        return 'sh -c {script}'.format(script=shlex.quote(script))
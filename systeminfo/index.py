@@ -0,0 +1,237 @@
+from . import query
+
+
+def trigrams(name):
+    """
+    Return the set of three character substrings of name
+    """
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+class NameIndex:
+    """
+    An inverted trigram index over package names
+
+    A fuzzy search only has to check the names that contain every trigram of
+    the search term instead of every name. Names are returned in the same
+    order a linear scan followed by a sort on length would give.
+    """
+    def __init__(self, names=()):
+        self.grams = {}  # Trigram to the set of names containing it
+        self.order = {}  # Name to its position, doubles as the exact match lookup
+        self.update(names)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, name):
+        return name in self.order
+
+    def _add(self, name):
+        for gram in trigrams(name):
+            self.grams.setdefault(gram, set()).add(name)
+
+    def _remove(self, name):
+        for gram in trigrams(name):
+            names = self.grams[gram]
+            names.discard(name)
+            if not names:
+                del self.grams[gram]
+
+    def update(self, names):
+        """
+        Make the index match names, only touching the postings of names that were added or removed
+
+        names: every name, in the order they should be returned when they tie on length
+        """
+        names = list(names)
+        new = set(names)
+        for name in self.order.keys() - new:
+            self._remove(name)
+        for name in new - self.order.keys():
+            self._add(name)
+        self.order = {name: i for i, name in enumerate(names)}
+        self.next_position = len(names)
+
+    def add(self, name):
+        """
+        Add a single name after every other name
+        """
+        if name in self.order:
+            return
+        self._add(name)
+        self.order[name] = self.next_position
+        self.next_position += 1
+
+    def discard(self, name):
+        """
+        Remove a single name, if it is there
+        """
+        if name not in self.order:
+            return
+        self._remove(name)
+        del self.order[name]
+
+    def candidates(self, term):
+        """
+        Return the names that could contain term
+        """
+        grams = trigrams(term)
+        if not grams:
+            # Too short to use the index
+            return self.order.keys()
+        postings = []
+        for gram in grams:
+            if gram not in self.grams:
+                return set()
+            postings.append(self.grams[gram])
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def find(self, term, match=False):
+        """
+        Return the names that contain term, or equal it if match is true, shortest first
+        """
+        if match:
+            return [term] if term in self.order else []
+        names = [name for name in self.candidates(term) if term in name]
+        names.sort(key=lambda name: (len(name), self.order[name]))
+        return names
+
+
+class GlobalIndex:
+    """
+    An index of the packages of many systems at once
+
+    Maps every package name to the systems that have it, so a query is
+    answered with one lookup per term instead of one search per system.
+    Build a new index and swap it in to publish a whole new set of data, or
+    use `apply` and `remove` to change only what a refresh changed. Neither
+    awaits, so a request running on the same event loop never sees a half
+    applied change.
+    """
+    def __init__(self, systems):
+        """
+        systems: dictionary of names to `System`s whose dict is already populated
+        """
+        self.systems = list(systems)
+        self.packages = {}  # Package name to a list of (system name, position in its dict, app)
+        self.positions = {}  # System name to the position its next new package gets
+        for system_name, info in systems.items():
+            for position, (name, app) in enumerate((info.dict or {}).items()):
+                self.packages.setdefault(name, []).append((system_name, position, app))
+            self.positions[system_name] = len(info.dict or {})
+        self.names = NameIndex(self.packages)
+
+    def _discard(self, system_name, name):
+        entries = [entry for entry in self.packages.get(name, ()) if entry[0] != system_name]
+        if entries:
+            self.packages[name] = entries
+        else:
+            self.packages.pop(name, None)
+            self.names.discard(name)
+
+    def apply(self, system_name, changes):
+        """
+        Apply the `Changes` of one system, adding the system if it is new
+        """
+        if system_name not in self.positions:
+            self.systems.append(system_name)
+            self.positions[system_name] = 0
+        for name in changes.removed:
+            self._discard(system_name, name)
+        for name, (old, app) in changes.changed.items():
+            # Replaced packages keep their position, like they do in the dictionary
+            self.packages[name] = [(entry[0], entry[1], app) if entry[0] == system_name else entry for entry in self.packages[name]]
+        for name, app in changes.added.items():
+            if name not in self.packages:
+                self.names.add(name)
+            self.packages.setdefault(name, []).append((system_name, self.positions[system_name], app))
+            self.positions[system_name] += 1
+
+    def remove(self, system_name):
+        """
+        Remove every package of a system
+        """
+        if system_name not in self.positions:
+            return
+        for name in [name for name, entries in self.packages.items() if any(entry[0] == system_name for entry in entries)]:
+            self._discard(system_name, name)
+        self.systems.remove(system_name)
+        del self.positions[system_name]
+
+    def reorder(self, system_names):
+        """
+        Put the systems in the order of system_names, results are returned in that order
+
+        Systems that aren't in system_names keep their place after the others
+        """
+        known = set(self.positions)
+        ordered = [system_name for system_name in system_names if system_name in known]
+        rest = set(ordered)
+        self.systems = ordered + [system_name for system_name in self.systems if system_name not in rest]
+
+    def find(self, term, version='', match=False):
+        """
+        Search every system for one term
+
+        Returns a dictionary of system name to the same list `System.search` would return
+        """
+        found = {}
+        for name in self.names.find(term, match=match):
+            for system_name, position, app in self.packages[name]:
+                if version in app['version']:
+                    found.setdefault(system_name, []).append((len(name), position, app))
+        return {system_name: [app if isinstance(app, dict) else dict(app) for _, _, app in sorted(apps, key=lambda item: item[:2])]
+                for system_name, apps in found.items()}
+
+    def count(self, name):
+        """
+        How many systems have a package called name
+        """
+        return len(self.packages.get(name, ()))
+
+    def entries(self, name):
+        """
+        The (system name, position, app) of every system with a package called name
+        """
+        return self.packages.get(name, ())
+
+    def system_names(self):
+        return self.systems
+
+    def query(self, node):
+        """
+        Run a parsed `query` against every system
+
+        Returns a dictionary of system name to a dictionary of the packages
+        that matched, systems are in the order they were indexed
+        """
+        return query.run(node, self)
+
+    def iter_query(self, node):
+        """
+        Run a parsed `query` like `query`, but generate the (system name, packages) one system at a time
+        """
+        return query.iter_run(node, self)
+
+    def search(self, terms, match=False):
+        """
+        Find the systems that have a match for every term
+
+        terms: list of (package name, version) tuples
+        Returns an ordered dictionary of system name to a list with the
+        results of each term, systems are in the order they were indexed
+        """
+        results = None
+        for term, version in terms:
+            found = self.find(term, version=version, match=match)
+            if results is None:
+                results = {system_name: [apps] for system_name, apps in found.items()}
+            else:
+                results = {system_name: lists + [found[system_name]] for system_name, lists in results.items() if system_name in found}
+            if not results:
+                return {}
+        if results is None:
+            return {}
+        return {system_name: results[system_name] for system_name in self.systems if system_name in results}
@@ -1,10 +1,16 @@
-import subprocess
 import logging
 import json
 import re
-import asyncio
+import io
+import itertools
+import os
+import time
+from .dpkg import dpkg_list
+from . import metadata
+from . import metrics
+from .store import Inventory, PackageRow
+from .diff import Changes, diff_inventories
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
@@ -13,81 +19,507 @@ class Information:
     This class represents a single system and you can query it to get that
     information.
     """
-    def __init__(self, pre_command='', timeout=30):
+    def __init__(self, pre_command='', timeout=30, root=None, filesystem=None, processes=None):
         """
         pre_command: The string to put in front of any command run. Useful for running remote commands
         timeout: The maximum time a command should take
+        root: Directory the system's files can be read from directly, like a
+            mounted or extracted image. If not set, files are read directly
+            when there is no pre_command and through `cat` otherwise
+        filesystem: Object the system's files are read from instead, with
+            `glob`, `isfile` and `open_text` methods like a `SquashFS`
+        processes: the `ProcessPool` commands are started from, the
+            one every system shares by default
         """
+        from .process import get_pool as get_process_pool
         self.pre_command = pre_command
         self.timeout = timeout
+        self.root = root
+        self.filesystem = filesystem
         self.stderr_into_stdout = True
+        self.processes = processes if processes is not None else get_process_pool()
 
     @property
     def log(self):
         return logger
 
     def process_command(self, command):
-        # TODO handle list as well for when shell != True
+        import shlex
         if type(command) is list:
-            if type(self.pre_command is not list):
+            if type(self.pre_command) is not list:
                 cmd = self.pre_command.split() + command
             else:
                 cmd = self.pre_command + command
         else:
             if type(self.pre_command) is list:
-                cmd = ' '.join(self.pre_command) + command
+                cmd = ' '.join(shlex.quote(word) for word in self.pre_command) + ' ' + command
             else:
                 cmd = self.pre_command + command
         return cmd
 
     def run_command(self, command, shell=False):
+        import subprocess
         cmd = self.process_command(command)
         self.log.debug('Running: `{cmd}`'.format(cmd=cmd))
         stderr = subprocess.STDOUT if self.stderr_into_stdout else subprocess.DEVNULL
-        status = subprocess.run(cmd, shell=shell, timeout=self.timeout, stdout=subprocess.PIPE, stderr=stderr)
+        label = metrics.command_label(command)
+        start = time.perf_counter()
+        try:
+            status = self.processes.run(cmd, shell=shell, timeout=self.timeout, stdout=subprocess.PIPE, stderr=stderr)
+        except Exception:
+            metrics.COMMAND_FAILURES.labels(label).inc()
+            raise
+        metrics.COMMAND_DURATION.labels(label).observe(time.perf_counter() - start)
+        metrics.COMMAND_BYTES.labels(label).inc(len(status.stdout))
         return status
     
     async def async_run_command(self, command):
+        """
+        Start a command and return its asyncio `Process`
+
+        Strings only go through a shell when they need one, lists never do.
+        The command waits for a free slot in `processes` first
+        """
+        import asyncio
         cmd = self.process_command(command)
         self.log.debug('Running: `{cmd}`'.format(cmd=cmd))
         stderr = asyncio.subprocess.STDOUT if self.stderr_into_stdout else asyncio.subprocess.DEVNULL
-        status = await asyncio.subprocess.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=stderr)
+        start = time.perf_counter()
+        status = await self.processes.start(cmd, stdout=asyncio.subprocess.PIPE, stderr=stderr)
+        metrics.COMMAND_SPAWN.labels(metrics.command_label(command)).observe(time.perf_counter() - start)
         return status
     
     def get_command_text(self, command, shell=False, check=True):
         status = self.run_command(command, shell)
         if check:
+            if status.returncode != 0:
+                metrics.COMMAND_FAILURES.labels(metrics.command_label(command)).inc()
             status.check_returncode()
         text = status.stdout.decode('utf-8')
         self.log.debug('cmd output: `{text}`'.format(text=text))
         return text
     
     async def async_get_command_text(self, command, check=True):
+        import asyncio
+        label = metrics.command_label(command)
+        start = time.perf_counter()
         status = await self.async_run_command(command)
-        # I think we want to use communicate first, so we get the text, then call wait to set returncode
-        # TODO does communicate() set the returncode?
-        stdout, stderr = await asyncio.wait_for(status.communicate(), self.timeout)  # You wait for the timeout
-        await status.wait()  # TODO use wait_for here too
+        # Waits for the command to exit too, on a timeout or cancellation its process group is killed
+        try:
+            stdout, stderr = await self.processes.communicate(status, self.timeout)
+        except asyncio.TimeoutError:
+            metrics.COMMAND_FAILURES.labels(label).inc()
+            raise
+        metrics.COMMAND_DURATION.labels(label).observe(time.perf_counter() - start)
+        metrics.COMMAND_BYTES.labels(label).inc(len(stdout))
         if check:
             if status.returncode != 0:
+                metrics.COMMAND_FAILURES.labels(label).inc()
                 raise Exception(f"Error running command {command};\nstdout: {stdout}\nstderr: {stderr}")
         text = stdout.decode('utf-8')
         self.log.debug('cmd output: `{text}`'.format(text=text))
         return text
 
+    def iter_command_chunks(self, command, shell=False, check=True, size=64 * 1024):
+        """
+        Run a command and generate its output as decoded text chunks, as soon as they are read
+
+        Unlike `get_command_text` the whole output is never held in memory.
+        If the generator is closed early the command is killed
+        """
+        import codecs
+        import subprocess
+        import threading
+        cmd = self.process_command(command)
+        self.log.debug('Running: `{cmd}`'.format(cmd=cmd))
+        stderr = subprocess.STDOUT if self.stderr_into_stdout else subprocess.DEVNULL
+        deadline = time.monotonic() + self.timeout
+        label = metrics.command_label(command)
+        start = time.perf_counter()
+        process = self.processes.popen(cmd, shell=shell, stdout=subprocess.PIPE, stderr=stderr)
+        metrics.COMMAND_SPAWN.labels(label).observe(time.perf_counter() - start)
+        # A command that prints nothing never gets back to the deadline checks, it is killed from a thread instead
+        timer = threading.Timer(self.timeout, self.processes.kill, (process.pid, 'timeout'))
+        timer.daemon = True
+        timer.start()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        total = 0
+        failed = True
+        reason = 'abandoned'
+        try:
+            while True:
+                data = process.stdout.read1(size)
+                if not data:
+                    break
+                total += len(data)
+                yield decoder.decode(data)
+                if time.monotonic() > deadline:
+                    reason = 'timeout'
+                    raise subprocess.TimeoutExpired(cmd, self.timeout)
+            if time.monotonic() > deadline:
+                reason = 'timeout'
+                raise subprocess.TimeoutExpired(cmd, self.timeout)
+            yield decoder.decode(b'', final=True)
+            try:
+                process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                reason = 'timeout'
+                raise
+            if check and process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+            failed = False
+            self.log.debug('cmd output: `{total}` bytes'.format(total=total))
+        finally:
+            timer.cancel()
+            self.processes.finished(process, reason)
+            process.stdout.close()
+            self._command_finished(label, start, total, failed)
+
+    async def async_iter_command_chunks(self, command, check=True, size=64 * 1024):
+        """
+        Run a command and generate its output as decoded text chunks, as soon as they are read
+        """
+        import asyncio
+        import codecs
+        label = metrics.command_label(command)
+        start = time.perf_counter()
+        process = await self.async_run_command(command)
+        deadline = time.monotonic() + self.timeout
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        total = 0
+        failed = True
+        reason = 'abandoned'
+        try:
+            while True:
+                data = await asyncio.wait_for(process.stdout.read(size), max(0, deadline - time.monotonic()))
+                if not data:
+                    break
+                total += len(data)
+                yield decoder.decode(data)
+            yield decoder.decode(b'', final=True)
+            await asyncio.wait_for(process.wait(), max(0, deadline - time.monotonic()))
+            if check and process.returncode != 0:
+                raise Exception(f"Error running command {command}; exit status {process.returncode}")
+            failed = False
+            self.log.debug('cmd output: `{total}` bytes'.format(total=total))
+        except asyncio.TimeoutError:
+            reason = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            reason = 'cancelled'
+            raise
+        finally:
+            if process.returncode is None:
+                await self.processes.abandon(process, reason)
+            self._command_finished(label, start, total, failed)
+
+    def _command_finished(self, label, start, total, failed):
+        # A generator closed early by its consumer counts as failed too, its command was killed
+        metrics.COMMAND_DURATION.labels(label).observe(time.perf_counter() - start)
+        metrics.COMMAND_BYTES.labels(label).inc(total)
+        if failed:
+            metrics.COMMAND_FAILURES.labels(label).inc()
+
+    def file_path(self, path):
+        """
+        Return where `path` on the system can be read from directly, or None
+        if it has to be read by running a command
+        """
+        if self.filesystem is not None:
+            return path
+        if self.root is not None:
+            return os.path.join(self.root, path.lstrip('/'))
+        if not self.pre_command:
+            return path
+        return None
+
+    def _cat_command(self, paths, missing_ok):
+        import shlex
+        # Every file is followed by a blank line so stanza based files can be concatenated
+        script = 'for f in {paths}; do [ -f "$f" ] && cat "$f" && echo; done'.format(paths=' '.join(paths))
+        if not missing_ok:
+            script = 'set -e; ' + script.replace('[ -f "$f" ] && ', '')
+        return 'sh -c {script}'.format(script=shlex.quote(script))
+
+    def _glob(self, pattern):
+        """
+        Return the sorted paths matching a pattern returned by `file_path`
+        """
+        import glob
+        if self.filesystem is not None:
+            return sorted(self.filesystem.glob(pattern))
+        return sorted(glob.glob(pattern))
+
+    def _isfile(self, path):
+        if self.filesystem is not None:
+            return self.filesystem.isfile(path)
+        return os.path.isfile(path)
+
+    def _open_file(self, path):
+        if self.filesystem is not None:
+            return self.filesystem.open_text(path)
+        return open(path, encoding='utf-8', errors='replace')
+
+    def _open_local(self, paths, missing_ok):
+        files = [self._glob(self.file_path(path)) for path in paths]
+        if not missing_ok and not all(files):
+            raise FileNotFoundError(' '.join(paths))
+        return self._read_local(itertools.chain.from_iterable(files))
+
+    def _read_local(self, files):
+        for file in files:
+            with self._open_file(file) as f:
+                yield from f
+            yield '\n'
+
+    def open_text(self, *paths, missing_ok=False):
+        """
+        Return an iterable of the lines in the files on the system
+
+        paths: absolute paths, shell style wildcards are allowed
+        missing_ok: if true, missing files are skipped instead of raising
+        """
+        if self.file_path('/') is not None:
+            return self._open_local(paths, missing_ok)
+        return io.StringIO(self.get_command_text(self._cat_command(paths, missing_ok), shell=True, check=not missing_ok))
+
+    async def async_open_text(self, *paths, missing_ok=False):
+        """
+        Return an iterable of the lines in the files on the system
+
+        Local files are read lazily, remote ones are read through a command
+        """
+        if self.file_path('/') is not None:
+            return self._open_local(paths, missing_ok)
+        return io.StringIO(await self.async_get_command_text(self._cat_command(paths, missing_ok), check=not missing_ok))
+
 
 class System(Information):
     """
     Used to describe some system, typically localhost
     """
-    def __init__(self, *args, **kwargs):
+    APT_STATUS = '/var/lib/dpkg/status'
+    APT_EXTENDED_STATES = '/var/lib/apt/extended_states'
+    APT_HISTORY = '/var/log/apt/history.log'
+    # dpkg's own available file is not consulted, apt itself ignores it
+    APT_AVAILABLE = ('/var/lib/apt/lists/*_Packages',)
+
+    PIP_SITE_PACKAGES = metadata.SITE_PACKAGES
+    PIP_SCRIPTS = metadata.PIP_SCRIPTS
+    # Methods that collect installed packages, with the `get_all_installed`
+    # arguments they take. Each needs an `async_` version too. They all run in
+    # parallel and earlier ones win when a name is found more than once
+    collectors = (
+        ('apt_installed', ()),
+        ('pip_list', ('long',)),
+    )
+    # Marks the start of a file when metadata is read through a command
+    _METADATA_MARKER = '@@systeminfo-metadata '
+    # Frames each section of a batched collection
+    _BATCH_MARKER = '@@systeminfo-batch '
+
+    def __init__(self, *args, apt_backend='apt', pip_backend='pip', cache=None, batch=False, compact=False,
+                 executor=None, **kwargs):
+        """
+        apt_backend: `apt` runs `apt list`, `dpkg` reads the dpkg status database directly
+        pip_backend: `pip` runs `pip list`, `metadata` reads the dist-info and
+            egg-info metadata of every site-packages directory it finds
+        cache: an `InventoryCache` to keep the package dictionary in between runs
+        batch: collect everything with a single command, see `collect_batch`
+        compact: keep the package dictionary as an `Inventory`, which shares
+            strings with every other system and uses far less memory
+        executor: where the async methods parse command output, so the event
+            loop stays responsive. None parses on the loop as the output
+            arrives, `thread` or `process` use a shared pool, or pass any
+            `concurrent.futures.Executor`, see `offload.get_executor`
+        """
+        from . import offload
         super().__init__(*args, **kwargs)
+        if apt_backend not in ('apt', 'dpkg'):
+            raise ValueError("Unknown apt backend `{apt_backend}`".format(apt_backend=apt_backend))
+        if pip_backend not in ('pip', 'metadata'):
+            raise ValueError("Unknown pip backend `{pip_backend}`".format(pip_backend=pip_backend))
+        self.apt_backend = apt_backend
+        self.pip_backend = pip_backend
+        self.cache = cache
+        self.batch = batch
+        self.compact = compact
+        self.executor = offload.get_executor(executor)
+        self._index = None
+        # The (GlobalIndex, name) the system is published in, searched instead of an index of its own
+        self.shared_index = None
+        # Counts changes to the dictionary, so an index built meanwhile is known to be stale
+        self._dict_version = 0
         self.dict = None
+        # What the last refresh of the dictionary changed
+        self.changes = None
+        # Kept so the history log is only read from where it was left
+        self._apt_history = None
+
+    @property
+    def dict(self):
+        return self._dict
+
+    @dict.setter
+    def dict(self, d):
+        """
+        Replace the package dictionary, the name index of the old one is dropped
+        """
+        if d is not None and d is getattr(self, '_dict', None):
+            return
+        if d is not None and self.compact and not isinstance(d, Inventory):
+            d = Inventory(d.values())
+        self._dict = d
+        self._index = None
+        self._dict_version += 1
+
+    @property
+    def index(self):
+        """
+        The `NameIndex` over the package dictionary, built the first time the system itself is searched
+
+        Systems only ever searched through a `GlobalIndex`, like the web
+        server's, never build one
+        """
+        from .index import NameIndex
+        if self._index is None:
+            self._index = NameIndex(self.dict or ())
+        return self._index
+
+    def share_index(self, index, name):
+        """
+        Search through a `GlobalIndex` that has this system under name, instead of a `NameIndex` of its own
+
+        Saves building the same postings twice, searches then answer with what
+        was last applied to the global index. None goes back to an index of its own
+        """
+        self.shared_index = (index, name) if index is not None else None
+        self._index = None
+
+    async def _async_build_index(self):
+        """
+        With an executor, build the name index in a thread so a large dictionary doesn't hold up the event loop
+        """
+        import asyncio
+        from .index import NameIndex
+        if self._index is not None or self.shared_index is not None or self.executor is None or not self.dict:
+            return
+        version = self._dict_version
+        loop = asyncio.get_event_loop()
+        # The thread only gets a copy of the names, the dictionary may change while it runs
+        index = await loop.run_in_executor(None, NameIndex, list(self.dict))
+        if self._index is None and self._dict_version == version:
+            self._index = index
     
     def clear_search(self):
         self.dict = None
 
-    def _apt_list_helper(self, text):
+    def update_dict(self, d):
+        """
+        Bring the package dictionary up to date with d, touching only the packages that changed
+
+        The dictionary and index are changed in place instead of replaced.
+        Returns the `Changes`, which are also kept as `.changes`
+        """
+        if not d and self.dict:
+            # Every collector failing is more likely than every package being removed
+            self.log.warning("No packages found, keeping the previous ones")
+            self.changes = Changes()
+            return self.changes
+        if self.dict is None:
+            self.changes = diff_inventories({}, d)
+            self.dict = d
+            return self.changes
+        if isinstance(self.dict, Inventory):
+            # The packages removed by the last update were published since, their rows can go
+            self.dict.recycle()
+        changes = diff_inventories(self.dict, d)
+        # Only an index that was already built is kept up to date
+        index = self._index
+        for name in changes.removed:
+            del self.dict[name]
+            if index is not None:
+                index.discard(name)
+        for name, (old, app) in changes.changed.items():
+            self.dict[name] = app
+        for name, app in changes.added.items():
+            self.dict[name] = app
+            if index is not None:
+                index.add(name)
+        if changes:
+            self._dict_version += 1
+        self.changes = changes
+        return changes
+
+    @property
+    def cache_path(self):
+        """
+        The file whose content the package dictionary depends on, used as the cache key
+
+        The local system changes without a single file changing, so it is never cached
+        """
+        return None
+
+    @property
+    def watch_paths(self):
+        """
+        Local files whose changes mean the package dictionary may have changed, see `systeminfo.watch`
+
+        Only the dpkg status database is watched, pip packages are only found
+        by the next full refresh
+        """
+        if self.filesystem is not None:
+            return []
+        path = self.file_path(self.APT_STATUS)
+        return [path] if path is not None else []
+
+    def invalidate(self):
+        """
+        Forget the package dictionary, both in memory and in the cache, so the next query rebuilds it
+        """
+        self.clear_search()
+        if self.cache is not None and self.cache_path is not None:
+            self.cache.invalidate(self.cache_path)
+
+    def _cached_dict(self, long):
+        if self.cache is None or self.cache_path is None:
+            return None
+        try:
+            return self.cache.get(self.cache_path, long=long)
+        except Exception as e:
+            self.log.warning("Error reading cache for `{path}`: `{e}`".format(path=self.cache_path, e=e))
+            return None
+
+    def load_snapshot(self, long=True):
+        """
+        Fill an empty package dictionary with the last one in the cache, without checking if it is current
+
+        Lets a server answer from what it knew before it restarted while
+        `get_dict` finds out what changed. Returns whether there was one
+        """
+        if self.dict is not None or self.cache is None or self.cache_path is None:
+            return False
+        try:
+            d = self.cache.snapshot(self.cache_path, long=long)
+        except Exception as e:
+            self.log.warning("Error reading cache for `{path}`: `{e}`".format(path=self.cache_path, e=e))
+            return False
+        if not d:
+            return False
+        self.update_dict(d)
+        return True
+
+    def _cache_dict(self, d, long):
+        if self.cache is None or self.cache_path is None or not d:
+            # An empty dictionary usually means every collector failed, so try again next time
+            return
+        try:
+            self.cache.put(self.cache_path, d, long=long)
+        except Exception as e:
+            self.log.warning("Error writing cache for `{path}`: `{e}`".format(path=self.cache_path, e=e))
+
+    @classmethod
+    def _apt_list_helper(cls, text):
         """
         parsing logic for apt_list
         This lets us use both the async ans sync versions
@@ -100,37 +532,48 @@ class System(Information):
         # `g++/bionic,now 4:7.3.0-3ubuntu2 amd64 [installed,automatic]`
         # `libcudnn7/unknown 7.2.1.38-1+cuda9.2 amd64 [upgradable from: 7.2.1.38-1+cuda9.0]`
         # I don't think there can be spaced in the version
-        for line in text.split('\n'):
-            if 'Listing...' in line:
-                # We skip this line
-                continue
-            try:
-                vars = line.split()
-                if not vars:
-                    continue
-                container = {}
-
-                name = vars[0].split('/')[0]
-                container['from'] = 'apt'
-                container['name'] = name
-                container['version'] = vars[1]
-
-                if len(vars[2:]) == 1:
-                    container['arch'] = vars[2]
-                else:
-                    container['arch'] = vars[2]
-                    # The state may be multiple words, but it will be the rest
-                    container['state'] = ' '.join(vars[3:])
-
-                    # If we have an installed version, and there is an upgrade available, it will be in the state
-                    if 'upgradable' in container['state']:
-                        _version = re.match(r'\[upgradable from: (.*)\]', container['state']).groups()[0]
-                        container['version'] = _version
-
-                self.log.debug("Apt app: {container}".format(container=container))
+        lines = text.split('\n') if isinstance(text, str) else text
+        for line in lines:
+            container = cls._apt_list_line(line)
+            if container is not None:
                 yield container
-            except Exception as e:
-                self.log.warning("Problem with line: {line}; {e}".format(line=line, e=e))
+
+    @classmethod
+    def _apt_list_line(cls, line):
+        """
+        Parse a single line of `apt list`, returns None for lines that aren't a package
+        """
+        if 'Listing...' in line:
+            # We skip this line
+            return None
+        try:
+            vars = line.split()
+            if not vars:
+                return None
+            container = {}
+
+            name = vars[0].split('/')[0]
+            container['from'] = 'apt'
+            container['name'] = name
+            container['version'] = vars[1]
+
+            if len(vars[2:]) == 1:
+                container['arch'] = vars[2]
+            else:
+                container['arch'] = vars[2]
+                # The state may be multiple words, but it will be the rest
+                container['state'] = ' '.join(vars[3:])
+
+                # If we have an installed version, and there is an upgrade available, it will be in the state
+                if 'upgradable' in container['state']:
+                    _version = re.match(r'\[upgradable from: (.*)\]', container['state']).groups()[0]
+                    container['version'] = _version
+
+            logger.debug("Apt app: {container}".format(container=container))
+            return container
+        except Exception as e:
+            logger.warning("Problem with line: {line}; {e}".format(line=line, e=e))
+            return None
 
     def apt_list(self, apps=None):
         """
@@ -138,14 +581,85 @@ class System(Information):
         apt list shows the cache of packages it knows about
         Each item is a dictionary with a `name`, `version`, `arch`, and `state` if available
         """
-        text = self.get_command_text('apt list {apps}'.format(apps='' if not apps else ' '.join((str(app) for app in apps))), shell=True)
+        from .stream import iter_lines
+        if self.apt_backend == 'dpkg':
+            return self._dpkg_list(apps, available=True)
+        # Lines are parsed as apt prints them
+        chunks = self.iter_command_chunks('apt list {apps}'.format(apps='' if not apps else ' '.join((str(app) for app in apps))), shell=True)
 
-        return self._apt_list_helper(text)
+        return self._apt_list_helper(iter_lines(chunks))
+
+    async def async_apt_list_stream(self, apps=None):
+        """
+        Asynchronously generate the packages of `apt list` as its lines arrive
+        """
+        from .stream import async_iter_lines
+        chunks = self.async_iter_command_chunks('apt list {apps}'.format(apps='' if not apps else ' '.join((str(app) for app in apps))))
+        # Parsing happens between reads, only the parsing is timed
+        stopwatch = metrics.PARSE_DURATION.labels('stream_apt_list').stopwatch()
+        async for line in async_iter_lines(chunks, stopwatch):
+            with stopwatch:
+                container = self._apt_list_line(line)
+            if container is not None:
+                yield container
+        stopwatch.observe()
 
     async def async_apt_list(self, apps=None):
-        text = await self.async_get_command_text('apt list {apps}'.format(apps='' if not apps else ' '.join((str(app) for app in apps))))
+        from . import offload
+        if self.apt_backend == 'dpkg':
+            return await self._async_dpkg_list(apps, available=True)
+        if self.executor is not None:
+            text = await self.async_get_command_text('apt list {apps}'.format(apps='' if not apps else ' '.join((str(app) for app in apps))))
+            return await self._offload(offload.parse_apt_list, type(self), text)
+        return [app async for app in self.async_apt_list_stream(apps)]
 
-        return self._apt_list_helper(text)
+    async def _offload(self, parse, *args):
+        """
+        Run parse in the executor, it returns packed packages that are unpacked here
+        """
+        import asyncio
+        from . import offload
+        loop = asyncio.get_event_loop()
+        # Includes waiting for a free worker, the time inside of a process isn't visible here
+        with metrics.PARSE_DURATION.labels(parse.__name__).time():
+            packed = await loop.run_in_executor(self.executor, parse, *args)
+        # Building the dictionaries is most of the work left, so that is kept off of the loop too
+        return await loop.run_in_executor(None, offload.unpack, packed)
+
+    def _local_executor(self):
+        import concurrent.futures
+        # Local files are read where the system is, processes can't share an open image
+        if isinstance(self.executor, concurrent.futures.ThreadPoolExecutor):
+            return self.executor
+        return None
+
+    def _dpkg_list(self, apps=None, available=False):
+        """
+        Read the dpkg database instead of running `apt list`
+
+        available: also read the apt lists, to know what is upgradable or not installed
+        """
+        apps = list(apps) if apps else None
+        status = self.open_text(self.APT_STATUS)
+        extended_states = self.open_text(self.APT_EXTENDED_STATES, missing_ok=True)
+        lists = self.open_text(*self.APT_AVAILABLE, missing_ok=True) if available else None
+        return dpkg_list(status, extended_states, lists, apps=apps)
+
+    async def _async_dpkg_list(self, apps=None, available=False):
+        import asyncio
+        from . import offload
+        apps = list(apps) if apps else None
+        if self.file_path('/') is not None:
+            # Reading local files is blocking, so parse them off of the event loop
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._local_executor(), lambda: list(self._dpkg_list(apps, available)))
+        status = await self.async_open_text(self.APT_STATUS)
+        extended_states = await self.async_open_text(self.APT_EXTENDED_STATES, missing_ok=True)
+        lists = await self.async_open_text(*self.APT_AVAILABLE, missing_ok=True) if available else None
+        if self.executor is not None:
+            return await self._offload(offload.parse_dpkg, status.getvalue(), extended_states.getvalue(),
+                                       lists.getvalue() if lists is not None else None, apps)
+        return dpkg_list(status, extended_states, lists, apps=apps)
 
     def _check_apt_installed(self, app):
         return True if ('state' in app and any([check in app['state'] for check in ['installed', 'upgradable']])) else False
@@ -153,36 +667,78 @@ class System(Information):
     def apt_installed(self, apps=''):
         """
         Returns a filtered generator of apt applications if the state has 'installed' in it
+
+        The dpkg backend reads the apt lists as well, so local and upgradable
+        packages have the same state `apt list --installed` gives them
         """
+        if self.apt_backend == 'dpkg':
+            return (app for app in self._dpkg_list(apps, available=True) if self._check_apt_installed(app))
         return (app for app in self.apt_list(apps) if self._check_apt_installed(app))
     
     async def async_apt_installed(self, apps=''):
         """
         Returns a filtered generator of apt applications if the state has 'installed' in it
         """
+        if self.apt_backend == 'dpkg':
+            return (app for app in await self._async_dpkg_list(apps, available=True) if self._check_apt_installed(app))
         return (app for app in await self.async_apt_list(apps) if self._check_apt_installed(app))
     
-    def _apt_manually_installed_helper(self, text):
-        # Extract out the commands issued
-        apt_commands = re.findall(r'Commandline: (.*)', text)
-
-        # Filter out things we don't want
-        def filter_func(word):
-            if word.startswith('-'):
-                return False
-            if word in ('apt-get', 'apt', 'upgrade', 'install'):
-                # TODO what if we were upgrading apt?
-                return False
-            if not long and 'cuda' in word:
-                return False
-            return True
-
-        apt_packages = (word for command in apt_commands for word in command.split() if filter_func(word))
+    def _local_apt_history(self):
+        """
+        Bring the `AptHistory` of a system whose files are read directly up to date, and return it
+        """
+        from .history import AptHistory
+        path = self.file_path(self.APT_HISTORY)
+        if self._apt_history is None or self._apt_history.path != path:
+            self._apt_history = AptHistory(path)
+        self._apt_history.update()
+        return self._apt_history
+
+    def _read_apt_history(self):
+        """
+        Read the whole history of a system whose log can only be opened through it, rotated logs aren't read
+        """
+        from .history import AptHistory
+        history = AptHistory(self.APT_HISTORY)
+        history.feed(self.open_text(self.APT_HISTORY, missing_ok=True))
+        return history
+
+    def apt_history(self):
+        """
+        Return the `AptHistory` of the system, for the packages installed by hand
+
+        Local files are read directly and only what was appended since the
+        last call is parsed. Other systems print their logs through a command
+        """
+        from .history import AptHistory
+        if self.filesystem is not None:
+            return self._read_apt_history()
+        if self.file_path('/') is not None:
+            return self._local_apt_history()
+        history = AptHistory(self.APT_HISTORY)
+        history.feed(self.get_command_text(history.command(), shell=True, check=False).splitlines())
+        return history
+
+    async def async_apt_history(self):
+        """
+        Return the `AptHistory` of the system, see `apt_history`
+        """
+        import asyncio
+        from .history import AptHistory
+        if self.file_path('/') is not None:
+            loop = asyncio.get_event_loop()
+            read = self._read_apt_history if self.filesystem is not None else self._local_apt_history
+            return await loop.run_in_executor(self._local_executor(), read)
+        history = AptHistory(self.APT_HISTORY)
+        history.feed((await self.async_get_command_text(history.command(), check=False)).splitlines())
+        return history
+
+    def _apt_manually_installed_helper(self, history, long):
+        """
+        Return the names of the packages installed by hand, without the cuda ones unless long
+        """
+        apt_packages = [name for name in history.manual if long or 'cuda' not in name]
         self.log.debug("Manual apt packages: `{apt_packages}`".format(apt_packages=apt_packages))
-        
-        # Remove any pinned parts of the packages; we get the information independent of the pin
-        apt_packages = (word[:word.find('=')] if '=' in word else word for word in apt_packages)
-        # Loop up the package info
         return apt_packages
 
     def apt_manually_installed(self, long=True):
@@ -191,9 +747,11 @@ class System(Information):
 
         long will add cuda packages from the list
         """
-        text = self.get_command_text("cat /var/log/apt/history.log", shell=True)
-        
-        return self.apt_installed(self._apt_manually_installed_helper(text))
+        apt_packages = self._apt_manually_installed_helper(self.apt_history(), long)
+        if not apt_packages:
+            # `apt list` without names would list everything
+            return iter(())
+        return self.apt_installed(apt_packages)
     
     async def async_apt_manually_installed(self, long=True):
         """
@@ -201,26 +759,165 @@ class System(Information):
 
         long will add cuda packages from the list
         """
-        text = await self.async_get_command_text("cat /var/log/apt/history.log", shell=True)
-        
-        return self.async_apt_installed(self._apt_manually_installed_helper(text))
+        apt_packages = self._apt_manually_installed_helper(await self.async_apt_history(), long)
+        if not apt_packages:
+            return iter(())
+        return await self.async_apt_installed(apt_packages)
     
+    def _local_requires(self, path):
+        requires = os.path.join(os.path.dirname(path), 'requires.txt')
+        if path.endswith('PKG-INFO') and self._isfile(requires):
+            with self._open_file(requires) as f:
+                yield from metadata.requires_txt(f)
+
+    def _realpath(self, path):
+        if self.filesystem is not None:
+            return self.filesystem.realpath(path)
+        real = os.path.realpath(self.file_path(path))
+        if self.root is None:
+            return real
+        root = os.path.realpath(self.root)
+        if not real.startswith(root + os.sep):
+            # An absolute symlink that was resolved outside of the root
+            return path
+        return '/' + os.path.relpath(real, root)
+
+    def _pip_interpreter(self):
+        """
+        Return the path of the python `pip` runs under with its symlinks resolved, or None if it can't be told
+        """
+        import shutil
+        if self.root is None and self.filesystem is None:
+            script = shutil.which('pip')
+        else:
+            script = next((path for path in self.PIP_SCRIPTS if self._isfile(self.file_path(path))), None)
+        if script is None:
+            return None
+        with self._open_file(self.file_path(script)) as f:
+            interpreter = metadata.shebang_interpreter(f.readline())
+        if interpreter is None:
+            # pyenv's shims are shell scripts running the python its version file names
+            directory = os.path.dirname(script)
+            version = os.path.join(os.path.dirname(directory), 'version')
+            if os.path.basename(directory) != 'shims' or not self._isfile(self.file_path(version)):
+                return None
+            with self._open_file(self.file_path(version)) as f:
+                interpreter = os.path.join(os.path.dirname(directory), 'versions', f.readline().strip(), 'bin', 'python')
+        elif '/' not in interpreter:
+            # `#!/usr/bin/env python3` runs the first one on the PATH
+            interpreter = next((os.path.join(directory, interpreter) for directory in metadata.PATH
+                                if self._isfile(self.file_path(os.path.join(directory, interpreter)))), None)
+        if interpreter is None or not self._isfile(self.file_path(interpreter)):
+            return None
+        return self._realpath(interpreter)
+
+    def _local_distributions(self):
+        """
+        Generate (headers, requires) for every package in the site-packages directories of the python pip runs under
+        """
+        sites = [site for pattern in self.PIP_SITE_PACKAGES for site in self._glob(self.file_path(pattern))]
+        interpreter = self._pip_interpreter()
+        if interpreter is not None:
+            interpreter = self.file_path(interpreter)
+        for site in metadata.select_sites(sites, interpreter):
+            for file_pattern in metadata.METADATA_FILES:
+                for path in self._glob(os.path.join(site, file_pattern)):
+                    if not self._isfile(path):
+                        continue
+                    with self._open_file(path) as f:
+                        headers = metadata.read_headers(f)
+                    yield headers, self._local_requires(path)
+
+    def _metadata_command(self):
+        """
+        Shell command that prints the metadata headers of every package, for systems we can't read directly
+        """
+        import shlex
+        files = ' '.join(os.path.join(site, file) for site in self.PIP_SITE_PACKAGES for file in metadata.METADATA_FILES)
+        # First the python pip runs under, like `_pip_interpreter`
+        script = ('p=$(command -v pip) && set -- $(head -n 1 "$p" | sed "s/^#! *//") && '
+                  'case "$1" in */env) i=$(command -v "$2");; *python*) i=$1;; '
+                  '*) r=$(dirname "$(dirname "$p")"); i="$r/versions/$(head -n 1 "$r/version" 2>/dev/null)/bin/python";; esac && '
+                  '[ -f "$i" ] && echo "{marker}python $(readlink -f "$i")"; '
+                  'for m in {files}; do [ -f "$m" ] || continue; '
+                  'echo "{marker}$m"; sed "/^$/q" "$m"; echo; '
+                  'r="$(dirname "$m")/requires.txt"; '
+                  'case "$m" in */PKG-INFO) [ -f "$r" ] && echo "{marker}$r" && cat "$r";; esac; '
+                  'done').format(files=files, marker=self._METADATA_MARKER)
+        return 'sh -c {script}'.format(script=shlex.quote(script))
+
+    @classmethod
+    def _command_distributions(cls, text):
+        """
+        Split the output of `_metadata_command` back into (headers, requires)
+        """
+        dists = []
+        interpreter = None
+        for block in text.split(cls._METADATA_MARKER)[1:]:
+            path, _, body = block.partition('\n')
+            if path.startswith('python '):
+                interpreter = path[len('python '):]
+                continue
+            if path.endswith('requires.txt'):
+                if dists:
+                    dists[-1][2].extend(metadata.requires_txt(body.splitlines()))
+                continue
+            dists.append((metadata.site_of(path), metadata.read_headers(body.splitlines()), []))
+        sites = {site: rank for rank, site in enumerate(metadata.select_sites(dict.fromkeys(site for site, _, _ in dists), interpreter))}
+        return [(headers, requires) for site, headers, requires in sorted(dists, key=lambda dist: sites.get(dist[0], -1)) if site in sites]
+
+    def _metadata_pip_list(self, long=True):
+        if self.file_path('/') is not None:
+            return metadata.pip_list(self._local_distributions(), long=long)
+        text = self.get_command_text(self._metadata_command(), shell=True, check=False)
+        return metadata.pip_list(self._command_distributions(text), long=long)
+
+    async def _async_metadata_pip_list(self, long=True):
+        import asyncio
+        from . import offload
+        if self.file_path('/') is not None:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._local_executor(), lambda: metadata.pip_list(self._local_distributions(), long=long))
+        text = await self.async_get_command_text(self._metadata_command(), check=False)
+        if self.executor is not None:
+            return await self._offload(offload.parse_metadata, type(self), text, long)
+        return metadata.pip_list(self._command_distributions(text), long=long)
+
     def pip_list(self, long=True):
+        from .stream import iter_json_array
+        if self.pip_backend == 'metadata':
+            lst = self._metadata_pip_list(long=long)
+            for app in lst:
+                app['from'] = 'pip'
+            return lst
         if long:
             cmd = 'pip list --format json'
         else:
             cmd = 'pip list --format json --not-required'
-        lst = json.loads(self.get_command_text(cmd, shell=True))
+        # Packages are decoded one at a time as pip prints them
+        lst = list(iter_json_array(self.iter_command_chunks(cmd, shell=True)))
         for app in lst:
             app['from'] = 'pip'
         return lst
     
     async def async_pip_list(self, long=True):
+        from . import offload
+        from .stream import async_iter_json_array
+        if self.pip_backend == 'metadata':
+            lst = await self._async_metadata_pip_list(long=long)
+            for app in lst:
+                app['from'] = 'pip'
+            return lst
         if long:
             cmd = 'pip list --format json'
         else:
             cmd = 'pip list --format json --not-required'
-        lst = json.loads(await self.async_get_command_text(cmd))
+        if self.executor is not None:
+            lst = await self._offload(offload.parse_pip_json, await self.async_get_command_text(cmd))
+        else:
+            stopwatch = metrics.PARSE_DURATION.labels('stream_pip_json').stopwatch()
+            lst = [app async for app in async_iter_json_array(self.async_iter_command_chunks(cmd), stopwatch)]
+            stopwatch.observe()
         for app in lst:
             app['from'] = 'pip'
         return lst
@@ -228,27 +925,203 @@ class System(Information):
     def get_multiple(self, iters):
         return (app for iter in iters for app in iter)
     
-    def get_all_installed(self, long=True):
+    def _collector_kwargs(self, arguments, long):
+        return {name: value for name, value in (('long', long),) if name in arguments}
+
+    def _collect(self, name, arguments, long):
+        # Consume generators here so errors while reading are isolated to this collector too
+        with metrics.COLLECT_DURATION.labels(name).time():
+            return list(getattr(self, name)(**self._collector_kwargs(arguments, long)))
+
+    async def _async_collect(self, name, arguments, long):
+        with metrics.COLLECT_DURATION.labels(name).time():
+            return list(await getattr(self, 'async_' + name)(**self._collector_kwargs(arguments, long)))
+
+    def _batch_command(self, commands):
+        """
+        Build one shell command that runs every command and frames their output
+
+        commands: dictionary of section names to shell commands
+        """
+        import shlex
+        script = ''.join(
+            'echo "{marker}begin {name}"; {{ {command}; }} 2>/dev/null; s=$?; echo; echo "{marker}end {name} $s"; '.format(
+                marker=self._BATCH_MARKER, name=name, command=command)
+            for name, command in commands.items())
+        return 'sh -c {script}'.format(script=shlex.quote(script))
+
+    def _batch_split(self, text):
+        """
+        Split the output of a batched command back into a dictionary of section names to (exit status, text)
+        """
+        sections = {}
+        name = None
+        lines = []
+        for line in text.split('\n'):
+            if line.startswith(self._BATCH_MARKER):
+                marker = line[len(self._BATCH_MARKER):].split()
+                if marker[0] == 'begin':
+                    name, lines = marker[1], []
+                elif marker[0] == 'end' and name == marker[1]:
+                    # Drop the blank line that ends every section
+                    sections[name] = (int(marker[2]), '\n'.join(lines[:-1]))
+                    name = None
+                continue
+            if name is not None:
+                lines.append(line)
+        return sections
+
+    def _batch_apt_installed(self, long):
+        """
+        Batched version of `apt_installed`, returns the commands it needs and a function that parses their output
+        """
+        if self.apt_backend == 'dpkg':
+            commands = {
+                'dpkg_status': 'cat {path}'.format(path=self.APT_STATUS),
+                'apt_extended_states': 'cat {path} || true'.format(path=self.APT_EXTENDED_STATES),
+                'apt_lists': self._cat_command(self.APT_AVAILABLE, missing_ok=True) + ' || true',
+            }
+            def parse(texts):
+                apps = dpkg_list(io.StringIO(texts['dpkg_status']), io.StringIO(texts['apt_extended_states']),
+                                 io.StringIO(texts['apt_lists']))
+                return [app for app in apps if self._check_apt_installed(app)]
+        else:
+            commands = {'apt': 'apt list'}
+            def parse(texts):
+                return [app for app in self._apt_list_helper(texts['apt']) if self._check_apt_installed(app)]
+        return commands, parse
+
+    def _batch_pip_list(self, long):
+        """
+        Batched version of `pip_list`, returns the commands it needs and a function that parses their output
+        """
+        if self.pip_backend == 'metadata':
+            commands = {'pip_metadata': self._metadata_command() + ' || true'}
+            def parse(texts):
+                lst = metadata.pip_list(self._command_distributions(texts['pip_metadata']), long=long)
+                for app in lst:
+                    app['from'] = 'pip'
+                return lst
+        else:
+            commands = {'pip': 'pip list --format json' + ('' if long else ' --not-required')}
+            def parse(texts):
+                lst = json.loads(texts['pip'])
+                for app in lst:
+                    app['from'] = 'pip'
+                return lst
+        return commands, parse
+
+    def _batch_parse(self, name, sections, commands, parse):
+        for section in commands:
+            if section not in sections:
+                raise Exception("Batched output is missing `{section}`".format(section=section))
+            if sections[section][0] != 0:
+                raise Exception("Error running `{command}`; exit status {status}".format(command=commands[section], status=sections[section][0]))
+        with metrics.PARSE_DURATION.labels('batch_' + name).time():
+            return parse({section: sections[section][1] for section in commands})
+
+    def _batch_plan(self, long):
+        """
+        Split the collectors into the ones that support batching, with their commands and parsers, and the rest
+        """
+        batched = []
+        rest = []
+        for name, arguments in self.collectors:
+            if hasattr(self, '_batch_' + name):
+                commands, parse = getattr(self, '_batch_' + name)(long)
+                batched.append((name, commands, parse))
+            else:
+                rest.append((name, arguments))
+        return batched, rest
+
+    def collect_batch(self, long=True):
+        """
+        Run every batchable collector with a single command and demultiplex the output
+
+        Containers only have to be started once instead of once per collector.
+        Collectors without a `_batch_` method are run normally afterwards.
+        Returns a list with the packages of each collector that worked
+        """
+        batched, rest = self._batch_plan(long)
+        commands = {section: command for _, sections, _ in batched for section, command in sections.items()}
+        sections = self._batch_split(self.get_command_text(self._batch_command(commands), shell=True, check=False))
         m = []
-        for func, kwargs in ((self.apt_installed, {}), (self.pip_list, {'long':long})):
+        for name, collector_commands, parse in batched:
             try:
-                m.append(func(**kwargs))
+                m.append(self._batch_parse(name, sections, collector_commands, parse))
             except Exception as e:
-                self.log.warning("Error getting from `{func}`: `{e}`".format(func=func, e=e))
-                continue
+                self.log.warning("Error getting from `{func}`: `{e}`".format(func=name, e=e))
+        for name, arguments in rest:
+            try:
+                m.append(self._collect(name, arguments, long))
+            except Exception as e:
+                self.log.warning("Error getting from `{func}`: `{e}`".format(func=name, e=e))
+        return m
+
+    async def async_collect_batch(self, long=True):
+        """
+        Run every batchable collector with a single command and demultiplex the output
+        """
+        batched, rest = self._batch_plan(long)
+        commands = {section: command for _, sections, _ in batched for section, command in sections.items()}
+        sections = self._batch_split(await self.async_get_command_text(self._batch_command(commands), check=False))
+        m = []
+        for name, collector_commands, parse in batched:
+            try:
+                m.append(self._batch_parse(name, sections, collector_commands, parse))
+            except Exception as e:
+                self.log.warning("Error getting from `{coroutine}`: `{e}`".format(coroutine=name, e=e))
+        for name, arguments in rest:
+            try:
+                m.append(await self._async_collect(name, arguments, long))
+            except Exception as e:
+                self.log.warning("Error getting from `{coroutine}`: `{e}`".format(coroutine='async_' + name, e=e))
+        return m
+
+    def get_all_installed(self, long=True):
+        """
+        Run every collector at the same time in threads and chain their packages together
+
+        A collector that fails is logged and skipped
+        """
+        import concurrent.futures
+        if self.batch:
+            return self.get_multiple(self.collect_batch(long=long))
+        m = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.collectors)) as executor:
+            futures = [(name, executor.submit(self._collect, name, arguments, long)) for name, arguments in self.collectors]
+            for name, future in futures:
+                try:
+                    m.append(future.result())
+                except Exception as e:
+                    self.log.warning("Error getting from `{func}`: `{e}`".format(func=name, e=e))
+                    continue
         return self.get_multiple(m)
     
     async def async_get_all_installed(self, long=True):
+        """
+        Run every collector concurrently and chain their packages together
+
+        A collector that fails is logged and skipped
+        """
+        import asyncio
+        if self.batch:
+            return self.get_multiple(await self.async_collect_batch(long=long))
         m = []
-        for coroutine in (self.async_apt_installed(), self.async_pip_list(long=long)):
-            try:
-                m.append(await coroutine)
-            except Exception as e:
-                self.log.warning("Error getting from `{coroutine}`: `{e}`".format(coroutine=coroutine, e=e))
+        results = await asyncio.gather(*[self._async_collect(name, arguments, long) for name, arguments in self.collectors],
+                                       return_exceptions=True)
+        for (name, _), result in zip(self.collectors, results):
+            if isinstance(result, Exception):
+                self.log.warning("Error getting from `{coroutine}`: `{e}`".format(coroutine='async_' + name, e=result))
                 continue
+            m.append(result)
         return self.get_multiple(m)
     
     def get_dict(self, long=True):
+        d = self._cached_dict(long)
+        if d is not None:
+            self.update_dict(d)
+            return self.dict
         d = {}
         for app in self.get_all_installed(long=long):
             name = app['name']
@@ -257,10 +1130,19 @@ class System(Information):
                 self.log.warning("Multiple packages found with the same name. Using first: `{dapp}`;`{app}`".format(dapp=d[app['name']], app=app))
                 continue
             d[name] = app
-        self.dict = d
-        return d
+        self._cache_dict(d, long)
+        self.update_dict(d)
+        return self.dict
     
     async def async_get_dict(self, long=True):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        # The cache reads the database and maybe the image, and (de)serializes the inventory
+        cached = self.cache is not None and self.cache_path is not None
+        d = await loop.run_in_executor(None, self._cached_dict, long) if cached else None
+        if d is not None:
+            self.update_dict(d)
+            return self.dict
         d = {}
         for app in await self.async_get_all_installed(long=long):
             name = app['name']
@@ -269,10 +1151,20 @@ class System(Information):
                 self.log.warning("Multiple packages found with the same name. Using first: `{dapp}`;`{app}`;".format(dapp=d[app['name']], app=app))
                 continue
             d[name] = app
-        self.dict = d  # We set it so we can use it later
-        return d
+        if cached:
+            await loop.run_in_executor(None, self._cache_dict, d, long)
+        self.update_dict(d)  # We set it so we can use it later
+        return self.dict
     
     def _search_helper(self, search_term, dict, version='', match=False):
+        if dict is self.dict and self.shared_index is not None:
+            index, name = self.shared_index
+            return index.find(search_term, version=version, match=match).get(name, [])
+        if dict is self.dict:
+            # Our own dictionary is indexed, so only look at the names that can match
+            apps = (dict[name] for name in self.index.find(search_term, match=match))
+            # Compact inventories hand out views, results are always real dictionaries
+            return [app.to_dict() if isinstance(app, PackageRow) else app for app in apps if version in app['version']]
         filter = lambda name: (search_term == name) if match else (search_term in name)
         lst = [app for name, app in dict.items() if filter(name) and version in app['version']]
         lst.sort(key=lambda app: len(app['name']))  # TODO Shortest match is probably what we want, right?
@@ -287,7 +1179,7 @@ class System(Information):
         """
         if not dict:
             if not self.dict:
-                self.dict = self.get_dict()
+                self.get_dict()
             dict = self.dict
         lst = self._search_helper(search_term, dict=dict, version=version, match=match)
         return lst
@@ -301,22 +1193,111 @@ class System(Information):
         """
         if not dict:
             if not self.dict:
-                self.dict = await self.async_get_dict()
+                await self.async_get_dict()
             dict = self.dict
+            await self._async_build_index()
         lst = self._search_helper(search_term, dict=dict, version=version, match=match)
         return lst
 
+    def _query_helper(self, node):
+        from . import query
+        if isinstance(node, str):
+            node = query.parse(node)
+        if self.shared_index is not None:
+            return query.run(node, query.SharedSource(*self.shared_index)).get('')
+        return query.run(node, query.SystemSource(self)).get('')
+
+    def query(self, node):
+        """
+        Run a query, see `systeminfo.query` for the syntax
+
+        node: a query string or an already parsed query
+        Returns a dictionary of the matching package names to their
+        information, or None if the system doesn't match the query. Terms are
+        checked most selective first, and the first one that fails stops it
+        """
+        if not self.dict:
+            self.get_dict()
+        return self._query_helper(node)
+
+    async def async_query(self, node):
+        """
+        Run a query, see `query`
+        """
+        if not self.dict:
+            await self.async_get_dict()
+        await self._async_build_index()
+        return self._query_helper(node)
+
 
 class Singularity(System):
     """
     Get information from within a singularity container
     """
-    def __init__(self, image, singularity='singularity', *args, **kwargs):
+    def __init__(self, image, singularity='singularity', *args, inspect=False, **kwargs):
         """
         image: string of the absolute location of the image
         singularity: string of what binary should be used
+        inspect: read the packages straight out of the image's squashfs
+            instead of executing it, which needs neither singularity nor
+            privileges. Defaults to the `dpkg` and `metadata` backends, since
+            nothing can be run
         """
+        if inspect:
+            kwargs.setdefault('apt_backend', 'dpkg')
+            kwargs.setdefault('pip_backend', 'metadata')
+        self.inspect = inspect
         super().__init__(*args, **kwargs)
         self.image = image
         self.pre_command = '{singularity} exec {image} '.format(singularity=singularity, image=image)
         self.stderr_into_stdout = False
+        if inspect and (self.apt_backend != 'dpkg' or self.pip_backend != 'metadata' or self.batch):
+            raise ValueError("Inspecting an image only works with the `dpkg` and `metadata` backends, without batch")
+
+    @property
+    def filesystem(self):
+        from .squashfs import SquashFS
+        # Opened on first use, so discovering many images doesn't hold a file open for each
+        if self._filesystem is None and self.inspect:
+            self._filesystem = SquashFS(self.image)
+        return self._filesystem
+
+    @filesystem.setter
+    def filesystem(self, filesystem):
+        self._filesystem = filesystem
+
+    def close(self):
+        """
+        Close the image, it is opened again the next time it is read, in case it was replaced
+        """
+        if self.inspect and self._filesystem is not None:
+            self._filesystem.close()
+            self._filesystem = None
+
+    def invalidate(self):
+        """
+        Forget the package dictionary, and reopen the image next time in case it was replaced
+        """
+        super().invalidate()
+        self.close()
+
+    def get_dict(self, long=True):
+        # An inspected image is only open while it is collected, not for as long as the server runs
+        try:
+            return super().get_dict(long=long)
+        finally:
+            self.close()
+
+    async def async_get_dict(self, long=True):
+        try:
+            return await super().async_get_dict(long=long)
+        finally:
+            self.close()
+
+    @property
+    def cache_path(self):
+        return self.image
+
+    @property
+    def watch_paths(self):
+        return [self.image]
@@ -0,0 +1,451 @@
+"""
+A `GlobalIndex` written to a file once, and searched from a memory map by any number of processes
+
+`write` serializes the packages of every system, their names and trigram
+index into one immutable file. `MappedIndex` maps it and answers queries
+like a `GlobalIndex` does, reading straight out of the map: processes that
+map the same file share the same pages, and nothing but the strings a query
+looks at is ever copied out of it. A new generation is written next to the
+old one and renamed over it, so readers either see the old file or the new
+one, never a half written one.
+
+The file is a header, a table of (offset, length) of every section and the
+sections, each an array of native 32 or 64 bit integers:
+
+    strings             offset of every string in the blob, and one past the last
+    blob                every string, in UTF-8
+    systems             string of every system name
+    names               string of every package name, in index order
+    sorted              positions in names, sorted by name
+    entry offsets       first entry of every name, and one past the last
+    entries             (system, position in its dictionary, app) of every package
+    apps                layout followed by a value per key, of every distinct app
+    layout offsets      first key of every layout, and one past the last
+    layout keys         string of every key
+    grams               string of every trigram, sorted
+    gram offsets        first posting of every trigram, and one past the last
+    postings            positions in names containing each trigram
+    meta                JSON, whatever the writer wanted to pass along
+"""
+import array
+import bisect
+import collections.abc
+import contextlib
+import json
+import mmap
+import os
+import struct
+from . import query
+from .index import trigrams
+from .store import PackageRow
+
+MAGIC = b'SYSINDEX'
+VERSION = 1
+# Written in native byte order, a file from a machine with the other order is refused
+BYTE_ORDER = 0x01020304
+HEADER = struct.Struct('=8sIIIQ')  # Magic, version, byte order, section count, generation
+SECTION = struct.Struct('=QQ')  # Offset, length
+SECTIONS = 14
+ALIGN = 8
+
+# Values that aren't strings are stored as their JSON, with this bit set on the string
+JSON_VALUE = 0x80000000
+NONE_VALUE = 0xFFFFFFFF
+# Decoded strings and apps kept per mapped index, before the cache starts over
+STRING_CACHE = 1 << 18
+APP_CACHE = 1 << 16
+
+
+class MappedIndexError(ValueError):
+    pass
+
+
+def freeze(index):
+    """
+    Copy what `write` needs out of a `GlobalIndex`
+
+    Only the lists are copied, not the apps, so this is quick enough to do on
+    the event loop. `write` can then take its time in another thread while
+    the index keeps changing. An app of a compact inventory whose row is
+    recycled meanwhile is left out, the next generation is written again anyway.
+
+    Returns the system names and a list of (package name, entries) in index order
+    """
+    order = index.names.order
+    names = sorted(order, key=order.__getitem__)
+    return list(index.system_names()), [(name, tuple(index.entries(name))) for name in names]
+
+
+def write(path, systems, packages, generation=0, meta=None):
+    """
+    Write an index to path, replacing whatever was there at once
+
+    systems: system names, in the order results are returned
+    packages: list of (package name, entries) in index order, entries are
+        the (system name, position, app) of every system with that package,
+        like `freeze` returns
+    meta: anything JSON can encode, it is read back as `MappedIndex.meta`
+    """
+    strings = {}
+
+    def intern(string):
+        i = strings.get(string)
+        if i is None:
+            i = strings[string] = len(strings)
+        return i
+
+    def encode(value):
+        if value is None:
+            return NONE_VALUE
+        if isinstance(value, str):
+            return intern(value)
+        return intern(json.dumps(value)) | JSON_VALUE
+
+    system_ids = {system_name: i for i, system_name in enumerate(systems)}
+    system_strings = array.array('I', (intern(system_name) for system_name in systems))
+    names = array.array('I')
+    entry_offsets = array.array('I', [0])
+    entries = array.array('I')
+    apps = array.array('I')
+    app_offsets = {}  # (layout, values...) to its offset in apps, images share most of their apps
+    layouts = {}  # Keys to the layout number
+    for name, found in packages:
+        names.append(intern(name))
+        for system_name, position, app in found:
+            if isinstance(app, PackageRow):
+                app = _copy(app)
+                if app is None:
+                    continue
+            keys = tuple(app)
+            layout = layouts.get(keys)
+            if layout is None:
+                layout = layouts[keys] = len(layouts)
+            record = (layout,) + tuple(encode(app[key]) for key in keys)
+            offset = app_offsets.get(record)
+            if offset is None:
+                offset = app_offsets[record] = len(apps)
+                apps.extend(record)
+            entries.extend((system_ids[system_name], position, offset))
+        entry_offsets.append(len(entries) // 3)
+    del app_offsets
+
+    layout_offsets = array.array('I', [0])
+    layout_keys = array.array('I')
+    for keys in layouts:
+        layout_keys.extend(intern(key) for key in keys)
+        layout_offsets.append(len(layout_keys))
+
+    names_list = [name for name, _ in packages]
+    by_name = array.array('I', sorted(range(len(names_list)), key=names_list.__getitem__))
+    grams = {}
+    for i, name in enumerate(names_list):
+        for gram in trigrams(name):
+            grams.setdefault(gram, []).append(i)
+    gram_strings = array.array('I')
+    gram_offsets = array.array('I', [0])
+    postings = array.array('I')
+    for gram in sorted(grams):
+        gram_strings.append(intern(gram))
+        postings.extend(grams[gram])
+        gram_offsets.append(len(postings))
+    del grams
+
+    blob = bytearray()
+    string_offsets = array.array('Q', [0])
+    for string in strings:
+        blob += string.encode('utf-8', 'surrogateescape')
+        string_offsets.append(len(blob))
+    del strings
+
+    sections = [string_offsets, blob, system_strings, names, by_name, entry_offsets, entries, apps,
+                layout_offsets, layout_keys, gram_strings, gram_offsets, postings,
+                json.dumps(meta if meta is not None else {}).encode('utf-8')]
+    table = []
+    position = _aligned(HEADER.size + SECTION.size * len(sections))
+    for section in sections:
+        length = len(section) * (section.itemsize if isinstance(section, array.array) else 1)
+        table.append((position, length))
+        position = _aligned(position + length)
+
+    directory, filename = os.path.split(os.path.abspath(path))
+    temporary = os.path.join(directory, '.{filename}.{pid}.tmp'.format(filename=filename, pid=os.getpid()))
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER, len(sections), generation))
+            for offset, length in table:
+                f.write(SECTION.pack(offset, length))
+            for section, (offset, length) in zip(sections, table):
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(section)
+        # Readers that already mapped the old file keep it until they let go
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def _aligned(position):
+    return (position + ALIGN - 1) // ALIGN * ALIGN
+
+
+class _Strings(collections.abc.Sequence):
+    """
+    The strings of an array of string numbers, like the sorted names a bisect looks through
+    """
+    def __init__(self, index, numbers, order=None):
+        self.index = index
+        self.numbers = numbers
+        self.order = order
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, i):
+        if self.order is not None:
+            i = self.order[i]
+        return self.index.string(self.numbers[i])
+
+
+class MappedNames:
+    """
+    The `NameIndex` of a `MappedIndex`, everything a query needs from one
+    """
+    def __init__(self, index):
+        self.index = index
+        self.names = _Strings(index, index.name_strings)
+        self.sorted = _Strings(index, index.name_strings, index.sorted)
+        self.grams = _Strings(index, index.grams)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self.position(name) is not None
+
+    def position(self, name):
+        """
+        The position of a name in index order, or None if no system has it
+        """
+        i = bisect.bisect_left(self.sorted, name)
+        if i < len(self.sorted) and self.sorted[i] == name:
+            return self.index.sorted[i]
+        return None
+
+    def candidates(self, term):
+        """
+        Return the positions of the names that could contain term
+        """
+        grams = trigrams(term)
+        if not grams:
+            return range(len(self.names))
+        postings = []
+        offsets = self.index.gram_offsets
+        for gram in grams:
+            i = bisect.bisect_left(self.grams, gram)
+            if i == len(self.grams) or self.grams[i] != gram:
+                return set()
+            postings.append(self.index.postings[offsets[i]:offsets[i + 1]])
+        postings.sort(key=len)
+        return set(postings[0].tolist()).intersection(*(posting.tolist() for posting in postings[1:]))
+
+    def find(self, term, match=False):
+        """
+        Return the names that contain term, or equal it if match is true, shortest first
+        """
+        if match:
+            return [term] if term in self else []
+        found = [(len(name), i, name) for i, name in ((i, self.names[i]) for i in self.candidates(term)) if term in name]
+        found.sort()
+        return [name for _, _, name in found]
+
+
+class MappedIndex:
+    """
+    An index written by `write`, searched straight out of a memory map
+
+    Answers `query` and `iter_query` like the `GlobalIndex` it was written
+    from, and has the same `names`, `count`, `entries` and `system_names` a
+    query uses. The map is released when the index is closed, or once it is
+    retired and the last search `using` it is done.
+
+    generation: the generation it was written with
+    meta: what it was written with
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        self.users = 0  # Searches between `using` and their end
+        self.retired = False
+        try:
+            self._open()
+        except Exception:
+            self.close()
+            raise
+        self.names = MappedNames(self)
+
+    def _open(self):
+        view = memoryview(self.mmap)
+        self.views = [view]
+        if len(view) < HEADER.size:
+            raise MappedIndexError("`{path}` is too short to be an index".format(path=self.path))
+        magic, version, byte_order, count, self.generation = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise MappedIndexError("`{path}` isn't an index".format(path=self.path))
+        if version != VERSION or byte_order != BYTE_ORDER or count != SECTIONS:
+            raise MappedIndexError("`{path}` is an index this version can't read".format(path=self.path))
+        sections = []
+        for i in range(count):
+            offset, length = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+            if offset + length > len(view):
+                raise MappedIndexError("`{path}` is cut short".format(path=self.path))
+            section = view[offset:offset + length]
+            self.views.append(section)
+            if i == 0:
+                section = section.cast('Q')
+            elif i not in (1, SECTIONS - 1):
+                section = section.cast('I')
+            self.views.append(section)
+            sections.append(section)
+        (self.string_offsets, self.blob, systems, self.name_strings, self.sorted, self.entry_offsets, self.entry_array,
+         self.apps, layout_offsets, layout_keys, self.grams, self.gram_offsets, self.postings, meta) = sections
+        self._decoded = {}
+        self._apps = {}
+        # Both are small and used by every query, so they are decoded once
+        self.systems = [self.string(i) for i in systems]
+        self.layouts = [tuple(self.string(key) for key in layout_keys[layout_offsets[i]:layout_offsets[i + 1]])
+                        for i in range(len(layout_offsets) - 1)]
+        self.meta = json.loads(bytes(meta).decode('utf-8'))
+
+    def string(self, i):
+        """
+        The string numbered i
+        """
+        string = self._decoded.get(i)
+        if string is None:
+            if len(self._decoded) >= STRING_CACHE:
+                self._decoded.clear()
+            string = self._decoded[i] = str(self.blob[self.string_offsets[i]:self.string_offsets[i + 1]], 'utf-8', 'surrogateescape')
+        return string
+
+    def value(self, number):
+        """
+        The value of an app's key
+        """
+        if number == NONE_VALUE:
+            return None
+        if number & JSON_VALUE:
+            return json.loads(self.string(number & ~JSON_VALUE))
+        return self.string(number)
+
+    def app(self, offset):
+        """
+        The dictionary of the app at offset in apps
+
+        Images share most of their apps, so a query that matches a package in
+        many images decodes it once. Like the apps of a `GlobalIndex`, the
+        dictionaries are shared and mustn't be changed
+        """
+        app = self._apps.get(offset)
+        if app is None:
+            if len(self._apps) >= APP_CACHE:
+                self._apps.clear()
+            keys = self.layouts[self.apps[offset]]
+            values = self.apps[offset + 1:offset + 1 + len(keys)].tolist()
+            app = self._apps[offset] = {key: self.value(value) for key, value in zip(keys, values)}
+        return app
+
+    def count(self, name):
+        """
+        How many systems have a package called name
+        """
+        i = self.names.position(name)
+        if i is None:
+            return 0
+        return self.entry_offsets[i + 1] - self.entry_offsets[i]
+
+    def entries(self, name):
+        """
+        The (system name, position, app) of every system with a package called name
+        """
+        i = self.names.position(name)
+        if i is None:
+            return
+        entries = self.entry_array[3 * self.entry_offsets[i]:3 * self.entry_offsets[i + 1]].tolist()
+        for j in range(0, len(entries), 3):
+            yield self.systems[entries[j]], entries[j + 1], self.app(entries[j + 2])
+
+    def system_names(self):
+        return self.systems
+
+    def query(self, node):
+        """
+        Run a parsed `query` against every system, like `GlobalIndex.query`
+        """
+        return query.run(node, self)
+
+    def iter_query(self, node):
+        """
+        Run a parsed `query` like `query`, but generate the (system name, packages) one system at a time
+        """
+        return query.iter_run(node, self)
+
+    @contextlib.contextmanager
+    def using(self):
+        """
+        Keep the map open while the block runs, even if the index is retired meanwhile
+        """
+        self.users += 1
+        try:
+            yield self
+        finally:
+            self.users -= 1
+            if self.retired and not self.users:
+                self.close()
+
+    def retire(self):
+        """
+        Close the map now, or once the last search using it is done
+        """
+        self.retired = True
+        if not self.users:
+            self.close()
+
+    def close(self):
+        """
+        Release the map, nothing read from it can be used afterwards
+        """
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def using(index):
+    """
+    `MappedIndex.using`, or nothing for an index that isn't mapped
+    """
+    return index.using() if isinstance(index, MappedIndex) else contextlib.nullcontext()
+
+
+def _copy(app):
+    """
+    Copy a `PackageRow` that may be recycled in another thread, None if it was
+    """
+    try:
+        copy = app.to_dict()
+    except KeyError:
+        return None
+    # Rows are recycled before they are cleared, a row still valid after the copy was whole during it
+    return copy if app.valid else None
@@ -0,0 +1,256 @@
+import posixpath
+import re
+
+# Where python packages are installed, relative to the root of the system
+# Ordered roughly like sys.path, so user and virtualenv packages shadow the system ones
+SITE_PACKAGES = (
+    '/root/.local/lib/python*/site-packages',
+    '/home/*/.local/lib/python*/site-packages',
+    '/root/.pyenv/versions/*/lib/python*/site-packages',
+    '/opt/*/lib/python*/site-packages',
+    '/opt/*/envs/*/lib/python*/site-packages',
+    '/usr/local/lib/python*/site-packages',
+    '/usr/local/lib/python*/dist-packages',
+    '/usr/lib/python*/site-packages',
+    '/usr/lib/python*/dist-packages',
+    '/usr/lib64/python*/site-packages',
+)
+
+# Metadata files inside of a site-packages directory
+# A plain `.egg-info` file is the metadata itself, distutils installs those
+METADATA_FILES = ('*.dist-info/METADATA', '*.egg-info/PKG-INFO', '*.egg-info')
+
+# Where `pip` usually is, in the order of a default PATH
+PIP_SCRIPTS = ('/usr/local/bin/pip', '/usr/bin/pip', '/bin/pip')
+PATH = ('/usr/local/bin', '/usr/bin', '/bin')
+
+_python = re.compile(r'^python(\d+)?(?:\.(\d+))?$')
+_site_python = re.compile(r'/python(\d+)(?:\.(\d+))?/(?:site|dist)-packages/*$')
+_requirement_name = re.compile(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
+# PEP 440's version pattern, with the alternative spellings it allows
+_version = re.compile(r'''
+    ^\s*v?
+    (?:(?P<epoch>[0-9]+)!)?
+    (?P<release>[0-9]+(?:\.[0-9]+)*)
+    (?:[-_.]?(?P<pre_l>a|b|c|rc|alpha|beta|pre|preview)[-_.]?(?P<pre_n>[0-9]+)?)?
+    (?:(?:-(?P<post_n1>[0-9]+))|(?:[-_.]?(?P<post_l>post|rev|r)[-_.]?(?P<post_n2>[0-9]+)?))?
+    (?:[-_.]?(?P<dev_l>dev)[-_.]?(?P<dev_n>[0-9]+)?)?
+    (?:\+(?P<local>[a-z0-9]+(?:[-_.][a-z0-9]+)*))?
+    \s*$
+''', re.VERBOSE | re.IGNORECASE)
+_pre_order = {'a': 0, 'alpha': 0, 'b': 1, 'beta': 1, 'c': 2, 'rc': 2, 'pre': 2, 'preview': 2}
+_extra_marker = re.compile(r'\bextra\s*==')
+
+
+def canonical_name(name):
+    """
+    Normalize a project name the way pip compares them
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def parse_version(version):
+    """
+    Parse a PEP 440 version into (epoch, release, pre, post, dev, local), None if it isn't one
+    """
+    match = _version.match(version)
+    if match is None:
+        return None
+    release = tuple(int(part) for part in match.group('release').split('.'))
+    pre = (_pre_order[match.group('pre_l').lower()], int(match.group('pre_n') or 0)) if match.group('pre_l') else None
+    post = match.group('post_n1') or match.group('post_n2')
+    if post is None and match.group('post_l'):
+        post = 0
+    dev = int(match.group('dev_n') or 0) if match.group('dev_l') else None
+    local = tuple(re.split(r'[-_.]', match.group('local').lower())) if match.group('local') else None
+    return int(match.group('epoch') or 0), release, pre, int(post) if post is not None else None, dev, local
+
+
+def version_key(version):
+    """
+    Return a sort key that orders PEP 440 versions like pip does, None if it isn't one
+
+    Parse versions once and keep their keys when comparing them many times
+    """
+    parsed = parse_version(version)
+    if parsed is None:
+        return None
+    epoch, release, pre, post, dev, local = parsed
+    # Trailing zeros don't matter, 1.0 == 1.0.0
+    while len(release) > 1 and release[-1] == 0:
+        release = release[:-1]
+    if pre is not None:
+        pre_key = pre
+    elif dev is not None and post is None:
+        # 1.0.dev0 comes before 1.0a0
+        pre_key = (-1, 0)
+    else:
+        pre_key = (3, 0)
+    post_key = (1, post) if post is not None else (0, 0)
+    dev_key = (0, dev) if dev is not None else (1, 0)
+    # Numeric local segments sort after alphanumeric ones
+    local_key = (1, tuple((1, int(part), '') if part.isdigit() else (0, 0, part) for part in local)) if local else (0, ())
+    return epoch, release, pre_key, post_key, dev_key, local_key
+
+
+def shebang_interpreter(line):
+    """
+    Return the interpreter a script's first line runs, a bare name for `#!/usr/bin/env name`, or None if it isn't python
+    """
+    if not line.startswith('#!'):
+        return None
+    args = line[2:].split()
+    if len(args) > 1 and posixpath.basename(args[0]) == 'env':
+        args = args[1:]
+    if not args or _python.match(posixpath.basename(args[0])) is None:
+        return None
+    return args[0]
+
+
+def python_version(interpreter):
+    """
+    Return the version in the name of a python executable, like (3, 11) for `python3.11`, () if it has none
+
+    Returns None if it isn't a python
+    """
+    match = _python.match(posixpath.basename(interpreter))
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.groups() if part is not None)
+
+
+def site_version(site):
+    """
+    Return the python version a site-packages directory is for, like (3,) for Debian's `/usr/lib/python3/dist-packages`, or None
+    """
+    match = _site_python.search(site)
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.groups() if part is not None)
+
+
+def site_of(path):
+    """
+    Return the site-packages directory of the path of a metadata file
+    """
+    directory = posixpath.dirname(path)
+    if directory.endswith(('.dist-info', '.egg-info')):
+        directory = posixpath.dirname(directory)
+    return directory
+
+
+def _newest_first(version):
+    if version is None:
+        return 1, 0, 0
+    # A directory for every python3, like Debian's, comes after the ones of each python3.x
+    major, minor = (version + (-1,))[:2]
+    return 0, -major, -minor
+
+
+def select_sites(sites, interpreter=None):
+    """
+    Pick the site-packages directories of the python pip runs under, and put them in the order it would use them
+
+    sites: directories in the order of `SITE_PACKAGES`
+    interpreter: path of the python pip runs under, with its symlinks resolved, or None if it isn't known
+    Returns the sites of the interpreter's prefix and of its users, in the
+    order given. Without an interpreter, or if none of the sites are its,
+    every site is returned, newest python first, so the packages the newest
+    python would see shadow the others.
+    """
+    sites = list(sites)
+    versions = {site: site_version(site) for site in sites}
+    version = python_version(interpreter) if interpreter is not None else None
+    if version is not None:
+        prefix = posixpath.dirname(posixpath.dirname(interpreter))
+        prefixes = [prefix + '/lib/']
+        if posixpath.basename(prefix) == 'usr':
+            # Debian's python uses /usr/local too
+            prefixes.append(prefix + '/local/lib/')
+        own = [site for site in sites if versions[site] is not None and (site.startswith(tuple(prefixes)) or '/.local/lib/' in site)]
+        # `python3` is whichever python3.x there is, the newest if there are several
+        full = [versions[site] for site in own if len(versions[site]) > 1 and versions[site][:len(version)] == version]
+        if full:
+            version = max(full)
+        selected = [site for site in own if versions[site][:len(version)] == version[:len(versions[site])]]
+        if selected:
+            return selected
+    return sorted(sites, key=lambda site: _newest_first(versions[site]))
+
+
+def read_headers(lines):
+    """
+    Parse the email style header block at the top of a METADATA or PKG-INFO file
+
+    Stops at the first blank line so the long description is never read.
+    Returns a dictionary of lowercase header names to a list of their values
+    """
+    headers = {}
+    key = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            break
+        if line[0] in ' \t':
+            if key is not None:
+                headers[key][-1] += '\n' + line.strip()
+            continue
+        name, _, value = line.partition(':')
+        key = name.strip().lower()
+        headers.setdefault(key, []).append(value.strip())
+    return headers
+
+
+def requirement_name(requirement):
+    """
+    Get the project name out of a `Requires-Dist` value
+
+    Returns None for requirements that only apply to an extra, pip doesn't
+    count those when deciding if a package is required
+    """
+    requirement, _, marker = requirement.partition(';')
+    if _extra_marker.search(marker):
+        return None
+    match = _requirement_name.match(requirement)
+    return match.groups()[0] if match else None
+
+
+def requires_txt(lines):
+    """
+    Get the requirement lines of an egg-info `requires.txt`, skipping the extras sections
+    """
+    for line in lines:
+        line = line.strip()
+        if line.startswith('['):
+            # Everything after the first section is an extra or a marker we can't evaluate
+            break
+        if line and not line.startswith('#'):
+            yield line
+
+
+def pip_list(distributions, long=True):
+    """
+    Build the same list `pip list --format json` returns from package metadata
+
+    distributions: iterable of (headers, requires) where headers come from
+        `read_headers` and requires is an iterable of extra requirement
+        strings (from an egg-info `requires.txt`)
+    long: if false, packages required by another package are left out, like `--not-required`
+    """
+    packages = {}
+    required = set()
+    for headers, requires in distributions:
+        if 'name' not in headers:
+            continue
+        name = headers['name'][0]
+        key = canonical_name(name)
+        if key in packages:
+            # The first one found shadows the rest, like it would on sys.path
+            continue
+        packages[key] = {'name': name, 'version': headers.get('version', [''])[0]}
+        if not long:
+            for requirement in list(headers.get('requires-dist', [])) + list(requires):
+                dependency = requirement_name(requirement)
+                if dependency is not None:
+                    required.add(canonical_name(dependency))
+    return [packages[key] for key in sorted(packages) if long or key not in required]
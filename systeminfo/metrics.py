@@ -0,0 +1,293 @@
+import bisect
+import math
+import threading
+import time
+
+# Seconds, from a quick parse up to a slow `singularity exec`
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class _CounterChild:
+    __slots__ = ('lock', 'current')
+
+    def __init__(self):
+        # Threads come and go with every executor, one lock keeps the memory fixed
+        self.lock = threading.Lock()
+        self.current = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.current += amount
+
+    def value(self):
+        return self.current
+
+
+class _GaugeChild:
+    __slots__ = ('current',)
+
+    def __init__(self):
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def value(self):
+        return self.current
+
+
+class _HistogramChild:
+    __slots__ = ('lock', 'totals', 'buckets')
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.totals = [0] * (len(buckets) + 2)  # Count per bucket..., count above the last, sum
+        self.buckets = buckets
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.totals[i] += 1
+            self.totals[-1] += value
+
+    def time(self):
+        """
+        Return a context manager that observes how many seconds its block took
+        """
+        return _Timer(self)
+
+    def stopwatch(self):
+        """
+        Return a `Stopwatch` that observes the seconds of every block it timed together
+        """
+        return Stopwatch(self)
+
+    def value(self):
+        """
+        Return the (cumulative count per bucket, count, sum)
+        """
+        with self.lock:
+            totals = list(self.totals)
+        counts = []
+        running = 0
+        for count in totals[:-1]:
+            running += count
+            counts.append(running)
+        return counts[:-1], running, totals[-1]
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Stopwatch:
+    """
+    Adds up the seconds of every block it times, and observes the total when asked to
+
+    For work done a piece at a time between waits, like parsing output as it
+    is read, where only the pieces should count
+    """
+    __slots__ = ('histogram', 'seconds', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.seconds = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds += time.perf_counter() - self.start
+
+    def observe(self):
+        self.histogram.observe(self.seconds)
+
+
+class Metric:
+    """
+    A named metric with optional labels, each combination of label values has its own child
+
+    Call the child methods (`inc`, `set`, `observe`, `time`, `stopwatch`) on the metric itself
+    when it has no labels, or on `.labels(...)` otherwise.
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.children = {}  # Label values to the child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **labels):
+        if labels:
+            values = tuple(str(labels[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("`{name}` takes the labels {labels}".format(name=self.name, labels=self.labelnames))
+            child = self.children.setdefault(values, self._child())
+        return child
+
+    def __getattr__(self, name):
+        # Only reached for the child methods, on a metric without labels
+        if name in ('inc', 'set', 'observe', 'time', 'stopwatch', 'value') and not self.labelnames:
+            return getattr(self.labels(), name)
+        raise AttributeError(name)
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{name}="{value}"'.format(name=name, value=_escape(value)) for name, value in pairs) + '}'
+
+    def samples(self):
+        """
+        Generate the (name, label text, value) of every sample
+        """
+        for values, child in list(self.children.items()):
+            yield self.name, self._label_text(values), child.value()
+
+
+class Counter(Metric):
+    """
+    A count that only goes up
+    """
+    type = 'counter'
+
+    def _child(self):
+        return _CounterChild()
+
+
+class Gauge(Metric):
+    """
+    A value that is set to whatever it currently is
+    """
+    type = 'gauge'
+
+    def _child(self):
+        return _GaugeChild()
+
+    def remove(self, *values):
+        """
+        Forget the child with these label values, like a gauge per image when the image is gone
+        """
+        self.children.pop(tuple(str(value) for value in values), None)
+
+
+class Histogram(Metric):
+    """
+    Counts of observations in buckets, with their sum
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            counts, count, total = child.value()
+            for bound, cumulative in zip(self.buckets, counts):
+                yield self.name + '_bucket', self._label_text(values, [('le', _number(bound))]), cumulative
+            yield self.name + '_bucket', self._label_text(values, [('le', '+Inf')]), count
+            yield self.name + '_sum', self._label_text(values), total
+            yield self.name + '_count', self._label_text(values), count
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    return str(value)
+
+
+class Registry:
+    """
+    Every metric of a process, and their Prometheus text exposition
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics.setdefault(name, cls(name, *args, **kwargs))
+        if not isinstance(metric, cls):
+            raise ValueError("`{name}` is already a {type}".format(name=name, type=metric.type))
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def exposition(self):
+        """
+        Return every metric in the Prometheus text format
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {name} {help}'.format(name=name, help=metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {name} {type}'.format(name=name, type=metric.type))
+            for sample, labels, value in metric.samples():
+                lines.append('{sample}{labels} {value}'.format(sample=sample, labels=labels, value=_number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# What the package itself measures, the web server adds its own to the same registry
+COMMAND_SPAWN = REGISTRY.histogram('systeminfo_command_spawn_seconds', "Time to start a command", ('command',))
+COMMAND_DURATION = REGISTRY.histogram('systeminfo_command_seconds', "Time from starting a command until it exited", ('command',))
+COMMAND_BYTES = REGISTRY.counter('systeminfo_command_output_bytes_total', "Bytes read from the output of commands", ('command',))
+COMMAND_FAILURES = REGISTRY.counter('systeminfo_command_failures_total', "Commands that failed or timed out", ('command',))
+PARSE_DURATION = REGISTRY.histogram('systeminfo_parse_seconds', "Time to parse output, read in full or as it arrives", ('parser',))
+COLLECT_DURATION = REGISTRY.histogram('systeminfo_collect_seconds', "Time a collector took, reading and parsing", ('collector',))
+CACHE_REQUESTS = REGISTRY.counter('systeminfo_cache_requests_total', "Cache lookups", ('cache', 'result'))
+SEARCH_DURATION = REGISTRY.histogram('systeminfo_search_seconds', "Time to answer a search", ('format',))
+REFRESH_DURATION = REGISTRY.histogram('systeminfo_refresh_seconds', "Time a successful refresh of one system took")
+REFRESH_LAST = REGISTRY.gauge('systeminfo_refresh_last_seconds', "Time the last successful refresh of each system took", ('system',))
+REFRESH_FAILURES = REGISTRY.counter('systeminfo_refresh_failures_total', "Failed refresh attempts")
+REFRESH_CYCLE = REGISTRY.gauge('systeminfo_refresh_cycle_seconds', "Time the last refresh of every system took")
+REMOTE_CONNECT = REGISTRY.histogram('systeminfo_remote_connect_seconds', "Time until a new session to a remote host answered")
+
+
+def command_label(command):
+    """
+    The program of a command, a label that stays the same whatever the arguments are
+    """
+    if isinstance(command, list):
+        return command[0] if command else ''
+    words = command.split(None, 1)
+    return words[0] if words else ''
@@ -0,0 +1,101 @@
+import array
+import atexit
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import threading
+from .dpkg import dpkg_list
+from . import metadata
+from .store import StringTable
+
+_lock = threading.Lock()
+_pools = {}
+
+
+def get_executor(executor):
+    """
+    Return the executor parsing is offloaded to
+
+    executor: None to parse on the event loop, `thread` or `process` for a
+        pool shared by every system, or any `concurrent.futures.Executor`.
+        The pools are `SYSTEMINFO_PARSE_WORKERS` big, the number of cpus by default
+    """
+    if executor is None or isinstance(executor, concurrent.futures.Executor):
+        return executor
+    if executor not in ('thread', 'process'):
+        raise ValueError("Unknown executor `{executor}`".format(executor=executor))
+    with _lock:
+        if executor not in _pools:
+            workers = int(os.environ['SYSTEMINFO_PARSE_WORKERS']) if os.environ.get('SYSTEMINFO_PARSE_WORKERS') else None
+            if executor == 'thread':
+                _pools[executor] = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            else:
+                # Forking a process that runs an event loop and threads isn't safe
+                _pools[executor] = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pools[executor]
+
+
+@atexit.register
+def _shutdown():
+    """
+    Shut the pools down while the interpreter still works, a process pool collected later fails on its way out
+    """
+    with _lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+
+def pack(apps):
+    """
+    Pack package dictionaries into (strings, layouts, ids) to send them between processes
+
+    Pickling a list of dictionaries repeats every key and every common value,
+    like `amd64` or `[installed]`. Here each distinct value is sent once and
+    the packages are a flat array of ids: the layout of the package's keys
+    followed by the id of each value. Values have to be hashable.
+    """
+    strings = StringTable()
+    layouts = StringTable()
+    ids = array.array('I')
+    for app in apps:
+        ids.append(layouts.intern(tuple(app)))
+        ids.extend(strings.intern(value) for value in app.values())
+    return strings.strings, layouts.strings, ids
+
+
+def unpack(packed):
+    """
+    Rebuild the list of package dictionaries from `pack`
+    """
+    strings, layouts, ids = packed
+    apps = []
+    i = 0
+    while i < len(ids):
+        keys = layouts[ids[i]]
+        apps.append(dict(zip(keys, [strings[j] for j in ids[i + 1:i + 1 + len(keys)]])))
+        i += 1 + len(keys)
+    return apps
+
+
+# The parsers below run in the executor, so they only take picklable arguments.
+# The system's class is passed instead of the system, for its parsing classmethods
+
+def parse_apt_list(system_class, text):
+    return pack(system_class._apt_list_helper(text))
+
+
+def parse_pip_json(text):
+    return pack(json.loads(text))
+
+
+def parse_metadata(system_class, text, long):
+    return pack(metadata.pip_list(system_class._command_distributions(text), long=long))
+
+
+def parse_dpkg(status, extended_states, lists, apps):
+    return pack(dpkg_list(status.splitlines(), extended_states.splitlines(),
+                          lists.splitlines() if lists is not None else None, apps=apps))
@@ -0,0 +1,326 @@
+"""
+Start the commands of every system as child processes, a limited number at a time, and never leave one behind
+
+Commands run without a shell unless they need one, each in a process group
+of its own. When a command times out, or whoever waits for it is cancelled,
+the whole group is killed, so whatever it started, like the processes of a
+`singularity exec`, goes with it. A `ProcessPool` caps how many children are
+running at once over every thread and event loop, and counts them.
+"""
+import asyncio
+import collections
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+from . import metrics
+
+# A command with any of these is handed to a shell, the rest are split and executed directly
+SHELL_CHARACTERS = frozenset('|&;<>()$`\\*?[]{}#~!\n')
+
+PROCESSES = metrics.REGISTRY.gauge('systeminfo_processes', "Child processes running now")
+PROCESSES_WAITING = metrics.REGISTRY.gauge('systeminfo_processes_waiting', "Commands waiting for a child process slot")
+PROCESSES_STARTED = metrics.REGISTRY.counter('systeminfo_processes_started_total', "Child processes started")
+PROCESSES_KILLED = metrics.REGISTRY.counter('systeminfo_processes_killed_total', "Child process groups that were killed", ('reason',))
+
+_lock = threading.Lock()
+_pool = None
+_watcher_pinned = False
+
+
+def split_command(command, shell=True):
+    """
+    Return the arguments to start a command with and whether they need a shell
+
+    A string is split like a shell would if it has nothing only a shell
+    understands, like pipes, redirections, variables or wildcards. Lists
+    are never run through a shell, and nothing is if shell is false
+    """
+    if isinstance(command, list):
+        return command, False
+    if not shell:
+        return shlex.split(command), False
+    if SHELL_CHARACTERS.isdisjoint(command):
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            return command, True
+        # `NAME=value command` sets a variable, only a shell does that
+        if args and '=' not in args[0]:
+            return args, False
+    return command, True
+
+
+def kill_group(pid):
+    """
+    Kill a child's process group, the child leads its own
+
+    The child isn't reaped here. `Popen.kill` and `Process.kill` poll first,
+    which can reap a child before asyncio's child watcher does, so the
+    watcher never learns how it exited
+    """
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def pin_child_watcher(loop=None):
+    """
+    Have asyncio wait for the children of loop with one pidfd watcher, instead of a thread for each
+
+    Only for a program that starts every child from one long running loop,
+    like the web server. Before 3.12 the pidfd watcher is attached to that
+    loop, and children started from any other loop fail. 3.12 and later use
+    pidfds on their own. Returns whether the watcher was pinned
+    """
+    global _watcher_pinned
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, 'PidfdChildWatcher'):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return False
+    with _lock:
+        if _watcher_pinned:
+            return True
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(loop or asyncio.get_event_loop())
+        asyncio.set_child_watcher(watcher)
+        _watcher_pinned = True
+    return True
+
+
+class _Slots:
+    """
+    A counting semaphore that threads and any number of event loops acquire together
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.waiters = collections.deque()  # (loop, future) of the coroutines waiting, in order
+
+    def acquire(self):
+        with self.condition:
+            while self.used >= self.limit or self.waiters:
+                self.condition.wait()
+            self.used += 1
+
+    async def async_acquire(self):
+        loop = asyncio.get_event_loop()
+        with self.lock:
+            if self.used < self.limit and not self.waiters:
+                self.used += 1
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self.waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                handed = waiter not in self.waiters
+                if not handed:
+                    self.waiters.remove(waiter)
+            if handed and future.done() and not future.cancelled():
+                # Handed a slot just before being cancelled
+                self.release()
+            raise
+
+    def _wake(self, future):
+        if future.cancelled():
+            # Its coroutine was cancelled after the slot was handed over, pass it on
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self):
+        with self.lock:
+            while self.waiters:
+                # Handed straight to the first coroutine waiting, so the slot stays used
+                loop, future = self.waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._wake, future)
+                    return
+                except RuntimeError:
+                    # Its loop is closed, nobody is waiting there anymore
+                    continue
+            self.used -= 1
+            self.condition.notify()
+
+
+class ProcessPool:
+    """
+    Starts child processes, at most max_processes at once, and kills their process groups when they are abandoned
+
+    max_processes: defaults to `SYSTEMINFO_MAX_PROCESSES`, or 64
+    """
+    def __init__(self, max_processes=None):
+        if max_processes is None:
+            max_processes = int(os.environ.get('SYSTEMINFO_MAX_PROCESSES', 64))
+        self.max_processes = max_processes
+        self.slots = _Slots(max_processes)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.started = 0
+        self.killed = collections.Counter()  # Reason to how many process groups were killed for it
+
+    def stats(self):
+        """
+        Return the children running and waiting now, and how many were started and killed so far
+        """
+        with self.lock:
+            return {'max_processes': self.max_processes, 'running': self.running, 'waiting': self.waiting,
+                    'started': self.started, 'killed': dict(self.killed)}
+
+    def _count(self, running=0, waiting=0, started=0):
+        with self.lock:
+            self.running += running
+            self.waiting += waiting
+            self.started += started
+            PROCESSES.set(self.running)
+            PROCESSES_WAITING.set(self.waiting)
+        if started:
+            PROCESSES_STARTED.inc(started)
+
+    def kill(self, pid, reason):
+        """
+        Kill a child's process group, counting why
+        """
+        kill_group(pid)
+        with self.lock:
+            self.killed[reason] += 1
+        PROCESSES_KILLED.labels(reason).inc()
+
+    def _acquire(self):
+        self._count(waiting=1)
+        try:
+            self.slots.acquire()
+        finally:
+            self._count(waiting=-1)
+
+    async def _async_acquire(self):
+        self._count(waiting=1)
+        try:
+            await self.slots.async_acquire()
+        finally:
+            self._count(waiting=-1)
+
+    def _release(self):
+        self._count(running=-1)
+        self.slots.release()
+
+    def popen(self, command, shell=True, **kwargs):
+        """
+        Start a command with `subprocess.Popen` once there is a slot for it
+
+        The slot is only given back by `finished`, once the child was waited for
+        """
+        args, shell = split_command(command, shell)
+        self._acquire()
+        try:
+            process = subprocess.Popen(args, shell=shell, start_new_session=True, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        self._count(running=1, started=1)
+        return process
+
+    def finished(self, process, reason='abandoned'):
+        """
+        Make sure a child from `popen` is gone and give its slot back, killing it if it is still running
+        """
+        if process.returncode is None and process.poll() is None:
+            self.kill(process.pid, reason)
+            process.wait()
+        self._release()
+
+    def run(self, command, shell=True, timeout=None, **kwargs):
+        """
+        Run a command like `subprocess.run`, killing its process group if it times out or is interrupted
+
+        Returns a `subprocess.CompletedProcess`, raises `subprocess.TimeoutExpired`
+        """
+        process = self.popen(command, shell, **kwargs)
+        reason = 'abandoned'
+        # Closes the pipes once it is gone
+        with process:
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                reason = 'timeout'
+                raise
+            finally:
+                self.finished(process, reason)
+        return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+    async def start(self, command, shell=True, **kwargs):
+        """
+        Start a command as an asyncio `Process` once there is a slot for it
+
+        The slot is given back when the child exits, however that happens
+        """
+        args, shell = split_command(command, shell)
+        await self._async_acquire()
+        try:
+            if shell:
+                process = await asyncio.create_subprocess_shell(args, start_new_session=True, **kwargs)
+            else:
+                process = await asyncio.create_subprocess_exec(*args, start_new_session=True, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        self._count(running=1, started=1)
+        process.exited = asyncio.ensure_future(self._exited(process))
+        process.killed = None  # Why it was killed, by the first `abandon`
+        return process
+
+    async def _exited(self, process):
+        try:
+            await process.wait()
+        finally:
+            self._release()
+
+    async def abandon(self, process, reason='cancelled'):
+        """
+        Kill the process group of a child from `start` that is still running, and wait for it to be gone
+
+        Abandoning a child again only waits, it is killed and counted once
+        """
+        if process.returncode is None and process.killed is None:
+            process.killed = reason
+            self.kill(process.pid, reason)
+        # Waited for even if this is cancelled too, so it is never left unreaped
+        await asyncio.shield(process.exited)
+
+    async def communicate(self, process, timeout=None):
+        """
+        Wait for a child from `start` to exit and return its (stdout, stderr)
+
+        Its process group is killed when timeout runs out, raising
+        `asyncio.TimeoutError`, or when the caller is cancelled
+        """
+        try:
+            return await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            await self.abandon(process, 'timeout')
+            raise
+        except asyncio.CancelledError:
+            await self.abandon(process, 'cancelled')
+            raise
+
+
+def get_pool():
+    """
+    Return the `ProcessPool` every system shares, unless it is given its own
+    """
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPool()
+        return _pool
@@ -0,0 +1,483 @@
+"""
+Parse search queries into a tree of terms and run them against package indexes
+
+A query is a list of terms, all of which have to match:
+
+    vim,python3>=3.6,numpy~=1.15
+
+Terms can also be combined with `|` (or `OR`), negated with `!` (or `NOT`)
+and grouped with parentheses, `,`, `&`, `AND` or a space all mean and:
+
+    (vim | emacs), !python2*, openssl=1.1
+
+A name matches any package containing it, `name*` only packages starting with
+it and `"name"` only that exact package. A version needs an operator:
+
+    =v     the version is v, or starts with v followed by `.`, `-`, `+`, `~` or `:`
+           so `python=3` matches `3.6.5-3` but not `2.7.3`
+    ==v    the version is equal to v
+    !=v    the version is not equal to v
+    <v <=v >v >=v
+    ~=v    compatible release, at least v and the same up to its last release number
+
+Versions of pip packages compare by PEP 440, all others like dpkg does.
+"""
+import functools
+import re
+from . import dpkg
+from . import metadata
+
+
+class QueryError(ValueError):
+    pass
+
+
+VERSION_OPERATORS = ('==', '!=', '<=', '>=', '~=', '=', '<', '>')
+# A version of `=` may be followed by any of these
+_SEPARATORS = '.-+~:'
+
+_token = re.compile(r'''
+    \s*(?:
+        (?P<open>\() | (?P<close>\)) | (?P<and>,|&) | (?P<or>\|) | (?P<not>!(?!=)) |
+        (?P<term>
+            (?P<name>"[^"]*"|[^\s,&|()!<>=~"]+)
+            (?:(?P<op>==|!=|<=|>=|~=|=|<|>)(?P<version>[^\s,&|()]*))?
+        )
+    )''', re.VERBOSE)
+
+
+@functools.lru_cache(maxsize=1 << 17)
+def version_key(scheme, version):
+    """
+    Return the parsed sort key of a version, versions are only parsed once however often they are compared
+
+    scheme: `pip` for PEP 440, anything else for debian. A version that isn't
+    valid PEP 440 falls back to the debian key, marked so the two never mix
+    """
+    if scheme == 'pip':
+        key = metadata.version_key(version)
+        if key is not None:
+            return 'pip', key
+    return 'debian', dpkg.version_key(version)
+
+
+def _compare(scheme, version, other):
+    a = version_key(scheme, version)
+    b = version_key(scheme, other)
+    if a[0] != b[0]:
+        # One of them isn't PEP 440, compare both like dpkg
+        a = version_key('debian', version)
+        b = version_key('debian', other)
+    return (a[1] > b[1]) - (a[1] < b[1])
+
+
+def _starts_with(version, prefix):
+    if version == prefix:
+        return True
+    return version.startswith(prefix) and version[len(prefix)] in _SEPARATORS
+
+
+def _compatible(scheme, version, other):
+    """
+    PEP 440's `~=`, at least other and equal up to its last release number
+    """
+    if _compare(scheme, version, other) < 0:
+        return False
+    parsed = metadata.parse_version(other)
+    if parsed is not None and version_key(scheme, version)[0] == 'pip':
+        release = parsed[1]
+        return metadata.parse_version(version)[1][:len(release) - 1] == release[:-1]
+    # Without PEP 440 drop the last dotted part of the upstream version instead
+    prefix = dpkg.split_version(other)[1].rpartition('.')[0]
+    return not prefix or _starts_with(dpkg.split_version(version)[1], prefix)
+
+
+class Node:
+    """
+    A part of a parsed query
+
+    `evaluate` returns a dictionary of system names to a list of the
+    (sort key, app) it matched, restricted to the systems given
+    """
+    def estimate(self, run):
+        """
+        Roughly how many packages this would match, smaller runs first
+        """
+        raise NotImplementedError
+
+    def evaluate(self, run, systems):
+        raise NotImplementedError
+
+
+class Term(Node):
+    """
+    A package name, optionally with a version comparison
+    """
+    def __init__(self, name, mode='fuzzy', op=None, version=''):
+        """
+        mode: `fuzzy` to match names containing name, `prefix` or `exact`
+        op: one of `VERSION_OPERATORS`, or None to match any version
+
+        Raises `QueryError` for a `~=` PEP 440 can't use, so a bad query fails
+        when it is parsed instead of halfway through running
+        """
+        if op == '~=':
+            parsed = metadata.parse_version(version)
+            if parsed is not None and len(parsed[1]) < 2:
+                raise QueryError("`~={version}` needs at least two release numbers".format(version=version))
+        self.name = name
+        self.mode = mode
+        self.op = op
+        self.version = version
+
+    def __repr__(self):
+        return 'Term({name!r}, {mode!r}, {op!r}, {version!r})'.format(name=self.name, mode=self.mode, op=self.op, version=self.version)
+
+    def __str__(self):
+        name = {'fuzzy': '{name}', 'prefix': '{name}*', 'exact': '"{name}"'}[self.mode].format(name=self.name)
+        return name + (self.op + self.version if self.op else '')
+
+    def __eq__(self, other):
+        if not isinstance(other, Term):
+            return NotImplemented
+        return (self.name, self.mode, self.op, self.version) == (other.name, other.mode, other.op, other.version)
+
+    def __hash__(self):
+        return hash((self.name, self.mode, self.op, self.version))
+
+    def names(self, run):
+        """
+        Return the package names this term's name matches, shortest first
+        """
+        if self not in run.names:
+            index = run.source.names
+            if self.mode == 'exact':
+                names = [self.name] if self.name in index else []
+            elif self.mode == 'prefix':
+                names = [name for name in index.find(self.name) if name.startswith(self.name)]
+            else:
+                names = index.find(self.name)
+            run.names[self] = names
+        return run.names[self]
+
+    def version_matches(self, app):
+        if self.op is None:
+            return True
+        version = app.get('version')
+        if version is None:
+            return self.op == '!='
+        scheme = app.get('from')
+        if self.op == '=':
+            if ':' not in self.version and ':' in version:
+                # Epochs are rarely known, `=1.2` matches `1:1.2`
+                version = version.partition(':')[2]
+            return _starts_with(version, self.version)
+        if self.op == '~=':
+            return _compatible(scheme, version, self.version)
+        order = _compare(scheme, version, self.version)
+        return {'==': order == 0, '!=': order != 0, '<': order < 0, '<=': order <= 0, '>': order > 0, '>=': order >= 0}[self.op]
+
+    def estimate(self, run):
+        return sum(run.source.count(name) for name in self.names(run))
+
+    def evaluate(self, run, systems):
+        if run.found is not None:
+            # Shared by a batch of queries, every system is matched once and the others filtered out of that
+            if self not in run.found:
+                run.found[self] = self.match(run, None)
+            found = run.found[self]
+            if systems is None:
+                return dict(found)
+            return {system_name: apps for system_name, apps in found.items() if system_name in systems}
+        return self.match(run, systems)
+
+    def match(self, run, systems):
+        found = {}
+        for name in self.names(run):
+            for system_name, position, app in run.source.entries(name):
+                if systems is not None and system_name not in systems:
+                    continue
+                if self.version_matches(app):
+                    found.setdefault(system_name, []).append(((len(name), position), app))
+        return found
+
+
+class Not(Node):
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return 'Not({child!r})'.format(child=self.child)
+
+    def __str__(self):
+        return '!' + _group(self.child)
+
+    def estimate(self, run):
+        # Matches almost everything, so it is only ever used to filter
+        return float('inf')
+
+    def evaluate(self, run, systems):
+        candidates = set(systems if systems is not None else run.source.system_names())
+        excluded = self.child.evaluate(run, candidates)
+        return {system_name: [] for system_name in candidates if system_name not in excluded}
+
+
+class And(Node):
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return 'And({children!r})'.format(children=self.children)
+
+    def __str__(self):
+        return ','.join(_group(child) for child in self.children)
+
+    def estimate(self, run):
+        return min(child.estimate(run) for child in self.children)
+
+    def evaluate(self, run, systems):
+        # The most selective term first, every other term only looks at the systems still matching
+        children = sorted(self.children, key=lambda child: child.estimate(run))
+        result = None
+        for child in children:
+            found = child.evaluate(run, systems if result is None else result)
+            if result is None:
+                result = found
+            else:
+                result = {system_name: apps + found[system_name] for system_name, apps in result.items() if system_name in found}
+            if not result:
+                # Short circuit, nothing can match every term anymore
+                return {}
+        return result
+
+
+class Or(Node):
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return 'Or({children!r})'.format(children=self.children)
+
+    def __str__(self):
+        return '|'.join(_group(child) for child in self.children)
+
+    def estimate(self, run):
+        return sum(child.estimate(run) for child in self.children)
+
+    def evaluate(self, run, systems):
+        result = {}
+        for child in self.children:
+            for system_name, apps in child.evaluate(run, systems).items():
+                result.setdefault(system_name, []).extend(apps)
+        return result
+
+
+def _group(node):
+    return '(' + str(node) + ')' if isinstance(node, (And, Or)) else str(node)
+
+
+class _Parser:
+    def __init__(self, text):
+        self.tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            match = _token.match(text, pos)
+            if match is None or match.end() == pos:
+                raise QueryError("Can't parse the query at `{rest}`".format(rest=text[pos:pos + 40]))
+            pos = match.end()
+            if match.group('term'):
+                word = match.group('term')
+                if word in ('AND', 'OR', 'NOT'):
+                    self.tokens.append((word.lower(), word))
+                else:
+                    self.tokens.append(('term', match))
+            else:
+                kind = match.lastgroup
+                self.tokens.append((kind, match.group(kind)))
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError("Empty query")
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise QueryError("Unexpected `{token}`".format(token=self.tokens[self.pos][1]))
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == 'or':
+            self.take()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while self.peek() in ('and', 'not', 'open', 'term'):
+            if self.peek() == 'and':
+                self.take()
+                if self.peek() in ('and', None, 'close', 'or'):
+                    # Allow a trailing or doubled comma, like `vim,`
+                    continue
+            children.append(self.parse_not())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_not(self):
+        if self.peek() == 'not':
+            self.take()
+            return Not(self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        kind = self.peek()
+        if kind == 'open':
+            self.take()
+            node = self.parse_or()
+            if self.peek() != 'close':
+                raise QueryError("Missing `)`")
+            self.take()
+            return node
+        if kind != 'term':
+            raise QueryError("Expected a package name, got `{token}`".format(
+                token=self.tokens[self.pos][1] if kind else 'the end of the query'))
+        match = self.take()[1]
+        name = match.group('name')
+        if name.startswith('"'):
+            name, mode = name[1:-1], 'exact'
+        elif name.endswith('*'):
+            name, mode = name.rstrip('*'), 'prefix'
+        else:
+            name, mode = name, 'fuzzy'
+        if not name:
+            raise QueryError("Empty package name")
+        op, version = match.group('op'), match.group('version') or ''
+        if op and not version:
+            # `name=` means any version, like it always has
+            op = None
+        return Term(name, mode, op, version)
+
+
+def parse(text):
+    """
+    Parse a query string into its tree of nodes, raises `QueryError` if it is invalid
+    """
+    return _Parser(text).parse()
+
+
+def terms_query(terms, match=False):
+    """
+    Build the query for a list of (name, version) terms, the old way of searching
+
+    Every term has to match, a version has to match as `=version`
+    """
+    return And([Term(name, 'exact' if match else 'fuzzy', '=' if version else None, version) for name, version in terms])
+
+
+class SystemSource:
+    """
+    Lets a query run against the dictionary and name index of one system
+    """
+    def __init__(self, system, name=''):
+        self.system = system
+        self.name = name
+        self.names = system.index
+
+    def count(self, name):
+        return 1 if name in self.system.dict else 0
+
+    def entries(self, name):
+        if name not in self.system.dict:
+            return ()
+        return ((self.name, self.system.index.order[name], self.system.dict[name]),)
+
+    def system_names(self):
+        return [self.name]
+
+
+class SharedSource:
+    """
+    Lets a query run against one system of a `GlobalIndex`, using its name index
+    """
+    def __init__(self, index, system_name, name=''):
+        self.index = index
+        self.system_name = system_name
+        self.name = name
+        self.names = index.names
+
+    def count(self, name):
+        return sum(1 for entry in self.index.entries(name) if entry[0] == self.system_name)
+
+    def entries(self, name):
+        return tuple((self.name, position, app) for system_name, position, app in self.index.entries(name)
+                     if system_name == self.system_name)
+
+    def system_names(self):
+        return [self.name]
+
+
+class _Run:
+    """
+    The state of running one query, names are only looked up once per term
+
+    shared: the run is shared by a batch of queries, so what every term
+        matched is kept for the next query that has it too
+    """
+    def __init__(self, source, shared=False):
+        self.source = source
+        self.names = {}
+        self.found = {} if shared else None
+
+
+def iter_run(node, source, run=None):
+    """
+    Run a parsed query like `run`, but generate the (system name, packages) one system at a time
+
+    The query is evaluated up front, only building the dictionaries of the
+    matching packages is left until each system is reached, so a caller
+    that stops early, or sends each system as it comes, never holds them all
+    """
+    found = node.evaluate(run or _Run(source), None)
+    # A copy, the source may change while the caller is between systems
+    for system_name in list(source.system_names()):
+        if system_name not in found:
+            continue
+        apps = {}
+        for _, app in sorted(found[system_name], key=lambda item: item[0]):
+            if app['name'] not in apps:
+                apps[app['name']] = app if isinstance(app, dict) else dict(app)
+        yield system_name, apps
+
+
+def run(node, source):
+    """
+    Run a parsed query against a source of packages, a `GlobalIndex` or a `SystemSource`
+
+    A source has a `names` `NameIndex`, `count(name)` and `entries(name)` of
+    the (system name, position, app) with that name, and `system_names()`
+
+    Returns a dictionary of system names, in the order of the source, to a
+    dictionary of the matching packages, shortest names first
+    """
+    return dict(iter_run(node, source))
+
+
+def iter_batch(nodes, source):
+    """
+    Run many parsed queries against one source, sharing the work of the terms they have in common
+
+    A term that is in several queries, like `python3>=3.6` in many sets of
+    requirements, has its names looked up and its versions compared once for
+    every system, not once per query. Returns an `iter_run` generator per
+    node, in order, each query is only evaluated when its generator is started
+    """
+    run = _Run(source, shared=True)
+    return [iter_run(node, source, run) for node in nodes]
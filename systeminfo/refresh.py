@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+import time
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def default_concurrency():
+    """
+    How many systems to refresh at once when nothing else is asked for
+
+    Collecting is mostly waiting on the container runtime and the disk, so
+    allow a couple per usable core, but cap it so storage isn't thrashed.
+    The `SYSTEMINFO_REFRESH_CONCURRENCY` envvar overrides it.
+    """
+    if os.environ.get('SYSTEMINFO_REFRESH_CONCURRENCY'):
+        return max(1, int(os.environ['SYSTEMINFO_REFRESH_CONCURRENCY']))
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    return max(2, min(2 * cpus, 16))
+
+
+class RefreshReport:
+    """
+    Timings and failures of one refresh of many systems
+    """
+    def __init__(self, total):
+        self.total = total
+        self.durations = {}  # System name to seconds taken by the successful attempt
+        self.attempts = {}  # System name to how many attempts it took
+        self.failed = {}  # System name to the last exception
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def done(self):
+        return len(self.durations) + len(self.failed)
+
+    @property
+    def duration(self):
+        return (self.end or time.monotonic()) - self.start
+
+    def __str__(self):
+        slowest = sorted(self.durations.items(), key=lambda item: item[1], reverse=True)[:3]
+        return "Refreshed {ok}/{total} in {duration:.1f} s, {failed} failed; slowest: {slowest}".format(
+            ok=len(self.durations), total=self.total, duration=self.duration, failed=len(self.failed),
+            slowest=', '.join('{name} ({seconds:.1f} s)'.format(name=name, seconds=seconds) for name, seconds in slowest))
+
+
+async def _refresh_one(name, info, semaphore, report, timeout, retries, backoff, long, on_refreshed):
+    for attempt in range(retries + 1):
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                d = await asyncio.wait_for(info.async_get_dict(long=long), timeout)
+                if not d:
+                    raise Exception("No packages found")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Refreshing `{name}` failed on attempt {attempt}: `{e!r}`".format(name=name, attempt=attempt + 1, e=e))
+                metrics.REFRESH_FAILURES.inc()
+                report.failed[name] = e
+            else:
+                report.failed.pop(name, None)
+                report.durations[name] = time.monotonic() - start
+                metrics.REFRESH_DURATION.observe(report.durations[name])
+                metrics.REFRESH_LAST.labels(name).set(report.durations[name])
+                report.attempts[name] = attempt + 1
+                if on_refreshed is not None:
+                    on_refreshed(name, info)
+                break
+        if attempt < retries:
+            # Back off outside of the semaphore so other systems can use the slot
+            await asyncio.sleep(backoff * 2 ** attempt)
+    logger.info("Refreshed {done}/{total}: `{name}`".format(done=report.done, total=report.total, name=name))
+
+
+async def refresh(systems, concurrency=None, timeout=None, retries=2, backoff=1.0, long=True, on_refreshed=None):
+    """
+    Populate the package dictionary of many systems concurrently
+
+    systems: dictionary of names to `System`s
+    concurrency: how many systems are collected at once, see `default_concurrency`
+    timeout: seconds a single attempt may take, None to wait forever
+    retries: how many more times a failed or timed out system is tried
+    backoff: seconds to wait before the first retry, doubled every retry
+    on_refreshed: called with the name and system as soon as a system is
+        refreshed, to use it before the others are done
+    Returns a `RefreshReport`
+    """
+    if concurrency is None:
+        concurrency = default_concurrency()
+    semaphore = asyncio.Semaphore(concurrency)
+    report = RefreshReport(len(systems))
+    await asyncio.gather(*[_refresh_one(name, info, semaphore, report, timeout, retries, backoff, long, on_refreshed)
+                           for name, info in systems.items()])
+    report.end = time.monotonic()
+    metrics.REFRESH_CYCLE.set(report.duration)
+    logger.info(str(report))
+    return report
@@ -0,0 +1,604 @@
+"""
+Collect from remote hosts through persistent shell sessions instead of a new ssh connection per command
+
+A session is one long running shell on the host, `ssh host sh` by default.
+Commands are written to its stdin, each followed by a line that marks the
+end of its output with its number and exit status, so the output of every
+command can be told apart. Commands are sent without waiting for the ones
+before them to finish, the shell runs them in order and the answers come
+back in order, so a refresh costs one handshake and no round trips between
+commands. ssh's connection sharing (ControlMaster) lets more sessions to the
+same host reuse its connection.
+
+The ssh processes are started from the system's `ProcessPool`, so an open
+session holds one of its slots until it is closed.
+"""
+import asyncio
+import codecs
+import collections
+import os
+import secrets
+import select
+import shlex
+import subprocess
+import threading
+import time
+from . import metrics
+from .info import System
+from .process import get_pool, kill_group
+from .refresh import refresh
+
+# Where ssh keeps the sockets of shared connections, %C is a hash of the host, port and user
+CONTROL_PATH = '~/.ssh/systeminfo-%C'
+
+
+class SessionError(Exception):
+    """
+    The session ended or got out of step, it is started again for the next command
+    """
+    pass
+
+
+class _Frames:
+    """
+    Splits the output of a session into the output of each command
+
+    Every command's output is followed by a newline and a line with the
+    session's marker, the command's number and its exit status. The marker
+    is random, so output can't contain it by accident
+    """
+    def __init__(self, marker):
+        self.marker = b'\n' + marker.encode() + b' '
+        self.buffer = b''
+
+    def feed(self, data):
+        """
+        Return the events in data: bytes of output, or the (number, exit status) of a finished command
+        """
+        self.buffer += data
+        events = []
+        while True:
+            i = self.buffer.find(self.marker)
+            if i < 0:
+                # Anything but what could be the start of a marker is output
+                keep = len(self.marker) - 1
+                if len(self.buffer) > keep:
+                    events.append(self.buffer[:-keep])
+                    self.buffer = self.buffer[-keep:]
+                return events
+            if i:
+                events.append(self.buffer[:i])
+                self.buffer = self.buffer[i:]
+            end = self.buffer.find(b'\n', len(self.marker))
+            if end < 0:
+                return events
+            number, status = self.buffer[len(self.marker):end].split()
+            events.append((int(number), int(status)))
+            self.buffer = self.buffer[end + 1:]
+
+
+class _Session:
+    """
+    What the blocking and the asyncio sessions share: the marker and how commands are framed
+    """
+    def __init__(self, transport, stderr_into_stdout=True, processes=None):
+        self.transport = transport
+        self.stderr_into_stdout = stderr_into_stdout
+        self.processes = processes if processes is not None else get_pool()
+        self.marker = '@@systeminfo-' + secrets.token_hex(8)
+        self.frames = _Frames(self.marker)
+        self.sent = 0
+        self.process = None
+
+    def frame(self, command):
+        """
+        Return the script that runs command and marks the end of its output, and its number
+
+        The command runs in a subshell without the session's stdin, so it can
+        neither read the commands after it nor change the session
+        """
+        self.sent += 1
+        script = "( {command}\n) </dev/null {stderr}; printf '\\n{marker} {number} %d\\n' \"$?\"\n".format(
+            command=command, stderr='2>&1' if self.stderr_into_stdout else '2>/dev/null', marker=self.marker, number=self.sent)
+        return script.encode('utf-8'), self.sent
+
+    def greeting(self):
+        # Answered as soon as the shell runs, which is when the connection is up
+        return "printf '\\n{marker} 0 0\\n'\n".format(marker=self.marker).encode()
+
+    @property
+    def closed(self):
+        return self.process is None or self.process.returncode is not None
+
+
+class Session(_Session):
+    """
+    A shell on a host that runs one command at a time, for the blocking methods
+    """
+    def __init__(self, transport, stderr_into_stdout=True, processes=None):
+        super().__init__(transport, stderr_into_stdout, processes)
+        self.lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.process is None or self.process.poll() is not None
+
+    def start(self, timeout):
+        start = time.perf_counter()
+        if self.process is not None:
+            # The shell before it ended, give its slot back
+            self.close()
+        self.frames = _Frames(self.marker)
+        self.process = self.processes.popen(self.transport, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.process.stdin.write(self.greeting())
+        self.process.stdin.flush()
+        for event in self._events(time.monotonic() + timeout):
+            if isinstance(event, tuple):
+                break
+        metrics.REMOTE_CONNECT.observe(time.perf_counter() - start)
+
+    def _events(self, deadline):
+        fd = self.process.stdout.fileno()
+        while True:
+            ready, _, _ = select.select([fd], [], [], max(0, deadline - time.monotonic()))
+            if not ready:
+                raise subprocess.TimeoutExpired(self.transport, None)
+            data = os.read(fd, 64 * 1024)
+            if not data:
+                raise SessionError("The session ended")
+            yield from self.frames.feed(data)
+
+    def run(self, command, timeout):
+        """
+        Run a command and generate its output as bytes, then its exit status as an int
+
+        A command that isn't read to the end, fails or times out closes the session
+        """
+        with self.lock:
+            finished = False
+            try:
+                if self.closed:
+                    self.start(timeout)
+                script, number = self.frame(command)
+                self.process.stdin.write(script)
+                self.process.stdin.flush()
+                for event in self._events(time.monotonic() + timeout):
+                    if isinstance(event, bytes):
+                        yield event
+                        continue
+                    if event[0] != number:
+                        raise SessionError("Expected the end of command {number}, got {other}".format(number=number, other=event[0]))
+                    finished = True
+                    yield event[1]
+                    return
+            except (OSError, ValueError) as e:
+                raise SessionError(str(e)) from e
+            finally:
+                if not finished:
+                    # Whatever is left of its output would be taken for the next command's
+                    self.close()
+
+    def close(self):
+        if self.process is not None:
+            self.processes.finished(self.process, 'closed')
+            for pipe in (self.process.stdin, self.process.stdout):
+                pipe.close()
+            self.process = None
+
+
+class _Command:
+    """
+    A command sent to an `AsyncSession`, its output is put in queue as it is read
+    """
+    __slots__ = ('number', 'queue')
+
+    def __init__(self, number):
+        self.number = number
+        self.queue = asyncio.Queue()
+
+
+class AsyncSession(_Session):
+    """
+    A shell on a host for asyncio, commands are sent right away and their output is read in order
+    """
+    def __init__(self, transport, stderr_into_stdout=True, processes=None):
+        super().__init__(transport, stderr_into_stdout, processes)
+        self.pending = collections.deque()
+        self.reader = None
+        self.loop = None
+
+    async def start(self, timeout):
+        start = time.perf_counter()
+        self.loop = asyncio.get_running_loop()
+        self.process = await self.processes.start(self.transport, stdin=asyncio.subprocess.PIPE,
+                                                  stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        greeting = _Command(0)
+        self.pending.append(greeting)
+        self.process.stdin.write(self.greeting())
+        self.reader = self.loop.create_task(self._read())
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                event = await asyncio.wait_for(greeting.queue.get(), max(0, deadline - time.monotonic()))
+                if isinstance(event, Exception):
+                    raise event
+                if isinstance(event, int):
+                    break
+        except BaseException:
+            await self.close()
+            raise
+        metrics.REMOTE_CONNECT.observe(time.perf_counter() - start)
+
+    async def _read(self):
+        error = SessionError("The session ended")
+        try:
+            while True:
+                data = await self.process.stdout.read(64 * 1024)
+                if not data:
+                    break
+                for event in self.frames.feed(data):
+                    if isinstance(event, bytes):
+                        self.pending[0].queue.put_nowait(event)
+                        continue
+                    command = self.pending.popleft()
+                    if event[0] != command.number:
+                        error = SessionError("Expected the end of command {number}, got {other}".format(number=command.number, other=event[0]))
+                        command.queue.put_nowait(error)
+                        return
+                    command.queue.put_nowait(event[1])
+        except IndexError:
+            error = SessionError("Output after every command finished")
+        finally:
+            # Nothing more will come for the commands still waiting
+            while self.pending:
+                self.pending.popleft().queue.put_nowait(error)
+            if self.process.returncode is None:
+                # Its stdout is closed, so the shell is on its way out anyway, the pool reaps it and takes its slot back
+                kill_group(self.process.pid)
+
+    @property
+    def load(self):
+        """
+        How many commands are waiting for their output
+        """
+        return len(self.pending)
+
+    async def run(self, command, timeout):
+        """
+        Run a command and generate its output as bytes, then its exit status as an int
+
+        A command that isn't read to the end, fails or times out closes the
+        session, the commands sent after it fail with a `SessionError`
+        """
+        script, number = self.frame(command)
+        sent = _Command(number)
+        self.pending.append(sent)
+        self.process.stdin.write(script)
+        deadline = time.monotonic() + timeout
+        finished = False
+        try:
+            await self.process.stdin.drain()
+            while True:
+                event = await asyncio.wait_for(sent.queue.get(), max(0, deadline - time.monotonic()))
+                if isinstance(event, Exception):
+                    raise event
+                if isinstance(event, int):
+                    finished = True
+                    yield event
+                    return
+                yield event
+        except (ConnectionError, BrokenPipeError) as e:
+            raise SessionError(str(e)) from e
+        finally:
+            if not finished:
+                await self.close()
+
+    async def close(self):
+        if self.process is not None:
+            # Waits until the pool reaped it and has its slot back
+            await self.processes.abandon(self.process, 'closed')
+        if self.reader is not None:
+            await self.reader
+
+
+class SessionProcess:
+    """
+    A command sent to an `AsyncSession`, read like the asyncio `Process` of a local command
+
+    stdout is a `StreamReader` the command's output is fed into as the
+    session reads it, the whole output is buffered if nobody reads it.
+    returncode is set once the command finished. `kill` stops waiting for
+    the command, which closes its session
+    """
+    def __init__(self, events):
+        self.stdout = asyncio.StreamReader()
+        self.returncode = None
+        self.error = None
+        self.reader = asyncio.ensure_future(self._read(events))
+
+    async def _read(self, events):
+        try:
+            async for event in events:
+                if isinstance(event, bytes):
+                    self.stdout.feed_data(event)
+                else:
+                    self.returncode = event
+        except (Exception, asyncio.CancelledError) as e:
+            # Raised to whoever reads stdout or waits
+            self.error = e
+            self.stdout.set_exception(e)
+        else:
+            self.stdout.feed_eof()
+        finally:
+            # Closes the session if the command didn't finish
+            await events.aclose()
+
+    async def wait(self):
+        """
+        Wait for the command to finish and return its exit status, raises a `SessionError` if the session ended first
+        """
+        await asyncio.shield(self.reader)
+        if self.error is not None:
+            raise self.error
+        return self.returncode
+
+    async def communicate(self):
+        """
+        Wait for the command to finish and return its (stdout, stderr), stderr is always None
+        """
+        stdout = await self.stdout.read()
+        await self.wait()
+        return stdout, None
+
+    def kill(self):
+        self.reader.cancel()
+
+
+class Remote(System):
+    """
+    A host reached over ssh, every command runs through persistent shell sessions
+    """
+    def __init__(self, host, *args, ssh='ssh', ssh_options=(), sessions=1, transport=None, **kwargs):
+        """
+        host: where ssh connects to, like `user@host`
+        ssh: the ssh binary
+        ssh_options: more ssh arguments, like `('-p', '2222')`
+        sessions: how many sessions the async methods may open, commands are
+            spread over them. Each runs its commands in order, without
+            waiting in between. The blocking methods use one more
+        transport: the command that starts a shell on the host instead of
+            ssh, like `['sh']` to stand in for a remote with this machine
+        """
+        super().__init__(*args, **kwargs)
+        self.host = host
+        if transport is None:
+            transport = [ssh, '-T', '-o', 'BatchMode=yes', '-o', 'ControlMaster=auto', '-o', 'ControlPath=' + CONTROL_PATH,
+                         '-o', 'ControlPersist=60', *ssh_options, host, 'sh']
+        self.transport = list(transport)
+        self.sessions = sessions
+        # A semaphore that limits how many sessions connect at once, see `Fleet`
+        self.connect_limit = None
+        self._session = None
+        self._async_sessions = []
+        self._lock = None  # The event loop and the lock that starts sessions on it
+
+    def __repr__(self):
+        return '{cls}({host!r})'.format(cls=type(self).__name__, host=self.host)
+
+    def file_path(self, path):
+        # Files are on the host, they are read with commands
+        if self.filesystem is not None:
+            return path
+        return None
+
+    def _command(self, command):
+        return command if isinstance(command, str) else ' '.join(shlex.quote(word) for word in command)
+
+    def _sync_session(self):
+        if self._session is None:
+            self._session = Session(self.transport, self.stderr_into_stdout, self.processes)
+        return self._session
+
+    def run_command(self, command, shell=False):
+        label = metrics.command_label(command)
+        start = time.perf_counter()
+        output = []
+        try:
+            for event in self._sync_session().run(self._command(command), self.timeout):
+                if isinstance(event, bytes):
+                    output.append(event)
+                else:
+                    status = event
+        except Exception:
+            metrics.COMMAND_FAILURES.labels(label).inc()
+            raise
+        stdout = b''.join(output)
+        metrics.COMMAND_DURATION.labels(label).observe(time.perf_counter() - start)
+        metrics.COMMAND_BYTES.labels(label).inc(len(stdout))
+        return subprocess.CompletedProcess(command, status, stdout)
+
+    async def async_run_command(self, command):
+        """
+        Send a command to a session and return its `SessionProcess`
+        """
+        start = time.perf_counter()
+        session = await self._pick_session()
+        process = SessionProcess(session.run(self._command(command), self.timeout))
+        metrics.COMMAND_SPAWN.labels(metrics.command_label(command)).observe(time.perf_counter() - start)
+        return process
+
+    def iter_command_chunks(self, command, shell=False, check=True, size=64 * 1024):
+        label = metrics.command_label(command)
+        start = time.perf_counter()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        total = 0
+        failed = True
+        events = self._sync_session().run(self._command(command), self.timeout)
+        try:
+            for event in events:
+                if isinstance(event, bytes):
+                    total += len(event)
+                    yield decoder.decode(event)
+                elif check and event != 0:
+                    raise subprocess.CalledProcessError(event, command)
+            yield decoder.decode(b'', final=True)
+            failed = False
+        finally:
+            events.close()
+            self._command_finished(label, start, total, failed)
+
+    async def _pick_session(self):
+        """
+        Return the session to send the next command to, starting one if every open one is busy
+        """
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock[0] is not loop:
+            self._lock = (loop, asyncio.Lock())
+        async with self._lock[1]:
+            # Sessions of an event loop that is gone can't be used anymore
+            self._async_sessions = [session for session in self._async_sessions if not session.closed and session.loop is loop]
+            idle = [session for session in self._async_sessions if not session.load]
+            if idle or len(self._async_sessions) >= self.sessions:
+                return min(self._async_sessions, key=lambda session: session.load)
+            session = AsyncSession(self.transport, self.stderr_into_stdout, self.processes)
+            if self.connect_limit is not None:
+                async with self.connect_limit:
+                    await session.start(self.timeout)
+            else:
+                await session.start(self.timeout)
+            self._async_sessions.append(session)
+            return session
+
+    async def async_iter_command_chunks(self, command, check=True, size=64 * 1024):
+        label = metrics.command_label(command)
+        start = time.perf_counter()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        total = 0
+        failed = True
+        events = None
+        try:
+            session = await self._pick_session()
+            events = session.run(self._command(command), self.timeout)
+            async for event in events:
+                if isinstance(event, bytes):
+                    total += len(event)
+                    yield decoder.decode(event)
+                elif check and event != 0:
+                    raise Exception(f"Error running command {command}; exit status {event}")
+            yield decoder.decode(b'', final=True)
+            failed = False
+        finally:
+            if events is not None:
+                # Closes the session if the command didn't finish
+                await events.aclose()
+            self._command_finished(label, start, total, failed)
+
+    async def async_get_command_text(self, command, check=True):
+        return ''.join([chunk async for chunk in self.async_iter_command_chunks(command, check=check)])
+
+    async def async_get_dict(self, long=True):
+        try:
+            return await super().async_get_dict(long=long)
+        except (Exception, asyncio.CancelledError):
+            # Its sessions hold process slots other hosts may be waiting for, a retry connects again
+            await self.async_close()
+            raise
+
+    def close(self):
+        """
+        Close the blocking session, see `async_close` for the others
+        """
+        if self._session is not None:
+            self._session.close()
+
+    async def async_close(self):
+        """
+        Close every session
+        """
+        self.close()
+        for session in self._async_sessions:
+            await session.close()
+        self._async_sessions = []
+
+
+class Fleet:
+    """
+    Many `Remote`s, refreshed a bounded number at a time
+    """
+    def __init__(self, hosts=(), concurrency=32, connect_concurrency=10, max_connections=None, **kwargs):
+        """
+        hosts: where ssh connects to
+        concurrency: how many hosts are collected at once, they are mostly
+            waiting on the network so this can be far more than the cores
+        connect_concurrency: how many sessions may be connecting at once,
+            sshd drops connections beyond its MaxStartups, 10 by default
+        max_connections: how many hosts keep their sessions open between
+            refreshes, None for all. The fastest hosts are closed first. Open
+            sessions hold slots of the `ProcessPool`, so no more hosts than
+            the slots the hosts being collected leave over are kept open
+        kwargs: passed to every `Remote`
+        """
+        self.concurrency = concurrency
+        self.connect_concurrency = connect_concurrency
+        self.max_connections = max_connections
+        self.kwargs = kwargs
+        self.processes = kwargs.get('processes') or get_pool()
+        self.systems = {}
+        self.durations = {}  # Host to how long its last refresh took
+        for host in hosts:
+            self.add(host)
+
+    def add(self, host):
+        if host not in self.systems:
+            self.systems[host] = Remote(host, **self.kwargs)
+        return self.systems[host]
+
+    async def remove(self, host):
+        info = self.systems.pop(host, None)
+        self.durations.pop(host, None)
+        if info is not None:
+            await info.async_close()
+
+    async def refresh(self, **kwargs):
+        """
+        Refresh every host, see `systeminfo.refresh.refresh` for the arguments
+
+        Hosts are started slowest first, as far as the last refresh knows, so
+        the slow ones don't start last and hold up the end. Returns the `RefreshReport`
+        """
+        connect_limit = asyncio.Semaphore(self.connect_concurrency)
+        for info in self.systems.values():
+            info.connect_limit = connect_limit
+        order = sorted(self.systems, key=lambda host: self.durations.get(host, float('inf')), reverse=True)
+        sessions = self.kwargs.get('sessions', 1)
+        # A host holds its sessions while it waits for more, so the hosts being collected must fit in the pool
+        kwargs['concurrency'] = max(1, min(kwargs.get('concurrency') or self.concurrency, self.processes.max_processes // sessions))
+        room = (self.processes.max_processes - kwargs['concurrency'] * sessions) // sessions
+        if self.max_connections is not None:
+            room = min(room, self.max_connections)
+        kept = [host for host, info in self.systems.items() if info._async_sessions]
+        closing = []
+        on_refreshed = kwargs.get('on_refreshed')
+
+        def refreshed(host, info):
+            if host not in kept:
+                kept.append(host)
+            if len(kept) > room:
+                # Idle sessions would hold the slots of the hosts still to be collected
+                kept.remove(host)
+                closing.append(asyncio.ensure_future(info.async_close()))
+            if on_refreshed is not None:
+                on_refreshed(host, info)
+
+        kwargs['on_refreshed'] = refreshed
+        report = await refresh({host: self.systems[host] for host in order}, **kwargs)
+        await asyncio.gather(*closing)
+        self.durations.update(report.durations)
+        if self.max_connections is not None:
+            for host in sorted(self.systems, key=lambda host: self.durations.get(host, 0))[:max(0, len(self.systems) - self.max_connections)]:
+                await self.systems[host].async_close()
+        return report
+
+    async def close(self):
+        for info in self.systems.values():
+            await info.async_close()
@@ -0,0 +1,453 @@
+import collections
+import fnmatch
+import io
+import lzma
+import mmap
+import posixpath
+import struct
+import zlib
+
+SQUASHFS_MAGIC = b'hsqs'
+SIF_MAGIC = b'SIF_MAGIC'
+
+# Superblock flags
+UNCOMPRESSED_INODES = 0x0001
+UNCOMPRESSED_FRAGMENTS = 0x0008
+
+# Inode types
+BASIC_DIRECTORY = 1
+BASIC_FILE = 2
+BASIC_SYMLINK = 3
+EXTENDED_DIRECTORY = 8
+EXTENDED_FILE = 9
+EXTENDED_SYMLINK = 10
+
+NO_FRAGMENT = 0xFFFFFFFF
+# Set on a data or fragment block size when the block is stored uncompressed
+BLOCK_UNCOMPRESSED = 1 << 24
+# Set on a metadata block header when the block is stored uncompressed
+METADATA_UNCOMPRESSED = 1 << 15
+METADATA_SIZE = 8192
+# How many uncompressed metadata blocks (8 KiB each) and inodes an open image keeps
+METADATA_CACHE_BLOCKS = 256
+INODE_CACHE_SIZE = 4096
+
+_superblock = struct.Struct('<IIIIIHHHHHHQQQQQQQQ')
+_inode_header = struct.Struct('<HHHHII')
+_basic_directory = struct.Struct('<IIHHI')
+_extended_directory = struct.Struct('<IIIIHHI')
+_basic_file = struct.Struct('<IIII')
+_extended_file = struct.Struct('<QQQIIII')
+_symlink = struct.Struct('<II')
+_directory_header = struct.Struct('<III')
+_directory_entry = struct.Struct('<HhHH')
+_fragment_entry = struct.Struct('<QII')
+
+# SIF global header up to the descriptor offset, and the start of a descriptor
+_sif_header = struct.Struct('<32s10s3s3s16sqqqqqqqq')
+_sif_descriptor = struct.Struct('<iBIIIqqqqqqq128s384s')
+SIF_PARTITION = 0x4004
+SIF_FS_SQUASHFS = 1
+SIF_PART_SYSTEM = 2
+
+
+class SquashFSError(Exception):
+    pass
+
+
+def _decompressor(compression):
+    if compression == 1:
+        return zlib.decompress
+    if compression == 2:
+        return lambda data: lzma.decompress(data, format=lzma.FORMAT_ALONE)
+    if compression == 4:
+        return lzma.decompress
+    if compression == 5:
+        try:
+            import lz4.block
+        except ImportError:
+            raise SquashFSError("lz4 compressed images need the `lz4` package")
+        return lambda data: lz4.block.decompress(data, uncompressed_size=1 << 20)
+    if compression == 6:
+        try:
+            import zstandard
+        except ImportError:
+            raise SquashFSError("zstd compressed images need the `zstandard` package")
+        return lambda data: zstandard.ZstdDecompressor().decompress(data, max_output_size=1 << 20)
+    raise SquashFSError("Unsupported squashfs compression `{compression}`".format(compression=compression))
+
+
+def is_squashfs(path):
+    """
+    Whether the image at path has a squashfs filesystem `SquashFS` can find, ext3 images don't
+    """
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            find_squashfs(data)
+    except (OSError, ValueError, struct.error, SquashFSError):
+        return False
+    return True
+
+
+def find_squashfs(data):
+    """
+    Return the offset of the squashfs filesystem inside of an image
+
+    Plain squashfs images start with it, SIF images have it as their system partition
+    """
+    if data[:4] == SQUASHFS_MAGIC:
+        return 0
+    if data[32:32 + len(SIF_MAGIC)] == SIF_MAGIC:
+        header = _sif_header.unpack_from(data, 0)
+        descriptors_offset, descriptors_length = header[9], header[10]
+        for offset in range(descriptors_offset, descriptors_offset + descriptors_length, _sif_descriptor.size):
+            descriptor = _sif_descriptor.unpack_from(data, offset)
+            datatype, used, fileoff, extra = descriptor[0], descriptor[1], descriptor[5], descriptor[13]
+            if datatype != SIF_PARTITION or not used:
+                continue
+            fstype, parttype = struct.unpack_from('<ii', extra, 0)
+            if fstype == SIF_FS_SQUASHFS and parttype == SIF_PART_SYSTEM and data[fileoff:fileoff + 4] == SQUASHFS_MAGIC:
+                return fileoff
+        # Descriptor layouts changed between SIF versions, fall back to the first squashfs in the data section
+        offset = data.find(SQUASHFS_MAGIC, header[11])
+        if offset == -1:
+            raise SquashFSError("SIF image without a squashfs system partition")
+        return offset
+    # Singularity 2 images may have a launch script in front of the filesystem
+    offset = data.find(SQUASHFS_MAGIC, 0, 64 * 1024)
+    if offset == -1:
+        raise SquashFSError("Not a squashfs or SIF image, ext3 images are not supported")
+    return offset
+
+
+class Inode:
+    """
+    The parts of an inode needed to read directories, files and symlinks
+    """
+    __slots__ = ('type', 'number', 'size', 'block', 'offset', 'fragment', 'fragment_offset', 'block_sizes', 'target')
+
+    @property
+    def is_dir(self):
+        return self.type in (BASIC_DIRECTORY, EXTENDED_DIRECTORY)
+
+    @property
+    def is_file(self):
+        return self.type in (BASIC_FILE, EXTENDED_FILE)
+
+    @property
+    def is_symlink(self):
+        return self.type in (BASIC_SYMLINK, EXTENDED_SYMLINK)
+
+
+class SquashFS:
+    """
+    Read only access to the files of a squashfs image from userspace
+
+    The image is mmap'd, so only the metadata and blocks of the files that are
+    actually read are ever paged in. Works on plain squashfs images, images
+    with a launch script in front and SIF images. The most recently used
+    metadata blocks and inodes are kept, up to `METADATA_CACHE_BLOCKS` and
+    `INODE_CACHE_SIZE`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise SquashFSError("Empty image")
+        try:
+            self.base = find_squashfs(self.data)
+            self._read_superblock()
+        except struct.error:
+            self.close()
+            raise SquashFSError("Truncated image")
+        except Exception:
+            self.close()
+            raise
+        self._metadata_cache = collections.OrderedDict()
+        self._fragments = None
+        self._inodes = collections.OrderedDict()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_superblock(self):
+        (magic, self.inode_count, _, self.block_size, self.fragment_count, compression, block_log, self.flags, _,
+         major, minor, self.root_inode, self.bytes_used, _, _, self.inode_table, self.directory_table,
+         self.fragment_table, _) = _superblock.unpack_from(self.data, self.base)
+        if (major, minor) != (4, 0):
+            raise SquashFSError("Unsupported squashfs version {major}.{minor}".format(major=major, minor=minor))
+        if 1 << block_log != self.block_size:
+            raise SquashFSError("Corrupt superblock")
+        if self.base + self.bytes_used > len(self.data):
+            raise SquashFSError("Truncated image, {missing} bytes are missing".format(missing=self.base + self.bytes_used - len(self.data)))
+        if not all(table < self.bytes_used for table in (self.inode_table, self.directory_table)):
+            raise SquashFSError("Corrupt superblock")
+        self.decompress = _decompressor(compression)
+
+    def _metadata_block(self, position):
+        """
+        Return the uncompressed metadata block at position and where the next one starts
+        """
+        if position in self._metadata_cache:
+            self._metadata_cache.move_to_end(position)
+            return self._metadata_cache[position]
+        if not 0 <= position < self.bytes_used - 2:
+            raise SquashFSError("Metadata block outside of the image at {position}".format(position=position))
+        start = self.base + position
+        header, = struct.unpack_from('<H', self.data, start)
+        size = header & ~METADATA_UNCOMPRESSED
+        raw = self.data[start + 2:start + 2 + size]
+        block = raw if header & METADATA_UNCOMPRESSED else self._decompress(raw, position)
+        return _remember(self._metadata_cache, position, (block, position + 2 + size), METADATA_CACHE_BLOCKS)
+
+    def _metadata(self, position, offset, length):
+        """
+        Read length bytes of metadata starting at offset in the block at position, crossing blocks as needed
+        """
+        chunks = []
+        while length > 0:
+            block, following = self._metadata_block(position)
+            chunk = block[offset:offset + length]
+            if not chunk:
+                raise SquashFSError("Metadata read past the end of the table")
+            chunks.append(chunk)
+            length -= len(chunk)
+            position, offset = following, 0
+        return b''.join(chunks)
+
+    def _metadata_reader(self, position, offset):
+        """
+        Return a function that reads consecutive metadata starting at offset in the block at position
+        """
+        state = [position, offset]
+
+        def read(length):
+            data = self._metadata(state[0], state[1], length)
+            # Advance through whole blocks to where the read ended
+            remaining = state[1] + length
+            while True:
+                block, following = self._metadata_block(state[0])
+                if remaining < len(block):
+                    break
+                remaining -= len(block)
+                state[0] = following
+                if not remaining:
+                    # Don't touch the next block until something is read from it
+                    break
+            state[1] = remaining
+            return data
+        return read
+
+    def inode(self, reference):
+        """
+        Read the inode an inode reference points at
+        """
+        if reference in self._inodes:
+            self._inodes.move_to_end(reference)
+            return self._inodes[reference]
+        read = self._metadata_reader(self.inode_table + (reference >> 16), reference & 0xFFFF)
+        inode = Inode()
+        inode.type, _, _, _, _, inode.number = _inode_header.unpack(read(_inode_header.size))
+        inode.target = None
+        inode.block_sizes = ()
+        inode.fragment = NO_FRAGMENT
+        if inode.type == BASIC_DIRECTORY:
+            inode.block, _, size, inode.offset, _ = _basic_directory.unpack(read(_basic_directory.size))
+            inode.size = size
+        elif inode.type == EXTENDED_DIRECTORY:
+            _, inode.size, inode.block, _, _, inode.offset, _ = _extended_directory.unpack(read(_extended_directory.size))
+        elif inode.type in (BASIC_FILE, EXTENDED_FILE):
+            if inode.type == BASIC_FILE:
+                inode.block, inode.fragment, inode.fragment_offset, inode.size = _basic_file.unpack(read(_basic_file.size))
+            else:
+                inode.block, inode.size, _, _, inode.fragment, inode.fragment_offset, _ = _extended_file.unpack(read(_extended_file.size))
+            count = inode.size // self.block_size
+            if inode.fragment == NO_FRAGMENT and inode.size % self.block_size:
+                count += 1
+            inode.block_sizes = struct.unpack('<{count}I'.format(count=count), read(4 * count))
+        elif inode.type in (BASIC_SYMLINK, EXTENDED_SYMLINK):
+            _, size = _symlink.unpack(read(_symlink.size))
+            inode.target = read(size).decode('utf-8', errors='surrogateescape')
+            inode.size = size
+        else:
+            inode.size = 0
+        return _remember(self._inodes, reference, inode, INODE_CACHE_SIZE)
+
+    def _entries(self, inode):
+        """
+        Generate (name, inode reference) for every entry of a directory inode
+        """
+        # Directory sizes count the `.` and `..` entries that aren't stored
+        remaining = inode.size - 3
+        if remaining <= 0:
+            return
+        read = self._metadata_reader(self.directory_table + inode.block, inode.offset)
+        while remaining > 0:
+            count, start, _ = _directory_header.unpack(read(_directory_header.size))
+            remaining -= _directory_header.size
+            for _ in range(count + 1):
+                offset, _, _, name_size = _directory_entry.unpack(read(_directory_entry.size))
+                name = read(name_size + 1).decode('utf-8', errors='surrogateescape')
+                remaining -= _directory_entry.size + name_size + 1
+                yield name, (start << 16) | offset
+
+    def _lookup(self, path, follow=True, depth=0):
+        """
+        Return the inode at an absolute path, following symlinks
+        """
+        return self._resolve(path, follow, depth)[0]
+
+    def _resolve(self, path, follow=True, depth=0):
+        """
+        Return the inode at an absolute path and the parts of that path with its symlinks resolved
+        """
+        if depth > 40:
+            raise SquashFSError("Too many levels of symbolic links: `{path}`".format(path=path))
+        inode = self.inode(self.root_inode)
+        parts = [part for part in path.split('/') if part and part != '.']
+        resolved = []
+        for i, part in enumerate(parts):
+            if part == '..':
+                resolved = resolved[:-1]
+                inode = self._lookup('/' + '/'.join(resolved), depth=depth + 1)
+                continue
+            if not inode.is_dir:
+                raise NotADirectoryError(path)
+            for name, reference in self._entries(inode):
+                if name == part:
+                    inode = self.inode(reference)
+                    break
+            else:
+                raise FileNotFoundError(path)
+            last = i == len(parts) - 1
+            if inode.is_symlink and (follow or not last):
+                target = posixpath.join('/' + '/'.join(resolved), inode.target)
+                inode = self._lookup(target, depth=depth + 1)
+                resolved = [part for part in posixpath.normpath(target).split('/') if part]
+            else:
+                resolved.append(part)
+        return inode, resolved
+
+    def realpath(self, path):
+        """
+        Return path with its symlinks resolved
+        """
+        return '/' + '/'.join(self._resolve(path)[1])
+
+    def exists(self, path):
+        try:
+            self._lookup(path)
+            return True
+        except (FileNotFoundError, NotADirectoryError, SquashFSError):
+            return False
+
+    def isfile(self, path):
+        try:
+            return self._lookup(path).is_file
+        except (FileNotFoundError, NotADirectoryError, SquashFSError):
+            return False
+
+    def isdir(self, path):
+        try:
+            return self._lookup(path).is_dir
+        except (FileNotFoundError, NotADirectoryError, SquashFSError):
+            return False
+
+    def listdir(self, path):
+        inode = self._lookup(path)
+        if not inode.is_dir:
+            raise NotADirectoryError(path)
+        return [name for name, _ in self._entries(inode)]
+
+    def _fragment(self, index):
+        if self._fragments is None:
+            self._fragments = {}
+        if index not in self._fragments:
+            if index >= self.fragment_count or self.fragment_table + 8 * (index // 512 + 1) > self.bytes_used:
+                raise SquashFSError("Fragment {index} isn't in the fragment table".format(index=index))
+            # The fragment table is a list of pointers to metadata blocks of 512 entries each
+            pointer, = struct.unpack_from('<Q', self.data, self.base + self.fragment_table + 8 * (index // 512))
+            offset = (index % 512) * _fragment_entry.size
+            start, size, _ = _fragment_entry.unpack(self._metadata(pointer, offset, _fragment_entry.size))
+            self._fragments[index] = (start, size)
+        return self._fragments[index]
+
+    def _decompress(self, raw, position):
+        try:
+            return self.decompress(raw)
+        except Exception as e:
+            raise SquashFSError("Corrupt block at {position}: {e}".format(position=position, e=e)) from e
+
+    def _block(self, start, size):
+        length = size & ~BLOCK_UNCOMPRESSED
+        if start + length > self.bytes_used:
+            raise SquashFSError("Data block outside of the image at {start}".format(start=start))
+        raw = self.data[self.base + start:self.base + start + length]
+        return raw if size & BLOCK_UNCOMPRESSED else self._decompress(raw, start)
+
+    def read(self, path):
+        """
+        Return the contents of the file at path as bytes
+        """
+        inode = self._lookup(path)
+        if not inode.is_file:
+            raise IsADirectoryError(path) if inode.is_dir else SquashFSError("Not a regular file: `{path}`".format(path=path))
+        chunks = []
+        position = inode.block
+        for size in inode.block_sizes:
+            if size & ~BLOCK_UNCOMPRESSED == 0:
+                # Sparse block
+                chunks.append(bytes(self.block_size))
+                continue
+            chunks.append(self._block(position, size))
+            position += size & ~BLOCK_UNCOMPRESSED
+        if inode.fragment != NO_FRAGMENT:
+            start, size = self._fragment(inode.fragment)
+            tail = inode.size % self.block_size
+            chunks.append(self._block(start, size)[inode.fragment_offset:inode.fragment_offset + tail])
+        return b''.join(chunks)[:inode.size]
+
+    def open_text(self, path):
+        return io.StringIO(self.read(path).decode('utf-8', errors='replace'))
+
+    def glob(self, pattern):
+        """
+        Return the absolute paths matching a shell style pattern, wildcards match within one path component
+        """
+        paths = ['/']
+        for part in [part for part in pattern.split('/') if part]:
+            matches = []
+            for path in paths:
+                if any(c in part for c in '*?['):
+                    try:
+                        names = self.listdir(path)
+                    except (FileNotFoundError, NotADirectoryError, SquashFSError):
+                        continue
+                    for name in sorted(fnmatch.filter(names, part)):
+                        # Like the shell, wildcards don't match hidden files
+                        if not name.startswith('.') or part.startswith('.'):
+                            matches.append(posixpath.join(path, name))
+                elif self.exists(posixpath.join(path, part)):
+                    matches.append(posixpath.join(path, part))
+            paths = matches
+        return paths
+
+
+def _remember(cache, key, value, size):
+    """
+    Add value to an LRU ordered dictionary, dropping the least recently used entry past size
+    """
+    cache[key] = value
+    if len(cache) > size:
+        cache.popitem(last=False)
+    return value
@@ -0,0 +1,252 @@
+import array
+import collections.abc
+import weakref
+
+# Keys that get their own column, anything else is kept in a per row dictionary
+COLUMNS = ('from', 'name', 'version', 'arch', 'state')
+
+
+class StringTable:
+    """
+    Interns strings as small integers
+
+    One table is shared by every inventory, so a string like `amd64` or a
+    common version is only stored once no matter how many systems have it.
+    Every `intern` counts a reference to the string and every `release`
+    drops one, a string nothing refers to anymore is removed and its id is
+    given to the next new string. Id 0 is always None.
+    """
+    def __init__(self):
+        self.ids = {None: 0}
+        self.strings = [None]
+        self.counts = array.array('Q', [0])
+        self.free = []  # Ids of removed strings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def intern(self, string):
+        """
+        Return the id of string, adding it if it is new, and count a reference to it
+        """
+        i = self.ids.get(string)
+        if i is None:
+            if self.free:
+                i = self.free.pop()
+                self.strings[i] = string
+            else:
+                i = len(self.strings)
+                self.strings.append(string)
+                self.counts.append(0)
+            self.ids[string] = i
+        if i:
+            self.counts[i] += 1
+        return i
+
+    def release(self, i):
+        """
+        Drop a reference to the string with id i, removing it if it was the last
+        """
+        if not i:
+            return
+        self.counts[i] -= 1
+        if not self.counts[i]:
+            del self.ids[self.strings[i]]
+            self.strings[i] = None
+            self.free.append(i)
+
+
+STRINGS = StringTable()
+# Key orders are interned too, each row remembers the order its dictionary had
+LAYOUTS = StringTable()
+
+
+class PackageRow(collections.abc.Mapping):
+    """
+    A read only, dictionary like view of one package in an `Inventory`
+
+    Once the inventory recycles the row of a removed package, views of it
+    raise a `KeyError` instead of showing whatever package gets the row next
+    """
+    __slots__ = ('inventory', 'row', 'version')
+
+    def __init__(self, inventory, row):
+        self.inventory = inventory
+        self.row = row
+        self.version = inventory.versions[row]
+
+    @property
+    def valid(self):
+        """
+        Whether the row still holds the package this view was made for
+        """
+        return self.inventory.versions[self.row] == self.version
+
+    def keys(self):
+        if not self.valid:
+            raise KeyError("The package was removed from its inventory")
+        return self.inventory.layouts[self.inventory.layout[self.row]]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, key):
+        inventory = self.inventory
+        if key not in self.keys():
+            raise KeyError(key)
+        if key in inventory.columns:
+            i = inventory.columns[key][self.row]
+            if i:
+                return inventory.strings[i]
+        return inventory.extra[self.row][key]
+
+    def to_dict(self):
+        return {key: self[key] for key in self.keys()}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class Inventory(collections.abc.MutableMapping):
+    """
+    A compact mapping of package names to their information
+
+    Every column is an array of string ids, instead of a dictionary per
+    package with its own copy of every key and value. Looking a package up
+    returns a `PackageRow`, use `to_dict` or `dict()` on it for a real dictionary.
+
+    Rows are never renumbered: replacing a package writes over its row.
+    Deleting one keeps its row as it was until `recycle` is called, so views
+    handed out before, like to a `GlobalIndex`, still show the package until
+    whoever holds them caught up. Recycled rows are reused for the next
+    packages added, and their old views stop working.
+
+    The strings of every row are released when the inventory is garbage
+    collected, so the shared tables only hold what live inventories use.
+    """
+    def __init__(self, apps=(), strings=STRINGS, layouts=LAYOUTS):
+        """
+        apps: iterable of package dictionaries, the first one with a name wins
+        strings: the `StringTable` to intern values in
+        layouts: the `StringTable` to intern key orders in
+        """
+        self.strings = strings
+        self.layouts = layouts
+        self.columns = {column: array.array('I') for column in COLUMNS}
+        self.layout = array.array('I')
+        self.versions = array.array('I')  # Bumped every time a row is recycled
+        self.extra = {}  # Row to a dictionary of keys without a column, rare
+        self.rows = {}  # Name to row
+        self.released = []  # Rows of deleted packages, until they are recycled
+        self.free = []  # Recycled rows, reused before the arrays grow
+        # Not at exit, nothing needs the tables then
+        weakref.finalize(self, _release_rows, strings, layouts, self.columns, self.layout, self.free).atexit = False
+        for app in apps:
+            self.append(app)
+
+    def append(self, app):
+        """
+        Add a package dictionary, ignored if the name is already in the inventory
+        """
+        if app['name'] in self.rows:
+            return
+        self._add_row(app)
+
+    def _add_row(self, app, row=None):
+        """
+        Write app to row, or to a free row if row is None
+        """
+        name = app['name']
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                row = len(self.layout)
+                for values in self.columns.values():
+                    values.append(0)
+                self.layout.append(0)
+                self.versions.append(0)
+        intern = self.strings.intern
+        release = self.strings.release
+        for column, values in self.columns.items():
+            value = app.get(column)
+            # Id 0 means the value isn't a string and lives in extra, or the key is missing
+            # Interned before the old value is released, so a value that stays isn't removed in between
+            old = values[row]
+            values[row] = intern(value) if isinstance(value, str) else 0
+            release(old)
+        extra = {key: value for key, value in app.items() if key not in self.columns or not isinstance(value, str)}
+        if extra:
+            self.extra[row] = extra
+        else:
+            self.extra.pop(row, None)
+        old = self.layout[row]
+        self.layout[row] = self.layouts.intern(tuple(app))
+        self.layouts.release(old)
+        # Key by the interned copy of the name, so every inventory shares it
+        self.rows[self.strings[self.columns['name'][row]] or name] = row
+
+    def __getitem__(self, name):
+        return PackageRow(self, self.rows[name])
+
+    def __setitem__(self, name, app):
+        if app['name'] != name:
+            raise KeyError("Package `{name}` stored under `{key}`".format(name=app['name'], key=name))
+        # Dictionaries keep the position of a replaced key, its row is written over in place
+        self._add_row(app, self.rows.get(name))
+
+    def __delitem__(self, name):
+        self.released.append(self.rows.pop(name))
+
+    def recycle(self):
+        """
+        Make the rows of the packages deleted until now free for new packages
+
+        Call it once nothing needs the views of those packages anymore, their
+        strings are released and the views raise a `KeyError` from now on
+        """
+        for row in self.released:
+            self.versions[row] += 1
+            self.extra.pop(row, None)
+            _release_row(self.strings, self.layouts, self.columns, self.layout, row)
+        self.free.extend(self.released)
+        self.released = []
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def to_dict(self):
+        """
+        Return a plain dictionary of names to package dictionaries
+        """
+        return {name: self[name].to_dict() for name in self.rows}
+
+
+def _release_row(strings, layouts, columns, layout, row):
+    for values in columns.values():
+        strings.release(values[row])
+        values[row] = 0
+    layouts.release(layout[row])
+    layout[row] = 0
+
+
+def _release_rows(strings, layouts, columns, layout, free):
+    """
+    Release the strings of every row of a garbage collected `Inventory`, the free rows hold none
+    """
+    free = set(free)
+    for row in range(len(layout)):
+        if row not in free:
+            _release_row(strings, layouts, columns, layout, row)
@@ -0,0 +1,137 @@
+import contextlib
+import json
+
+
+class LineSplitter:
+    """
+    Turn chunks of text into whole lines, keeping the unfinished last line until more text comes
+    """
+    def __init__(self):
+        self.pending = ''
+
+    def feed(self, chunk):
+        """
+        Return the lines completed by chunk, without their newline
+        """
+        lines = (self.pending + chunk).split('\n')
+        self.pending = lines.pop()
+        return lines
+
+    def close(self):
+        """
+        Return whatever is left after the last newline
+        """
+        lines = [self.pending] if self.pending else []
+        self.pending = ''
+        return lines
+
+
+class JSONArrayDecoder:
+    """
+    Decode the items of a top level JSON array, like `pip list --format json`
+    prints, as its text arrives
+
+    Only the text of the item being decoded is kept around
+    """
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk):
+        """
+        Return the items completed by chunk
+        """
+        self.buffer += chunk
+        items = []
+        pos = 0
+        while not self.finished:
+            while pos < len(self.buffer) and self.buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(self.buffer):
+                break
+            if not self.started:
+                if self.buffer[pos] != '[':
+                    raise ValueError("Expected a JSON array, got `{text}`".format(text=self.buffer[pos:pos + 80]))
+                self.started = True
+                pos += 1
+                continue
+            if self.buffer[pos] == ']':
+                self.finished = True
+                pos += 1
+                break
+            try:
+                item, end = self.decoder.raw_decode(self.buffer, pos)
+            except ValueError:
+                # The item isn't complete yet
+                break
+            if isinstance(item, (int, float)) and not isinstance(item, bool) and self.buffer[end:end + 1] in ('', '.', 'e', 'E', '+', '-'):
+                # A number is only whole once something else follows it, the next chunk may have more of it
+                break
+            items.append(item)
+            pos = end
+        self.buffer = self.buffer[pos:]
+        return items
+
+    def close(self):
+        if not self.finished:
+            raise ValueError("Unfinished JSON array: `{text}`".format(text=self.buffer[:80]))
+        if self.buffer.strip():
+            raise ValueError("Extra data after JSON array: `{text}`".format(text=self.buffer[:80]))
+
+
+def iter_lines(chunks):
+    """
+    Generate lines from an iterable of text chunks
+    """
+    splitter = LineSplitter()
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield from splitter.close()
+
+
+async def async_iter_lines(chunks, stopwatch=None):
+    """
+    Generate lines from an async iterable of text chunks
+
+    stopwatch: a `metrics` stopwatch that times the splitting, not the waits for chunks
+    """
+    stopwatch = stopwatch or contextlib.nullcontext()
+    splitter = LineSplitter()
+    async for chunk in chunks:
+        with stopwatch:
+            lines = splitter.feed(chunk)
+        for line in lines:
+            yield line
+    with stopwatch:
+        lines = splitter.close()
+    for line in lines:
+        yield line
+
+
+def iter_json_array(chunks):
+    """
+    Generate the items of a JSON array from an iterable of text chunks
+    """
+    decoder = JSONArrayDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    decoder.close()
+
+
+async def async_iter_json_array(chunks, stopwatch=None):
+    """
+    Generate the items of a JSON array from an async iterable of text chunks
+
+    stopwatch: a `metrics` stopwatch that times the decoding, not the waits for chunks
+    """
+    stopwatch = stopwatch or contextlib.nullcontext()
+    decoder = JSONArrayDecoder()
+    async for chunk in chunks:
+        with stopwatch:
+            items = decoder.feed(chunk)
+        for item in items:
+            yield item
+    with stopwatch:
+        decoder.close()
@@ -0,0 +1,276 @@
+"""
+Notice when the files systems are collected from change, instead of collecting them again on a timer
+
+`watcher` returns an `InotifyWatcher` where inotify is available, and a
+`PollingWatcher` that compares stat results otherwise. Both generate the
+sets of paths that changed, once they have been left alone for a while.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Writes only move a file's debounce along, the other events are what changed it
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _inotify_libc():
+    """
+    Return libc with the inotify functions, or None where there is no inotify
+    """
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        except (OSError, AttributeError):
+            libc = False
+        _libc = libc
+    return _libc or None
+
+
+class Watcher:
+    """
+    Watches the files under some directories, and some single files
+
+    roots: directories whose files, at any depth, are watched
+    files: single files that are watched, they don't need to exist yet
+    match: called with a path under a root, only paths it is true for are
+        reported. Single files are always reported
+    debounce: seconds a path has to be left alone before it is reported,
+        so a file that is still being written is only reported once it's done
+    """
+    def __init__(self, roots=(), files=(), match=None, debounce=2.0):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.files = {os.path.abspath(path) for path in files}
+        self.match = match
+        self.debounce = debounce
+
+    def wanted(self, path):
+        if path in self.files:
+            return True
+        if not any(path.startswith(root + os.sep) for root in self.roots):
+            return False
+        return self.match is None or self.match(path)
+
+    def changes(self):
+        """
+        Asynchronously generate the sets of paths that were added, removed or changed
+
+        None means the watcher lost track, and everything should be checked
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    """
+    A `Watcher` that is told about changes by the kernel
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.libc = _inotify_libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}  # Watch descriptor to the directory it watches
+        for root in self.roots:
+            self._add_tree(root)
+        for directory in {os.path.dirname(path) for path in self.files}:
+            self._add(directory)
+
+    def _add(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                logger.warning("Out of inotify watches, raise fs.inotify.max_user_watches: `{directory}`".format(directory=directory))
+            elif error not in (errno.ENOENT, errno.ENOTDIR):
+                logger.warning("Can't watch `{directory}`: `{error}`".format(directory=directory, error=os.strerror(error)))
+            return False
+        self.directories[wd] = directory
+        return True
+
+    def _add_tree(self, root):
+        """
+        Watch a directory and every directory below it, returns the files found in them
+        """
+        found = []
+        for path, directories, files in os.walk(root):
+            self._add(path)
+            found.extend(os.path.join(path, file) for file in files)
+        return found
+
+    def read(self):
+        """
+        Return the paths of the events waiting to be read, or None if some were lost
+        """
+        paths = set()
+        lost = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # Events were dropped, or a watched directory itself went away
+                    lost = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.directories.pop(wd, None)
+                    continue
+                directory = self.directories.get(wd)
+                if directory is None:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name)) if name else directory
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and any(path == root or path.startswith(root + os.sep) for root in self.roots):
+                        # Files moved in with the directory never get events of their own
+                        paths.update(self._add_tree(path))
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        # Whatever was in it is gone, only a full check knows what that was
+                        lost = True
+                    continue
+                paths.add(path)
+        return None if lost else paths
+
+    async def changes(self):
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        fd = self.fd
+        loop.add_reader(fd, readable.set)
+        pending = {}  # Path to when its last event was seen
+        try:
+            while True:
+                timeout = None
+                if pending:
+                    timeout = max(0, min(pending.values()) + self.debounce - time.monotonic())
+                try:
+                    await asyncio.wait_for(readable.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                if readable.is_set():
+                    readable.clear()
+                    paths = self.read()
+                    if paths is None:
+                        logger.warning("Lost track of changes, everything has to be checked")
+                        pending.clear()
+                        yield None
+                        continue
+                    now = time.monotonic()
+                    for path in paths:
+                        if self.wanted(path):
+                            pending[path] = now
+                now = time.monotonic()
+                settled = {path for path, seen in pending.items() if now - seen >= self.debounce}
+                if settled:
+                    for path in settled:
+                        del pending[path]
+                    yield settled
+        finally:
+            loop.remove_reader(fd)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(Watcher):
+    """
+    A `Watcher` that compares the stat results of every file each interval
+
+    A change is reported once a file looks the same on two scans in a row,
+    so a file is left alone for at least an interval, or debounce if that is longer
+    """
+    def __init__(self, *args, interval=30.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = max(interval, self.debounce)
+
+    def scan(self):
+        """
+        Return a dictionary of every wanted path to its (size, mtime, inode)
+        """
+        found = {}
+        paths = set(self.files)
+        for root in self.roots:
+            for path, directories, files in os.walk(root):
+                paths.update(os.path.join(path, file) for file in files)
+        for path in paths:
+            if not self.wanted(path):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        return found
+
+    async def changes(self):
+        loop = asyncio.get_running_loop()
+        # Walking a big tree is slow, so it isn't done on the event loop
+        previous = await loop.run_in_executor(None, self.scan)
+        pending = {}  # Path to its stat result when it was seen changing, None when it is gone
+        while True:
+            await asyncio.sleep(self.interval)
+            current = await loop.run_in_executor(None, self.scan)
+            settled = {path for path, stat in pending.items() if current.get(path) == stat}
+            for path in settled:
+                del pending[path]
+            for path in previous.keys() | current.keys():
+                if previous.get(path) != current.get(path):
+                    pending[path] = current.get(path)
+            previous = current
+            if settled:
+                yield settled
+
+
+def watcher(roots=(), files=(), match=None, debounce=2.0, interval=30.0, polling=False):
+    """
+    Return an `InotifyWatcher`, or a `PollingWatcher` if polling is true or inotify can't be used
+
+    interval: seconds between scans when polling
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(roots, files, match=match, debounce=debounce)
+        except OSError as e:
+            logger.warning("Can't use inotify, polling every {interval} s instead: `{e}`".format(interval=interval, e=e))
+    return PollingWatcher(roots, files, match=match, debounce=debounce, interval=interval)
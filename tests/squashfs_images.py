@@ -0,0 +1,209 @@
+"""
+Write small squashfs and SIF images for the tests, no mksquashfs needed
+
+Only what `systeminfo.squashfs` reads is written: basic directory, file and
+symlink inodes, data blocks, fragments and the fragment table. The tree is
+a dictionary of absolute paths to bytes, or to `Symlink`s
+"""
+import lzma
+import struct
+import zlib
+
+METADATA_SIZE = 8192
+BLOCK_UNCOMPRESSED = 1 << 24
+METADATA_UNCOMPRESSED = 1 << 15
+NO_FRAGMENT = 0xFFFFFFFF
+NO_TABLE = 0xFFFFFFFFFFFFFFFF
+GZIP, XZ = 1, 4
+
+
+class Symlink:
+    def __init__(self, target):
+        self.target = target
+
+
+def _compressor(compression):
+    if compression == GZIP:
+        return zlib.compress
+    if compression == XZ:
+        return lzma.compress
+    return None
+
+
+class _MetadataWriter:
+    def __init__(self, compress):
+        self.compress = compress
+        self.blocks = bytearray()
+        self.current = bytearray()
+
+    def position(self):
+        """
+        (start of the current block, offset in it), a reference to what is written next
+        """
+        return len(self.blocks), len(self.current)
+
+    def write(self, data):
+        self.current += data
+        while len(self.current) >= METADATA_SIZE:
+            self._flush(bytes(self.current[:METADATA_SIZE]))
+            del self.current[:METADATA_SIZE]
+
+    def _flush(self, block):
+        compressed = self.compress(block) if self.compress else None
+        if compressed is not None and len(compressed) < len(block):
+            self.blocks += struct.pack('<H', len(compressed)) + compressed
+        else:
+            self.blocks += struct.pack('<H', len(block) | METADATA_UNCOMPRESSED) + block
+
+    def finish(self):
+        if self.current:
+            self._flush(bytes(self.current))
+            self.current = bytearray()
+        return bytes(self.blocks)
+
+
+def _tree(files):
+    root = {}
+    for path, content in files.items():
+        parts = [part for part in path.split('/') if part]
+        directory = root
+        for part in parts[:-1]:
+            directory = directory.setdefault(part, {})
+        directory[parts[-1]] = content
+    return root
+
+
+def squashfs(files, compression=GZIP, block_size=4096, fragments=True):
+    """
+    Return the bytes of a squashfs 4.0 filesystem with files in it
+
+    compression: `GZIP`, `XZ`, or None to store everything uncompressed,
+        though still marked as gzip in the superblock
+    fragments: put the tails of files in fragment blocks, like mksquashfs does
+    """
+    compress = _compressor(compression)
+    superblock_size = 96
+    data = bytearray()
+    pending_fragment = bytearray()
+    fragment_entries = []
+    inodes = _MetadataWriter(compress)
+    directories = _MetadataWriter(compress)
+    numbers = [0]
+
+    def block(raw):
+        compressed = compress(raw) if compress else None
+        if compressed is not None and len(compressed) < len(raw):
+            return compressed, len(compressed)
+        return raw, len(raw) | BLOCK_UNCOMPRESSED
+
+    def flush_fragment():
+        if pending_fragment:
+            stored, size = block(bytes(pending_fragment))
+            fragment_entries.append((superblock_size + len(data), size))
+            data.extend(stored)
+            pending_fragment.clear()
+
+    def add_inode(header_type, body):
+        numbers[0] += 1
+        reference = inodes.position()
+        inodes.write(struct.pack('<HHHHII', header_type, 0o755, 0, 0, 0, numbers[0]) + body)
+        return (reference[0] << 16) | reference[1], numbers[0], header_type
+
+    def add_file(content):
+        start = superblock_size + len(data)
+        sizes = []
+        whole = len(content) // block_size if fragments else -(-len(content) // block_size)
+        for i in range(whole):
+            raw = content[i * block_size:(i + 1) * block_size]
+            if not raw.strip(b'\0') and len(raw) == block_size:
+                # Sparse, nothing is stored
+                sizes.append(0)
+                continue
+            stored, size = block(raw)
+            data.extend(stored)
+            sizes.append(size)
+        fragment, fragment_offset = NO_FRAGMENT, 0
+        tail = content[whole * block_size:] if fragments else b''
+        if tail:
+            if len(pending_fragment) + len(tail) > block_size:
+                flush_fragment()
+            fragment, fragment_offset = len(fragment_entries), len(pending_fragment)
+            pending_fragment.extend(tail)
+        body = struct.pack('<IIII', start, fragment, fragment_offset, len(content))
+        body += struct.pack('<{count}I'.format(count=len(sizes)), *sizes)
+        return add_inode(2, body)
+
+    def add_directory(tree):
+        entries = []
+        for name in sorted(tree):
+            value = tree[name]
+            if isinstance(value, dict):
+                entries.append((name,) + add_directory(value))
+            elif isinstance(value, Symlink):
+                target = value.target.encode()
+                entries.append((name,) + add_inode(3, struct.pack('<II', 1, len(target)) + target))
+            else:
+                entries.append((name,) + add_file(value))
+        start, offset = directories.position()
+        listing = bytearray()
+        # A header starts every run of entries whose inodes are in the same metadata block
+        run = []
+        for entry in entries + [None]:
+            if run and (entry is None or entry[1] >> 16 != run[0][1] >> 16 or len(run) == 256):
+                listing += struct.pack('<III', len(run) - 1, run[0][1] >> 16, run[0][2])
+                for name, reference, number, kind in run:
+                    encoded = name.encode()
+                    listing += struct.pack('<HhHH', reference & 0xFFFF, number - run[0][2], kind, len(encoded) - 1) + encoded
+                run = []
+            if entry is not None:
+                run.append(entry)
+        directories.write(bytes(listing))
+        return add_inode(1, struct.pack('<IIHHI', start, 2, len(listing) + 3, offset, 0))
+
+    root_reference, _, _ = add_directory(_tree(files))
+    flush_fragment()
+
+    inode_table = superblock_size + len(data)
+    inode_bytes = inodes.finish()
+    directory_table = inode_table + len(inode_bytes)
+    directory_bytes = directories.finish()
+    fragment_blocks = _MetadataWriter(compress)
+    pointers = []
+    for i, (start, size) in enumerate(fragment_entries):
+        if i % 512 == 0:
+            pointers.append(directory_table + len(directory_bytes) + fragment_blocks.position()[0])
+        fragment_blocks.write(struct.pack('<QII', start, size, 0))
+    fragment_bytes = fragment_blocks.finish()
+    fragment_table = directory_table + len(directory_bytes) + len(fragment_bytes)
+    pointer_bytes = struct.pack('<{count}Q'.format(count=len(pointers)), *pointers)
+    id_blocks = _MetadataWriter(compress)
+    id_blocks.write(struct.pack('<I', 0))
+    id_bytes = id_blocks.finish()
+    id_table = fragment_table + len(pointer_bytes) + len(id_bytes)
+    tables = inode_bytes + directory_bytes + fragment_bytes + pointer_bytes + id_bytes + struct.pack('<Q', fragment_table + len(pointer_bytes))
+    bytes_used = superblock_size + len(data) + len(tables)
+    superblock = struct.pack('<IIIIIHHHHHHQQQQQQQQ', 0x73717368, numbers[0], 0, block_size, len(fragment_entries),
+                             compression or GZIP, block_size.bit_length() - 1, 0, 1, 4, 0, root_reference, bytes_used,
+                             id_table, NO_TABLE, inode_table, directory_table, fragment_table, NO_TABLE)
+    return superblock + bytes(data) + tables
+
+
+def sif(filesystem):
+    """
+    Return the bytes of a SIF image with filesystem as its system partition, after a definition file descriptor
+    """
+    descriptor = struct.Struct('<iBIIIqqqqqqq128s384s')
+    definition = b'Bootstrap: docker\nFrom: ubuntu\n'
+    descriptors_offset = 4096
+    data_offset = descriptors_offset + 2 * descriptor.size
+    descriptors = descriptor.pack(0x4001, 1, 1, 0, 0, data_offset, len(definition), len(definition), 0, 0, 0, 0, b'', b'')
+    partition_offset = data_offset + 4096
+    descriptors += descriptor.pack(0x4004, 1, 2, 0, 0, partition_offset, len(filesystem), len(filesystem), 0, 0, 0, 0,
+                                   b'rootfs', struct.pack('<ii', 1, 2) + b'amd64')
+    header = struct.pack('<32s10s3s3s16sqqqqqqqq', b'#!/usr/bin/env run-singularity\n', b'SIF_MAGIC', b'01', b'02', b'\0' * 16,
+                         0, 0, 0, 2, descriptors_offset, len(descriptors), data_offset, partition_offset + len(filesystem) - data_offset)
+    image = bytearray(header.ljust(descriptors_offset, b'\0'))
+    image += descriptors
+    image += definition.ljust(partition_offset - data_offset, b'\0')
+    image += filesystem
+    return bytes(image)
@@ -0,0 +1,60 @@
+import concurrent.futures
+import os
+import shutil
+from systeminfo.cache import InventoryCache
+
+INVENTORY = {'vim': {'from': 'apt', 'name': 'vim', 'version': '2:8.0.1453-1ubuntu1'}}
+
+
+def image(tmp_path, name='image.sif'):
+    path = str(tmp_path / name)
+    with open(path, 'wb') as f:
+        f.write(bytes(range(256)) * 4096 * 8)
+    return path
+
+
+def test_edit_between_the_sampled_blocks_is_a_miss(tmp_path):
+    cache = InventoryCache(block_size=1024, samples=4)
+    path = image(tmp_path)
+    cache.put(path, INVENTORY)
+    assert cache.get(path) == INVENTORY
+    hashed = cache.content_hash(path)
+    with open(path, 'r+b') as f:
+        f.seek(os.path.getsize(path) // 6)
+        f.write(b'changed')
+    # The sampled hash doesn't see it, the new mtime does
+    assert cache.content_hash(path) == hashed
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert cache.get(path) is None
+
+
+def test_copy_with_the_same_mtime_is_a_hit(tmp_path):
+    cache = InventoryCache(block_size=1024, samples=4)
+    path = image(tmp_path)
+    cache.put(path, INVENTORY)
+    copy = shutil.copy2(path, str(tmp_path / 'copy.sif'))
+    os.replace(copy, path)
+    assert cache.get(path) == INVENTORY
+    copy = shutil.copy2(path, str(tmp_path / 'copy.sif'))
+    with open(copy, 'r+b') as f:
+        f.write(b'changed')
+    shutil.copystat(path, copy)
+    os.replace(copy, path)
+    assert cache.get(path) is None
+
+
+def test_threads_share_the_cache(tmp_path):
+    cache = InventoryCache(str(tmp_path / 'inventory.sqlite3'), block_size=1024, samples=4)
+    paths = [image(tmp_path, 'image{i}.sif'.format(i=i)) for i in range(8)]
+
+    def use(path):
+        for i in range(20):
+            cache.put(path, INVENTORY)
+            assert cache.get(path) == INVENTORY
+            cache.invalidate(path)
+        cache.put(path, INVENTORY)
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(use, paths))
+    assert all(cache.snapshot(path) == INVENTORY for path in paths)
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import time
+from systeminfo.info import System
+from test_dpkg import EXTENDED_STATES, MAIN, STATUS, write
+from test_metadata import dist
+
+
+class Slow(System):
+    """
+    Collectors that take a while, pip fails if asked to
+    """
+    def __init__(self, delay, fail=False, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.fail = fail
+
+    def _pip(self):
+        if self.fail:
+            raise ValueError("pip is broken")
+        return [{'from': 'pip', 'name': 'vim', 'version': '9.0'}, {'from': 'pip', 'name': 'six', 'version': '1.16.0'}]
+
+    def apt_installed(self):
+        time.sleep(self.delay)
+        return [{'from': 'apt', 'name': 'vim', 'version': '8.0'}]
+
+    async def async_apt_installed(self):
+        await asyncio.sleep(self.delay)
+        return [{'from': 'apt', 'name': 'vim', 'version': '8.0'}]
+
+    def pip_list(self, long=True):
+        time.sleep(self.delay)
+        return self._pip()
+
+    async def async_pip_list(self, long=True):
+        await asyncio.sleep(self.delay)
+        return self._pip()
+
+
+def test_collectors_run_at_the_same_time():
+    for collect in (lambda system: system.get_dict(), lambda system: asyncio.run(system.async_get_dict())):
+        system = Slow(0.3)
+        start = time.monotonic()
+        d = collect(system)
+        assert time.monotonic() - start < 0.55
+        # The first collector wins a name both have
+        assert d == {'vim': {'from': 'apt', 'name': 'vim', 'version': '8.0'}, 'six': {'from': 'pip', 'name': 'six', 'version': '1.16.0'}}
+
+
+def test_failing_collector_is_skipped():
+    expected = {'vim': {'from': 'apt', 'name': 'vim', 'version': '8.0'}}
+    assert Slow(0, fail=True).get_dict() == expected
+    assert asyncio.run(Slow(0, fail=True).async_get_dict()) == expected
+
+
+class Counting(System):
+    """
+    Counts the commands it runs
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.commands = 0
+
+    def process_command(self, command):
+        self.commands += 1
+        return super().process_command(command)
+
+
+def image(root, batch):
+    # Files are read through commands, like in a container
+    system = Counting(pre_command='env ', apt_backend='dpkg', pip_backend='metadata', batch=batch)
+    system.APT_STATUS = os.path.join(str(root), 'var/lib/dpkg/status')
+    system.APT_EXTENDED_STATES = os.path.join(str(root), 'var/lib/apt/extended_states')
+    system.APT_AVAILABLE = (os.path.join(str(root), 'var/lib/apt/lists/*_Packages'),)
+    system.PIP_SITE_PACKAGES = (os.path.join(str(root), 'usr/lib/python3/dist-packages'),)
+    return system
+
+
+def test_batch_collects_the_same_with_one_command(tmp_path):
+    write(tmp_path, '/var/lib/dpkg/status', STATUS)
+    write(tmp_path, '/var/lib/apt/extended_states', EXTENDED_STATES)
+    write(tmp_path, '/var/lib/apt/lists/archive.ubuntu.com_ubuntu_dists_bionic_main_binary-amd64_Packages', MAIN)
+    dist(tmp_path, '/usr/lib/python3/dist-packages', 'six', '1.16.0')
+    unbatched = image(tmp_path, batch=False)
+    expected = unbatched.get_dict()
+    assert unbatched.commands > 1
+    assert sorted(expected) == ['curl', 'mytool', 'six', 'vim', 'vim-runtime']
+    for collect in (lambda system: system.get_dict(), lambda system: asyncio.run(system.async_get_dict())):
+        system = image(tmp_path, batch=True)
+        assert collect(system) == expected
+        assert system.commands == 1
+
+
+def test_batch_skips_a_failing_collector(tmp_path):
+    # No dpkg status, apt fails and pip is still collected
+    dist(tmp_path, '/usr/lib/python3/dist-packages', 'six', '1.16.0')
+    assert list(image(tmp_path, batch=True).get_dict()) == ['six']
+    assert list(asyncio.run(image(tmp_path, batch=True).async_get_dict())) == ['six']
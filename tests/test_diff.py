@@ -0,0 +1,42 @@
+from systeminfo.diff import ChangeLog, diff_inventories
+
+
+def test_diff_inventories():
+    old = {'a': {'name': 'a', 'version': '1'}, 'b': {'name': 'b', 'version': '1'}}
+    new = {'a': {'name': 'a', 'version': '2'}, 'c': {'name': 'c', 'version': '1'}}
+    changes = diff_inventories(old, new)
+    assert changes.added == {'c': new['c']}
+    assert changes.removed == {'b': old['b']}
+    assert changes.changed == {'a': (old['a'], new['a'])}
+
+
+def test_since():
+    changelog = ChangeLog()
+    changelog.record(1, [{'image': 'a', 'change': 'image_added'}])
+    changelog.record(2, [{'image': 'b', 'change': 'image_added'}])
+    assert [entry['image'] for entry in changelog.since(0)] == ['a', 'b']
+    assert [entry['image'] for entry in changelog.since(1, changelog.epoch)] == ['b']
+    assert changelog.since(2, changelog.epoch) == []
+    assert changelog.since(1) is None
+
+
+def test_since_dropped_generation():
+    changelog = ChangeLog(max_entries=2)
+    for generation in range(1, 5):
+        changelog.record(generation, [{'image': str(generation), 'change': 'image_added'}])
+    assert changelog.since(1, changelog.epoch) is None
+    assert [entry['image'] for entry in changelog.since(3, changelog.epoch)] == ['4']
+
+
+def test_since_generation_from_before_a_restart():
+    changelog = ChangeLog()
+    assert changelog.since(5, changelog.epoch) is None
+    changelog.record(1, [{'image': 'a', 'change': 'image_added'}])
+    assert changelog.since(5, changelog.epoch) is None
+    assert changelog.since(1, changelog.epoch) == []
+    # Generations started over, but the epoch tells them apart
+    restarted = ChangeLog()
+    restarted.record(1, [{'image': 'b', 'change': 'image_added'}])
+    assert restarted.since(1, changelog.epoch) is None
+    assert ChangeLog.from_state(restarted.state()).since(0, None) == restarted.since(0)
+    assert ChangeLog.from_state(restarted.state()).epoch == restarted.epoch
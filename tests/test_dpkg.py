@@ -0,0 +1,88 @@
+import asyncio
+import os
+from systeminfo.info import System
+
+STATUS = '''Package: vim
+Status: install ok installed
+Architecture: amd64
+Version: 2:8.0.1453-1ubuntu1
+
+Package: mytool
+Status: install ok installed
+Architecture: amd64
+Version: 1.0
+
+Package: curl
+Status: install ok installed
+Architecture: amd64
+Version: 7.58.0-2ubuntu3
+
+Package: vim-runtime
+Status: install ok installed
+Architecture: all
+Version: 2:8.0.1453-1ubuntu1
+
+Package: nano
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 2.9.3-2
+
+'''
+EXTENDED_STATES = '''Package: vim-runtime
+Architecture: all
+Auto-Installed: 1
+
+'''
+MAIN = '''Package: curl
+Architecture: amd64
+Version: 7.58.0-2ubuntu3
+
+Package: vim
+Architecture: amd64
+Version: 2:8.0.1453-1ubuntu1
+
+Package: vim-runtime
+Architecture: all
+Version: 2:8.0.1453-1ubuntu1
+
+Package: emacs
+Architecture: all
+Version: 47.0
+
+'''
+UPDATES = '''Package: curl
+Architecture: amd64
+Version: 7.58.0-2ubuntu3.8
+
+'''
+# What `apt list --installed` prints on the same system
+APT_LIST = '''Listing...
+curl/bionic-updates 7.58.0-2ubuntu3.8 amd64 [upgradable from: 7.58.0-2ubuntu3]
+mytool/now 1.0 amd64 [installed,local]
+vim-runtime/bionic,now 2:8.0.1453-1ubuntu1 all [installed,automatic]
+vim/bionic,now 2:8.0.1453-1ubuntu1 amd64 [installed]
+'''
+
+
+def write(root, path, text):
+    path = os.path.join(str(root), path.lstrip('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def by_name(apps):
+    return sorted(apps, key=lambda app: app['name'])
+
+
+def test_installed_states_match_apt_list(tmp_path):
+    write(tmp_path, '/var/lib/dpkg/status', STATUS)
+    write(tmp_path, '/var/lib/apt/extended_states', EXTENDED_STATES)
+    write(tmp_path, '/var/lib/apt/lists/archive.ubuntu.com_ubuntu_dists_bionic_main_binary-amd64_Packages', MAIN)
+    write(tmp_path, '/var/lib/apt/lists/archive.ubuntu.com_ubuntu_dists_bionic-updates_main_binary-amd64_Packages', UPDATES)
+    expected = by_name(System._apt_list_helper(APT_LIST))
+    system = System(root=str(tmp_path), apt_backend='dpkg')
+    assert by_name(system.apt_installed()) == expected
+    assert by_name(asyncio.run(system.async_apt_installed())) == expected
+    assert [app['state'] for app in expected] == [
+        '[upgradable from: 7.58.0-2ubuntu3]', '[installed,local]', '[installed]', '[installed,automatic]']
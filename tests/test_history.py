@@ -0,0 +1,107 @@
+import gzip
+import os
+import subprocess
+from systeminfo.history import AptHistory, parse_packages, rotated_logs
+
+
+def entry(**fields):
+    lines = ['Start-Date: 2018-10-01  12:00:00']
+    lines.extend('{field}: {value}'.format(field=field.capitalize(), value=value) for field, value in fields.items())
+    lines.append('End-Date: 2018-10-01  12:00:05')
+    return '\n'.join(lines) + '\n\n'
+
+
+def append(path, text):
+    with open(path, 'a') as f:
+        f.write(text)
+
+
+def test_parse_packages():
+    value = 'vim:amd64 (2:8.0.1453-1ubuntu1), vim-runtime:all (2:8.0.1453-1ubuntu1, automatic), tzdata (2018e-0ubuntu1)'
+    assert list(parse_packages(value)) == [('vim', 'amd64', '2:8.0.1453-1ubuntu1', False),
+                                           ('vim-runtime', 'all', '2:8.0.1453-1ubuntu1', True),
+                                           ('tzdata', '', '2018e-0ubuntu1', False)]
+
+
+def test_update_only_reads_what_was_appended(tmp_path):
+    path = str(tmp_path / 'history.log')
+    append(path, entry(install='vim:amd64 (8.0), vim-runtime:all (8.0, automatic)'))
+    history = AptHistory(path)
+    history.update()
+    assert history.manual == {'vim': '8.0'}
+    offset = history.offset
+    assert offset == os.path.getsize(path) - 1
+    # An entry that is still being written waits for its end
+    append(path, 'Start-Date: 2018-10-02  12:00:00\nInstall: emacs:amd64 (25.2)\n')
+    history.update()
+    assert history.manual == {'vim': '8.0'} and history.offset == offset
+    append(path, 'End-Date: 2018-10-02  12:00:05\n\n' + entry(remove='vim:amd64 (8.0)'))
+    history.update()
+    assert history.manual == {'emacs': '25.2'} and history.offset > offset
+    # Nothing new, nothing read
+    history.manual['marker'] = '1'
+    history.update()
+    assert history.manual == {'emacs': '25.2', 'marker': '1'}
+
+
+def test_rotated_logs_are_read_oldest_first(tmp_path):
+    path = str(tmp_path / 'history.log')
+    append(path, entry(install='vim:amd64 (8.0)'))
+    history = AptHistory(path)
+    history.update()
+    # logrotate moves the log away, compresses older ones and starts a new one
+    with open(path, 'rb') as f, gzip.open(path + '.2.gz', 'wb') as rotated:
+        rotated.write(f.read())
+    os.remove(path)
+    append(path + '.1', entry(install='emacs:amd64 (25.2)') + entry(purge='vim:amd64 (8.0)'))
+    append(path, entry(install='vim:amd64 (8.1)'))
+    append(str(tmp_path / 'history.log.old'), entry(install='nano:amd64 (2.9)'))
+    assert rotated_logs(path) == [path + '.2.gz', path + '.1']
+    history.update()
+    assert history.manual == {'emacs': '25.2', 'vim': '8.1'}
+    assert list(history.manual) == ['emacs', 'vim']
+    assert history.offset == os.path.getsize(path) - 1
+
+
+def test_truncated_log_is_read_again(tmp_path):
+    path = str(tmp_path / 'history.log')
+    append(path, entry(install='vim:amd64 (8.0)') + entry(install='emacs:amd64 (25.2)'))
+    history = AptHistory(path)
+    history.update()
+    # copytruncate keeps the inode, the log only gets shorter
+    with open(path, 'r+') as f:
+        copied = f.read()
+        f.seek(0)
+        f.truncate()
+    append(path + '.1', copied)
+    append(path, entry(install='nano:amd64 (2.9)'))
+    history.update()
+    assert history.manual == {'vim': '8.0', 'emacs': '25.2', 'nano': '2.9'}
+
+
+def test_gone_log_forgets_everything(tmp_path):
+    path = str(tmp_path / 'history.log')
+    append(path, entry(install='vim:amd64 (8.0)'))
+    history = AptHistory(path)
+    history.update()
+    os.remove(path)
+    history.update()
+    assert history.manual == {} and history.offset == 0
+
+
+def test_command_prints_what_update_reads(tmp_path):
+    path = str(tmp_path / 'history.log')
+    with gzip.open(path + '.10.gz', 'wt') as f:
+        f.write(entry(install='vim:amd64 (7.4)'))
+    with gzip.open(path + '.2.gz', 'wt') as f:
+        f.write(entry(install='vim:amd64 (8.0), emacs:amd64 (25.1)'))
+    append(path + '.1', entry(remove='emacs:amd64 (25.1)'))
+    append(path, entry(install='nano:amd64 (2.9)'))
+    history = AptHistory(path)
+    history.update()
+    fed = AptHistory(path)
+    fed.feed(subprocess.run(history.command(), shell=True, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines())
+    assert fed.manual == history.manual == {'vim': '8.0', 'nano': '2.9'}
+    # Without a log there is nothing to print
+    assert subprocess.run(AptHistory(str(tmp_path / 'none' / 'history.log')).command(), shell=True, check=True,
+                          stdout=subprocess.PIPE).stdout == b''
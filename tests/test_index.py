@@ -0,0 +1,99 @@
+import asyncio
+from systeminfo.index import GlobalIndex, NameIndex
+from systeminfo.info import System
+
+
+def packages(*names):
+    return {name: {'from': 'apt', 'name': name, 'version': '1.0'} for name in names}
+
+
+def test_find_shortest_first():
+    index = NameIndex(['python3-numpy', 'python3', 'libpython3.6', 'vim'])
+    assert index.find('python3') == ['python3', 'libpython3.6', 'python3-numpy']
+    assert index.find('vim', match=True) == ['vim']
+    assert index.find('vi', match=True) == []
+
+
+def test_name_index_is_built_on_the_first_search():
+    system = System(compact=True)
+    system.update_dict(packages('vim', 'vim-runtime', 'python3'))
+    GlobalIndex({'image': system}).find('vim')
+    assert system._index is None
+    assert [app['name'] for app in system.search('vim')] == ['vim', 'vim-runtime']
+    assert system._index is not None
+    # A built index is kept up to date
+    system.update_dict(packages('vim', 'neovim', 'python3'))
+    assert [app['name'] for app in system.search('vim')] == ['vim', 'neovim']
+    # And dropped with the dictionary it indexes
+    system.dict = packages('emacs')
+    assert system._index is None
+    assert system.search('vim') == []
+
+
+def test_async_search_builds_the_index_in_a_thread():
+    system = System(executor='thread')
+    system.update_dict(packages('vim', 'python3'))
+    assert asyncio.run(system.async_search('vim')) == [packages('vim')['vim']]
+    assert 'vim' in system._index
+
+
+def test_published_systems_search_the_global_index():
+    systems = {}
+    for system_name, names in (('a', ('vim', 'vim-runtime', 'python3')), ('b', ('neovim', 'vim'))):
+        systems[system_name] = System(executor='thread')
+        systems[system_name].update_dict(packages(*names))
+    index = GlobalIndex(systems)
+    expected = {system_name: (info.search('vim'), info.query('vim | python3')) for system_name, info in systems.items()}
+    for system_name, info in systems.items():
+        info.share_index(index, system_name)
+        assert info._index is None
+
+    async def run():
+        for system_name, info in systems.items():
+            assert (await info.async_search('vim'), await info.async_query('vim | python3')) == expected[system_name]
+            assert await info.async_search('vim-runtime', match=True) == info.search('vim-runtime', match=True)
+            assert info._index is None
+    asyncio.run(run())
+    assert systems['b'].query('python3') is None
+
+
+def per_system(systems, term, version='', match=False):
+    # What searching every system on its own finds
+    found = {system_name: info.search(term, version=version, match=match) for system_name, info in systems.items()}
+    return {system_name: apps for system_name, apps in found.items() if apps}
+
+
+def test_global_index_finds_what_each_system_would():
+    systems = {'a': System(), 'b': System(), 'c': System()}
+    systems['a'].update_dict(packages('vim', 'vim-runtime', 'python3'))
+    systems['b'].update_dict(packages('neovim', 'python3-numpy'))
+    systems['c'].update_dict({'vim': {'from': 'apt', 'name': 'vim', 'version': '2.0'}})
+    index = GlobalIndex(systems)
+    for term, version, match in (('vim', '', False), ('vim', '2', False), ('python3', '', False), ('vim', '', True), ('emacs', '', False)):
+        assert index.find(term, version=version, match=match) == per_system(systems, term, version, match)
+    assert index.count('vim') == 2 and index.count('emacs') == 0
+    # Systems that match every term, in the order they were indexed
+    assert list(index.search([('vim', ''), ('python3', '')])) == ['a', 'b']
+    assert list(index.search([('vim', ''), ('numpy', '')])) == ['b']
+    assert list(index.search([('vim', '')])) == ['a', 'b', 'c']
+    assert index.search([('vim', ''), ('emacs', '')]) == {}
+
+
+def test_global_index_applies_changes():
+    systems = {'a': System(), 'b': System()}
+    systems['a'].update_dict(packages('vim', 'python3'))
+    systems['b'].update_dict(packages('vim'))
+    index = GlobalIndex(systems)
+    index.apply('a', systems['a'].update_dict(dict(packages('python3', 'neovim'), vim={'from': 'apt', 'name': 'vim', 'version': '2.0'})))
+    systems['c'] = System()
+    index.apply('c', systems['c'].update_dict(packages('vim-tiny')))
+    index.apply('b', systems['b'].update_dict(packages('emacs')))
+    for term in ('vim', 'neovim', 'python3', 'emacs'):
+        assert index.find(term) == per_system(systems, term)
+    assert index.find('vim', version='2') == {'a': [systems['a'].dict['vim']]}
+    # Removing a system drops the names only it had
+    index.remove('a')
+    assert index.find('python3') == {} and 'neovim' not in index.names
+    assert list(index.find('vim')) == ['c']
+    index.reorder(['c', 'b'])
+    assert index.system_names() == ['c', 'b']
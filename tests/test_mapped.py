@@ -0,0 +1,117 @@
+import asyncio
+import os
+import sys
+import pytest
+from systeminfo import mapped, query
+from systeminfo.index import GlobalIndex
+from systeminfo.info import System
+
+
+def image(packages):
+    system = System()
+    system.update_dict({name: {'from': 'pip', 'name': name, 'version': version} for name, version in packages.items()})
+    return system
+
+
+IMAGES = {
+    'old': {'numpy': '1.14.0', 'scipy': '1.0.0', 'vim': '8.0'},
+    'new': {'numpy': '1.16.2', 'pandas': '0.24.1'},
+}
+
+
+def test_written_index_answers_like_the_global_index(tmp_path):
+    index = GlobalIndex({image_name: image(packages) for image_name, packages in IMAGES.items()})
+    path = str(tmp_path / 'index')
+    systems, packages = mapped.freeze(index)
+    mapped.write(path, systems, packages, generation=3, meta={'snapshot': True})
+    with mapped.MappedIndex(path) as written:
+        assert written.generation == 3 and written.meta == {'snapshot': True}
+        assert written.system_names() == ['old', 'new']
+        for text in ('numpy', 'numpy>=1.15', 'py', 'vim | pandas', '!scipy'):
+            node = query.parse(text)
+            assert written.query(node) == index.query(node)
+
+
+def test_retired_index_is_closed_after_the_last_search(tmp_path):
+    index = GlobalIndex({image_name: image(packages) for image_name, packages in IMAGES.items()})
+    path = str(tmp_path / 'index')
+    mapped.write(path, *mapped.freeze(index))
+    written = mapped.MappedIndex(path)
+    with mapped.using(written):
+        results = written.iter_query(query.parse('numpy'))
+        assert next(results)[0] == 'old'
+        written.retire()
+        assert not written.mmap.closed
+        assert next(results)[0] == 'new'
+    assert written.mmap.closed
+    with mapped.using(index):
+        pass
+
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('aiohttp_jinja2')
+from aiohttp import web
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web'))
+import app as webapp
+from api import keys
+from api.cache import ResponseCache
+
+
+def server_app(path):
+    # What the refresher and the workers need, without mounting the api
+    app = web.Application()
+    app[keys.STATE] = keys.State()
+    app[keys.RESPONSE_CACHE] = ResponseCache(max_bytes=1024 * 1024)
+    app[keys.INDEX_PATH] = path
+    return app
+
+
+def test_index_path_follows_the_port(monkeypatch):
+    monkeypatch.delenv('SYSTEMINFO_INDEX_PATH', raising=False)
+    monkeypatch.setenv('SYSTEMINFO_PORT', '9001')
+    assert os.path.basename(webapp.index_path()) == 'systeminfo-9001.index'
+    monkeypatch.setenv('SYSTEMINFO_INDEX_PATH', '/tmp/elsewhere.index')
+    assert webapp.index_path() == '/tmp/elsewhere.index'
+
+
+def test_workers_follow_what_the_refresher_writes(tmp_path, monkeypatch):
+    monkeypatch.setenv('SYSTEMINFO_INDEX_DELAY', '0')
+    monkeypatch.setenv('SYSTEMINFO_INDEX_POLL', '0.02')
+    monkeypatch.setenv('SYSTEMINFO_INDEX_CHANGES', '2')
+    path = str(tmp_path / 'systeminfo.index')
+    refresher = server_app(path)
+    worker = server_app(path)
+
+    async def wait_for(generation):
+        for _ in range(200):
+            if worker[keys.STATE].generation == generation:
+                return
+            await asyncio.sleep(0.02)
+        raise AssertionError("The worker never served generation {generation}".format(generation=generation))
+
+    async def run():
+        refresher[keys.INDEX_DUE] = asyncio.Event()
+        tasks = [asyncio.ensure_future(webapp.write_index(refresher)), asyncio.ensure_future(webapp.follow_index(worker))]
+        try:
+            images = {image_name: image(packages) for image_name, packages in IMAGES.items()}
+            webapp.publish(refresher, images)
+            await wait_for(1)
+            first = worker[keys.STATE].index
+            assert first.query(query.parse('pandas')) == {'new': {'pandas': {'from': 'pip', 'name': 'pandas', 'version': '0.24.1'}}}
+            webapp.publish(refresher, {'new': images['new'], 'newer': image({'pandas': '1.0.0'})})
+            await wait_for(2)
+            # The old map was closed once the new one was served
+            assert first.mmap.closed
+            assert list(worker[keys.STATE].index.query(query.parse('pandas'))) == ['new', 'newer']
+            changelog = worker[keys.STATE].changelog
+            assert changelog.epoch == refresher[keys.STATE].changelog.epoch
+            # Only the last two changes were written, those of generation 2
+            assert len(refresher[keys.STATE].changelog.entries) == 4 and len(changelog.entries) == 2
+            assert [change['change'] for change in changelog.since(1, changelog.epoch)] == ['image_removed', 'image_added']
+            assert changelog.since(0) is None
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks)
+            worker[keys.STATE].index.close()
+    asyncio.run(run())
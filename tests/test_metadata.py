@@ -0,0 +1,86 @@
+import os
+from systeminfo import metadata
+from systeminfo.info import System
+
+
+def write(root, path, text):
+    path = os.path.join(str(root), path.lstrip('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def dist(root, site, name, version):
+    write(root, '{site}/{name}-{version}.dist-info/METADATA'.format(site=site, name=name, version=version),
+          'Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n\nDescription\n'.format(name=name, version=version))
+
+
+def two_pythons(root):
+    dist(root, '/usr/lib/python2.7/dist-packages', 'setuptools', '41.2.0')
+    dist(root, '/usr/lib/python2.7/dist-packages', 'futures', '3.3.0')
+    dist(root, '/usr/local/lib/python3.11/dist-packages', 'setuptools', '65.5.0')
+    dist(root, '/usr/lib/python3/dist-packages', 'six', '1.16.0')
+    dist(root, '/usr/lib/python3.12/dist-packages', 'setuptools', '68.1.2')
+    write(root, '/usr/bin/python2.7', '')
+    write(root, '/usr/bin/python3.11', '')
+    write(root, '/usr/bin/python3.12', '')
+    os.symlink('python3.11', os.path.join(str(root), 'usr/bin/python3'))
+
+
+def test_only_the_sites_of_pips_python(tmp_path):
+    two_pythons(tmp_path)
+    write(tmp_path, '/usr/bin/pip', '#!/usr/bin/python3\nimport pip\n')
+    system = System(root=str(tmp_path), pip_backend='metadata')
+    assert system._pip_interpreter() == '/usr/bin/python3.11'
+    assert system.pip_list() == [{'name': 'setuptools', 'version': '65.5.0', 'from': 'pip'},
+                                 {'name': 'six', 'version': '1.16.0', 'from': 'pip'}]
+
+
+def test_env_shebang(tmp_path):
+    two_pythons(tmp_path)
+    write(tmp_path, '/usr/local/bin/pip', '#!/usr/bin/env python2.7\nimport pip\n')
+    system = System(root=str(tmp_path), pip_backend='metadata')
+    assert system._pip_interpreter() == '/usr/bin/python2.7'
+    assert system.pip_list() == [{'name': 'futures', 'version': '3.3.0', 'from': 'pip'},
+                                 {'name': 'setuptools', 'version': '41.2.0', 'from': 'pip'}]
+
+
+def test_pyenv_shim(tmp_path):
+    dist(tmp_path, '/root/.pyenv/versions/2.7.18/lib/python2.7/site-packages', 'setuptools', '41.2.0')
+    dist(tmp_path, '/root/.pyenv/versions/3.11.7/lib/python3.11/site-packages', 'setuptools', '65.5.0')
+    write(tmp_path, '/root/.pyenv/versions/3.11.7/bin/python3.11', '')
+    os.symlink('python3.11', os.path.join(str(tmp_path), 'root/.pyenv/versions/3.11.7/bin/python'))
+    write(tmp_path, '/root/.pyenv/version', '3.11.7\n')
+    write(tmp_path, '/root/.pyenv/shims/pip', '#!/usr/bin/env bash\nexec pyenv exec pip "$@"\n')
+    system = System(root=str(tmp_path), pip_backend='metadata')
+    system.PIP_SCRIPTS = ('/root/.pyenv/shims/pip',) + system.PIP_SCRIPTS
+    assert system._pip_interpreter() == '/root/.pyenv/versions/3.11.7/bin/python3.11'
+    assert system.pip_list() == [{'name': 'setuptools', 'version': '65.5.0', 'from': 'pip'}]
+
+
+def test_without_pip_the_newest_python_wins(tmp_path):
+    two_pythons(tmp_path)
+    system = System(root=str(tmp_path), pip_backend='metadata')
+    assert system._pip_interpreter() is None
+    assert system.pip_list() == [{'name': 'futures', 'version': '3.3.0', 'from': 'pip'},
+                                 {'name': 'setuptools', 'version': '68.1.2', 'from': 'pip'},
+                                 {'name': 'six', 'version': '1.16.0', 'from': 'pip'}]
+
+
+def test_command_output_is_ranked_the_same():
+    marker = System._METADATA_MARKER
+    text = ''.join('{marker}{path}\nName: {name}\nVersion: {version}\n\n'.format(marker=marker, path=path, name=name, version=version)
+                   for path, name, version in (
+                       ('/usr/lib/python2.7/dist-packages/setuptools-41.2.0.egg-info', 'setuptools', '41.2.0'),
+                       ('/usr/local/lib/python3.11/dist-packages/setuptools-65.5.0.dist-info/METADATA', 'setuptools', '65.5.0')))
+    assert metadata.pip_list(System._command_distributions(text)) == [{'name': 'setuptools', 'version': '65.5.0'}]
+    text = '{marker}python /usr/bin/python2.7\n'.format(marker=marker) + text
+    assert metadata.pip_list(System._command_distributions(text)) == [{'name': 'setuptools', 'version': '41.2.0'}]
+
+
+def test_select_sites():
+    sites = ['/usr/local/lib/python3.11/dist-packages', '/usr/lib/python3/dist-packages',
+             '/usr/lib/python3.11/dist-packages', '/usr/lib/python3.12/dist-packages', '/opt/venv/lib/python3.12/site-packages']
+    assert metadata.select_sites(sites, '/usr/bin/python3.11') == sites[:3]
+    assert metadata.select_sites(sites, '/opt/venv/bin/python3.12') == sites[4:]
+    assert metadata.select_sites(sites) == [sites[3], sites[4], sites[0], sites[2], sites[1]]
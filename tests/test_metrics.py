@@ -0,0 +1,109 @@
+import asyncio
+import concurrent.futures
+import os
+import sys
+import pytest
+from systeminfo import metrics
+from systeminfo.info import System
+
+
+def test_threads_that_come_and_go_are_all_counted():
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', "Test")
+    histogram = registry.histogram('test_seconds', "Test", buckets=(1, 2))
+    for _ in range(20):
+        # Like `get_all_installed`, every call has threads of its own
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda i: (counter.inc(), histogram.observe(i % 3)), range(40)))
+    assert counter.value() == 800
+    assert histogram.value() == ([540, 800], 800, 780)
+    assert 'test_seconds_bucket{le="1"} 540' in registry.exposition()
+
+
+def test_stopwatch_only_counts_what_it_timed():
+    histogram = metrics.Registry().histogram('test_seconds', "Test", buckets=(0.05,))
+    stopwatch = histogram.stopwatch()
+    for _ in range(3):
+        with stopwatch:
+            pass
+        asyncio.run(asyncio.sleep(0.03))
+    stopwatch.observe()
+    counts, count, total = histogram.value()
+    assert counts == [1] and count == 1 and total < 0.01
+
+
+def test_streamed_output_is_timed():
+    system = System()
+    output = '[{"name": "numpy", "version": "1.16.2"}, {"name": "scipy", "version": "1.2.1"}]'
+
+    async def chunks(command, check=True):
+        for i in range(0, len(output), 7):
+            await asyncio.sleep(0.01)
+            yield output[i:i + 7]
+    system.async_iter_command_chunks = chunks
+    _, before, _ = metrics.PARSE_DURATION.labels('stream_pip_json').value()
+    lst = asyncio.run(system.async_pip_list())
+    assert [app['name'] for app in lst] == ['numpy', 'scipy']
+    _, after, _ = metrics.PARSE_DURATION.labels('stream_pip_json').value()
+    assert after == before + 1
+
+
+def test_exposition():
+    registry = metrics.Registry()
+    registry.counter('test_total', "Counted", ('command',)).labels('say "hi"\n').inc(2)
+    gauge = registry.gauge('test_images', "Images", ('image',))
+    gauge.labels('one').set(3)
+    gauge.labels('two').set(1.5)
+    gauge.remove('two')
+    histogram = registry.histogram('test_seconds', "Timed", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(5)
+    assert registry.exposition() == '\n'.join([
+        '# HELP test_images Images',
+        '# TYPE test_images gauge',
+        'test_images{image="one"} 3',
+        '# HELP test_seconds Timed',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 1',
+        'test_seconds_bucket{le="+Inf"} 2',
+        'test_seconds_sum 5.05',
+        'test_seconds_count 2',
+        '# HELP test_total Counted',
+        '# TYPE test_total counter',
+        'test_total{command="say \\"hi\\"\\n"} 2',
+    ]) + '\n'
+
+
+def test_metrics_endpoint():
+    pytest.importorskip('aiohttp')
+    pytest.importorskip('aiohttp_jinja2')
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web'))
+    import app as webapp
+    from api import keys
+    from api.cache import ResponseCache
+    from api.search import Search
+
+    application = web.Application()
+    application[keys.STATE] = keys.State()
+    application[keys.RESPONSE_CACHE] = ResponseCache()
+    application.add_routes([web.get('/metrics', webapp.metrics), web.get('/search', Search)])
+    images = {}
+    for image_name in ('a', 'b'):
+        images[image_name] = System()
+        images[image_name].update_dict({'numpy': {'from': 'pip', 'name': 'numpy', 'version': '1.16.2'}})
+    webapp.publish(application, images)
+
+    async def run():
+        async with TestClient(TestServer(application)) as client:
+            _, before, _ = metrics.SEARCH_DURATION.labels('json').value()
+            await client.get('/search', params={'query': 'numpy', 'format': 'json'})
+            response = await client.get('/metrics')
+            assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+            lines = (await response.text()).splitlines()
+            assert 'systeminfo_generation 1' in lines and 'systeminfo_images 2' in lines
+            assert 'systeminfo_search_seconds_count{{format="json"}} {count}'.format(count=before + 1) in lines
+            assert any(line.startswith('systeminfo_response_cache_bytes ') and not line.endswith(' 0') for line in lines)
+    asyncio.run(run())
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import pytest
+from systeminfo import offload
+from systeminfo.info import System
+from test_dpkg import APT_LIST
+
+PIP_LIST = json.dumps([{'name': 'six', 'version': '1.16.0'}, {'name': 'numpy', 'version': '1.16.2'}])
+
+
+class Canned(System):
+    """
+    Answers `apt list` and `pip list` with canned output
+    """
+    def _text(self, command):
+        return APT_LIST if command.startswith('apt list') else PIP_LIST
+
+    async def async_get_command_text(self, command, check=True):
+        return self._text(command)
+
+    async def async_iter_command_chunks(self, command, check=True, size=64 * 1024):
+        text = self._text(command)
+        for i in range(0, len(text), 7):
+            yield text[i:i + 7]
+
+
+def test_pack_round_trip():
+    apps = [{'name': 'vim', 'version': '8.0', 'arch': 'amd64'}, {'name': 'curl', 'version': '8.0', 'arch': 'amd64'},
+            {'version': '1.0', 'name': 'six', 'from': None}, {}]
+    strings, layouts, ids = packed = offload.pack(apps)
+    assert offload.unpack(packed) == apps
+    # Every value and every key order is sent once
+    assert strings.count('8.0') == 1 and strings.count('amd64') == 1
+    assert len([layout for layout in layouts if layout is not None]) == 3
+    assert [list(app) for app in offload.unpack(packed)] == [list(app) for app in apps]
+
+
+def test_get_executor():
+    assert offload.get_executor(None) is None
+    assert offload.get_executor('thread') is offload.get_executor('thread')
+    with pytest.raises(ValueError):
+        offload.get_executor('fiber')
+    with pytest.raises(ValueError):
+        System(executor='fiber')
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_offloaded_parsing_matches_the_loop(executor):
+    async def collect(system):
+        return await system.async_apt_list(), await system.async_pip_list()
+    expected = asyncio.run(collect(Canned()))
+    assert [app['name'] for app in expected[0]] == ['curl', 'mytool', 'vim-runtime', 'vim']
+    assert asyncio.run(collect(Canned(executor=executor))) == expected
@@ -0,0 +1,109 @@
+import asyncio
+import subprocess
+import threading
+import time
+import pytest
+from systeminfo.process import ProcessPool, split_command
+from test_remote import left_running
+
+
+def test_split_command():
+    assert split_command('dpkg -l') == (['dpkg', '-l'], False)
+    assert split_command("grep -e 'a b' status") == (['grep', '-e', 'a b', 'status'], False)
+    assert split_command(['ls', '*']) == (['ls', '*'], False)
+    for command in ('ls | wc -l', 'ls *.py', 'echo $HOME', 'LANG=C dpkg -l', "echo 'unclosed"):
+        assert split_command(command) == (command, True)
+    assert split_command('ls *.py', shell=False) == (['ls', '*.py'], False)
+
+
+def test_run_kills_the_whole_group_when_it_times_out():
+    pool = ProcessPool(2)
+    assert pool.run('echo one; echo two >&2', stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout == b'one\n'
+    assert pool.run(['printf', 'three'], stdout=subprocess.PIPE).stdout == b'three'
+    with pytest.raises(subprocess.TimeoutExpired):
+        # The shell's children are in its group, and go with it
+        pool.run('sleep 1020 & sleep 1021; wait', timeout=0.3)
+    assert left_running('sleep 102') == []
+    assert pool.stats() == {'max_processes': 2, 'running': 0, 'waiting': 0, 'started': 3, 'killed': {'timeout': 1}}
+
+
+def test_threads_share_the_slots():
+    pool = ProcessPool(2)
+    most = []
+
+    def run():
+        pool.run('sleep 0.2')
+        most.append(pool.stats()['running'])
+    started = time.monotonic()
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    assert pool.stats()['running'] == 2 and pool.stats()['waiting'] == 2
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - started >= 0.4
+    assert max(most) <= 2 and pool.stats()['running'] == 0 and pool.stats()['started'] == 4
+
+
+def test_coroutines_wait_for_a_slot():
+    pool = ProcessPool(2)
+    most = 0
+
+    async def run(i):
+        nonlocal most
+        process = await pool.start(['sh', '-c', 'sleep 0.2; echo {i}'.format(i=i)], stdout=asyncio.subprocess.PIPE)
+        most = max(most, pool.stats()['running'])
+        stdout, _ = await pool.communicate(process)
+        return stdout
+
+    async def main():
+        started = asyncio.get_running_loop().time()
+        results = await asyncio.gather(*(run(i) for i in range(5)))
+        return results, asyncio.get_running_loop().time() - started
+    results, elapsed = asyncio.run(main())
+    assert results == [b'0\n', b'1\n', b'2\n', b'3\n', b'4\n']
+    assert elapsed >= 0.6 and most == 2
+    assert pool.stats() == {'max_processes': 2, 'running': 0, 'waiting': 0, 'started': 5, 'killed': {}}
+
+
+def test_communicate_kills_the_group_when_it_times_out_or_is_cancelled():
+    pool = ProcessPool(2)
+
+    async def main():
+        process = await pool.start('sleep 1030 & sleep 1031; wait')
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.communicate(process, timeout=0.3)
+        assert process.returncode is not None
+        process = await pool.start('sleep 1032 & sleep 1033; wait')
+        task = asyncio.ensure_future(pool.communicate(process))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Abandoning it again doesn't kill or count it twice
+        await pool.abandon(process)
+    asyncio.run(main())
+    assert left_running('sleep 103') == []
+    assert pool.stats() == {'max_processes': 2, 'running': 0, 'waiting': 0, 'started': 2, 'killed': {'timeout': 1, 'cancelled': 1}}
+
+
+def test_cancelled_while_waiting_takes_no_slot():
+    pool = ProcessPool(1)
+
+    async def main():
+        blocking = await pool.start('sleep 0.3')
+        waiting = asyncio.ensure_future(pool.start('echo never'))
+        await asyncio.sleep(0.1)
+        assert pool.stats()['waiting'] == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        await pool.communicate(blocking)
+        # The slot is free for the next command
+        process = await asyncio.wait_for(pool.start(['true']), 1)
+        await pool.communicate(process)
+        await process.exited
+    asyncio.run(main())
+    assert pool.stats() == {'max_processes': 1, 'running': 0, 'waiting': 0, 'started': 2, 'killed': {}}
+    assert pool.slots.used == 0
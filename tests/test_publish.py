@@ -0,0 +1,119 @@
+import asyncio
+import os
+import subprocess
+import sys
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('aiohttp_jinja2')
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from systeminfo.info import System
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web'))
+import app as webapp
+from api import keys
+from api.cache import ResponseCache
+from api.changes import Changes
+
+
+def publishing_app():
+    # Only the state publishing needs, `create_app` mounts subapps that can't be mounted twice
+    app = web.Application()
+    app[keys.STATE] = keys.State()
+    app[keys.RESPONSE_CACHE] = ResponseCache(max_bytes=1024 * 1024)
+    return app
+
+
+def image(name):
+    system = System()
+    system.update_dict({name: {'from': 'pip', 'name': name, 'version': '1.0'}})
+    return system
+
+
+def test_first_refreshes_are_published_together(monkeypatch):
+    monkeypatch.setenv('SYSTEMINFO_PUBLISH_DELAY', '0.05')
+    application = publishing_app()
+
+    async def run():
+        images = {'image{i:02}'.format(i=i): image('package{i}'.format(i=i)) for i in range(50)}
+        for image_name, info in images.items():
+            webapp.publish_refreshed(application, image_name, info)
+        assert application[keys.STATE].generation == 0
+        await asyncio.sleep(0.2)
+        assert application[keys.STATE].generation == 1
+        assert list(application[keys.STATE].images) == list(images)
+        assert len(application[keys.STATE].changelog.since(0)) == 50
+        # Already served, it waits for the end of the cycle
+        webapp.publish_refreshed(application, 'image00', image('package0'))
+        webapp.publish_refreshed(application, 'late', image('late'))
+        # The end of the cycle publishes everything, nothing is left to publish after it
+        webapp.publish(application, dict(images, late=image('late')))
+        assert application[keys.STATE].generation == 2 and application[keys.STATE].unpublished == {}
+        await asyncio.sleep(0.2)
+        assert application[keys.STATE].generation == 2
+    asyncio.run(run())
+
+
+def changes_app(images):
+    application = publishing_app()
+    application.router.add_view('/changes', Changes)
+    webapp.publish(application, images)
+    return application
+
+
+def test_changes_from_before_a_restart_are_gone():
+    async def run():
+        async with TestClient(TestServer(changes_app({'a': image('a')}))) as client:
+            response = await client.get('/changes', params={'since': '0'})
+            body = await response.json()
+            assert body['generation'] == 1 and [change['image'] for change in body['changes']] == ['a']
+            since = '{epoch}:{generation}'.format(**body)
+            response = await client.get('/changes', params={'since': since})
+            assert (await response.json())['changes'] == []
+            # A bare generation could be from any epoch
+            response = await client.get('/changes', params={'since': '1'})
+            assert response.status == 400
+        # The restarted server published a generation 1 of its own
+        async with TestClient(TestServer(changes_app({'b': image('b')}))) as client:
+            response = await client.get('/changes', params={'since': since})
+            assert response.status == 410
+    asyncio.run(run())
+
+
+def test_ready_once_the_snapshots_are_published(tmp_path, monkeypatch):
+    from systeminfo.cache import InventoryCache
+    from systeminfo.info import Singularity
+    cache = InventoryCache()
+    paths = {}
+    for image_name in ('known', 'new'):
+        paths[image_name] = str(tmp_path / (image_name + '.sif'))
+        with open(paths[image_name], 'w') as f:
+            f.write(image_name)
+    cache.put(paths['known'], {'vim': {'from': 'apt', 'name': 'vim', 'version': '8.0'}})
+    # Only the known image has a snapshot, the new one waits for its refresh
+    monkeypatch.setattr(webapp, 'discover_images', lambda app: {image_name: Singularity(path, cache=cache) for image_name, path in paths.items()})
+    application = publishing_app()
+    application.add_routes([web.get('/live', webapp.live), web.get('/ready', webapp.ready)])
+
+    async def run():
+        async with TestClient(TestServer(application)) as client:
+            response = await client.get('/live')
+            assert response.status == 200 and (await response.json())['live']
+            response = await client.get('/ready')
+            assert response.status == 503 and not (await response.json())['ready']
+            await webapp.load_snapshots(application)
+            response = await client.get('/ready')
+            assert response.status == 200
+            assert await response.json() == {'ready': True, 'generation': 1, 'images': 1, 'snapshot': True, 'refreshed': False}
+            assert list(application[keys.STATE].images) == ['known']
+    asyncio.run(run())
+
+
+def test_importing_the_package_loads_nothing_heavy():
+    code = 'import sys, systeminfo, systeminfo.metrics, systeminfo.info; print(" ".join(sorted(sys.modules)))'
+    modules = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.split()
+    assert 'systeminfo.info' in modules
+    for module in ('asyncio', 'subprocess', 'concurrent.futures', 'systeminfo.remote', 'systeminfo.squashfs', 'systeminfo.index'):
+        assert module not in modules
@@ -0,0 +1,84 @@
+import pytest
+from systeminfo import query
+from systeminfo.index import GlobalIndex
+from systeminfo.info import System
+
+
+def test_precedence():
+    # Not binds tightest, then and, then or
+    assert str(query.parse('a | b, c')) == 'a|(b,c)'
+    assert str(query.parse('NOT a OR b AND c')) == '!a|(b,c)'
+    assert str(query.parse('!a b')) == '!a,b'
+    assert str(query.parse('(a | b) & c')) == '(a|b),c'
+    assert str(query.parse('!(a | b)')) == '!(a|b)'
+    assert query.parse('vim,') == query.Term('vim')
+    assert query.parse('"vim" python3*>=3.6').children == [query.Term('vim', 'exact'), query.Term('python3', 'prefix', '>=', '3.6')]
+    # A name with an empty version matches any version
+    assert query.parse('vim=') == query.Term('vim')
+
+
+@pytest.mark.parametrize('text', ['', '   ', '(vim', 'vim)', 'vim |', '!', '""', 'numpy~=1', 'vim|,'])
+def test_invalid_queries(text):
+    with pytest.raises(query.QueryError):
+        query.parse(text)
+
+
+def matches(text, version, scheme='apt'):
+    return query.parse('x' + text).version_matches({'from': scheme, 'name': 'x', 'version': version})
+
+
+def test_version_operators():
+    assert matches('=3', '3.6.5-3') and not matches('=3', '2.7.3') and not matches('=3', '36')
+    assert matches('=1.2', '1:1.2-1') and not matches('=1:1.2', '1.2')
+    assert matches('==1.0', '1.0') and not matches('==1.0', '1.0-1')
+    assert matches('!=1.0', '1.1') and matches('!=1.0', None)
+    assert matches('<1.0', '1.0~rc1') and matches('>=1.0', '1.0+b1') and matches('>2', '10', 'pip')
+    # pip versions compare by PEP 440, a pre-release is before its release
+    assert matches('<1.0', '1.0rc1', 'pip') and matches('>1.0', '1.0.post1', 'pip') and matches('==1.0', '1.0.0', 'pip')
+
+
+@pytest.mark.parametrize('version, spec, scheme, expected', [
+    ('1.15.4', '1.15', 'pip', True),
+    ('1.16', '1.15', 'pip', True),
+    ('2.0', '1.15', 'pip', False),
+    ('1.14', '1.15', 'pip', False),
+    ('1.15.4', '1.15.0', 'pip', True),
+    ('1.16.0', '1.15.0', 'pip', False),
+    ('1.15rc1', '1.15', 'pip', False),
+    # Without PEP 440 the last part of the upstream version is dropped
+    ('1:1.16-1', '1.15-1', 'apt', True),
+    ('2.0-1', '1.15-1', 'apt', False),
+    ('1.15.2-1', '1.15.1', 'apt', True),
+    ('1.16', '1.15.1', 'apt', False),
+])
+def test_compatible_release(version, spec, scheme, expected):
+    assert matches('~=' + spec, version, scheme) is expected
+
+
+def test_query_runs_against_systems():
+    systems = {name: System() for name in 'abc'}
+    systems['a'].update_dict({'vim': {'from': 'apt', 'name': 'vim', 'version': '2:8.0-1'},
+                              'python2.7': {'from': 'apt', 'name': 'python2.7', 'version': '2.7.15-1'}})
+    systems['b'].update_dict({'emacs': {'from': 'apt', 'name': 'emacs', 'version': '25.2-1'},
+                              'numpy': {'from': 'pip', 'name': 'numpy', 'version': '1.15.4'}})
+    systems['c'].update_dict({'vim-tiny': {'from': 'apt', 'name': 'vim-tiny', 'version': '2:8.0-1'},
+                              'numpy': {'from': 'pip', 'name': 'numpy', 'version': '1.16.0'}})
+    index = GlobalIndex(systems)
+
+    def found(text):
+        results = query.run(query.parse(text), index)
+        # A query runs the same against one system
+        for system_name, info in systems.items():
+            assert info.query(text) == results.get(system_name)
+        return {system_name: sorted(apps) for system_name, apps in results.items()}
+
+    assert found('(vim | emacs), !python2*') == {'b': ['emacs'], 'c': ['vim-tiny']}
+    assert found('"vim" | numpy~=1.15.0') == {'a': ['vim'], 'b': ['numpy']}
+    assert found('vim=8.0') == {'a': ['vim'], 'c': ['vim-tiny']}
+    assert found('numpy>=1.15 !emacs') == {'c': ['numpy']}
+    # A negation on its own keeps the systems, with no packages
+    assert found('NOT vim') == {'b': []}
+    # A batch shares its terms and finds what each query finds alone
+    texts = ['numpy>=1.15', 'numpy>=1.15, vim', 'emacs | numpy>=1.15']
+    batch = [dict(results) for results in query.iter_batch([query.parse(text) for text in texts], index)]
+    assert batch == [query.run(query.parse(text), index) for text in texts]
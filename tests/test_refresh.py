@@ -0,0 +1,61 @@
+import asyncio
+from systeminfo.refresh import default_concurrency, refresh
+
+
+class FakeSystem:
+    """
+    Answers async_get_dict after a delay per attempt, an exception in delays is raised instead
+    """
+    running = 0
+    most = 0
+
+    def __init__(self, *delays):
+        self.delays = list(delays)
+        self.attempts = 0
+
+    async def async_get_dict(self, long=True):
+        delay = self.delays[min(self.attempts, len(self.delays) - 1)]
+        self.attempts += 1
+        FakeSystem.running += 1
+        FakeSystem.most = max(FakeSystem.most, FakeSystem.running)
+        try:
+            if isinstance(delay, Exception):
+                raise delay
+            await asyncio.sleep(delay)
+            return {'vim': {'name': 'vim'}}
+        finally:
+            FakeSystem.running -= 1
+
+
+def test_refresh_runs_a_bounded_number_at_once():
+    FakeSystem.most = 0
+    systems = {str(i): FakeSystem(0.05) for i in range(10)}
+    refreshed = []
+    report = asyncio.run(refresh(systems, concurrency=3, on_refreshed=lambda name, info: refreshed.append(name)))
+    assert FakeSystem.most == 3
+    assert report.done == 10 and report.failed == {} and sorted(refreshed) == sorted(systems)
+    # Three at a time, so about four rounds
+    assert 0.15 < report.duration < 2
+
+
+def test_refresh_retries_timeouts_and_failures():
+    systems = {'slow': FakeSystem(10, 0), 'failing': FakeSystem(ValueError('no'), ValueError('no'), 0),
+               'broken': FakeSystem(ValueError('never'))}
+    report = asyncio.run(asyncio.wait_for(refresh(systems, timeout=0.1, retries=2, backoff=0.01), 5))
+    assert report.attempts == {'slow': 2, 'failing': 3}
+    assert sorted(report.durations) == ['failing', 'slow']
+    assert list(report.failed) == ['broken'] and systems['broken'].attempts == 3
+    # A timed out attempt was given up, not waited for
+    assert report.duration < 1
+
+
+def test_refresh_without_retries_reports_the_timeout():
+    report = asyncio.run(refresh({'slow': FakeSystem(10)}, timeout=0.05, retries=0))
+    assert isinstance(report.failed['slow'], asyncio.TimeoutError)
+
+
+def test_default_concurrency(monkeypatch):
+    monkeypatch.setenv('SYSTEMINFO_REFRESH_CONCURRENCY', '5')
+    assert default_concurrency() == 5
+    monkeypatch.delenv('SYSTEMINFO_REFRESH_CONCURRENCY')
+    assert 2 <= default_concurrency() <= 16
@@ -0,0 +1,163 @@
+import asyncio
+import os
+import subprocess
+import time
+import pytest
+from systeminfo.process import ProcessPool
+from systeminfo.remote import Fleet, Remote, SessionError
+
+
+def local(pool, **kwargs):
+    # The local machine stands in for a host
+    return Remote('local', transport=['sh'], processes=pool, **kwargs)
+
+
+def left_running(token):
+    """
+    The pids of live processes with token in their command line, waiting a bit for killed ones to go
+    """
+    deadline = time.monotonic() + 5
+    while True:
+        pids = []
+        for pid in filter(str.isdigit, os.listdir('/proc')):
+            try:
+                with open('/proc/{pid}/cmdline'.format(pid=pid), 'rb') as f:
+                    cmdline = f.read()
+                with open('/proc/{pid}/stat'.format(pid=pid)) as f:
+                    state = f.read().rsplit(')', 1)[1].split()[0]
+            except OSError:
+                continue
+            if token.encode() in cmdline and state != 'Z':
+                pids.append(int(pid))
+        if not pids or time.monotonic() > deadline:
+            return pids
+        time.sleep(0.05)
+
+
+def test_sync_session_holds_a_pool_slot():
+    pool = ProcessPool(4)
+    remote = local(pool)
+    assert remote.get_command_text('echo one') == 'one\n'
+    assert remote.get_command_text('echo two') == 'two\n'
+    assert pool.stats()['running'] == 1 and pool.stats()['started'] == 1
+    remote.close()
+    assert pool.stats()['running'] == 0 and pool.stats()['killed'] == {'closed': 1}
+
+
+def test_async_run_command():
+    pool = ProcessPool(4)
+    remote = local(pool)
+
+    async def run():
+        process = await remote.async_run_command('echo hello; exit 3')
+        assert await process.communicate() == (b'hello\n', None)
+        assert process.returncode == 3
+        process = await remote.async_run_command('printf a; printf b')
+        assert await process.stdout.read(1) == b'a'
+        assert await process.wait() == 0
+        assert await process.stdout.read() == b'b'
+        assert await remote.async_get_command_text('echo text') == 'text\n'
+        assert pool.stats()['running'] == 1
+        # Killing a command that didn't finish closes its session
+        process = await remote.async_run_command('sleep 30')
+        await asyncio.sleep(0.1)
+        process.kill()
+        with pytest.raises(asyncio.CancelledError):
+            await process.wait()
+        assert await remote.async_get_command_text('echo again') == 'again\n'
+        await remote.async_close()
+        assert pool.stats()['running'] == 0 and pool.stats()['started'] == 2
+    asyncio.run(run())
+
+
+def test_session_that_ends_gives_its_slot_back():
+    pool = ProcessPool(4)
+    remote = local(pool)
+
+    async def run():
+        with pytest.raises(SessionError):
+            await remote.async_get_command_text('kill -9 $$')
+        await asyncio.sleep(0.1)
+        assert pool.stats()['running'] == 0
+    asyncio.run(run())
+    with pytest.raises(SessionError):
+        remote.get_command_text('kill -9 $$')
+    assert remote.get_command_text('echo again') == 'again\n'
+    remote.close()
+    assert pool.stats()['running'] == 0
+
+
+def test_fleet_keeps_no_more_sessions_than_the_pool_has_room_for():
+    pool = ProcessPool(3)
+    fleet = Fleet(['host{i}'.format(i=i) for i in range(6)], concurrency=2, transport=['sh'], processes=pool,
+                  apt_backend='dpkg', pip_backend='metadata')
+
+    async def run():
+        report = await fleet.refresh(retries=0, timeout=10)
+        # Every host was collected without waiting forever for a slot
+        assert report.done == 6
+        assert sum(1 for info in fleet.systems.values() if info._async_sessions) <= 1
+        await fleet.close()
+        assert pool.stats()['running'] == 0
+    asyncio.run(asyncio.wait_for(run(), 30))
+
+
+def test_sync_command_that_times_out_kills_its_session():
+    pool = ProcessPool(4)
+    remote = local(pool, timeout=0.5)
+    with pytest.raises(subprocess.TimeoutExpired):
+        remote.get_command_text('sleep 1001')
+    assert pool.stats()['running'] == 0 and pool.stats()['killed'] == {'closed': 1}
+    assert left_running('1001') == []
+    # The next command starts a new session
+    assert remote.get_command_text('echo again') == 'again\n'
+    remote.close()
+
+
+def test_session_process_that_times_out_kills_its_session():
+    pool = ProcessPool(4)
+    remote = local(pool, timeout=0.5)
+
+    async def run():
+        process = await remote.async_run_command('sleep 1002')
+        with pytest.raises(asyncio.TimeoutError):
+            await process.wait()
+        assert pool.stats()['running'] == 0 and pool.stats()['killed'] == {'closed': 1}
+        assert left_running('1002') == []
+        assert await remote.async_get_command_text('echo again') == 'again\n'
+        await remote.async_close()
+    asyncio.run(asyncio.wait_for(run(), 30))
+
+
+def test_killed_session_process_leaves_nothing_running():
+    pool = ProcessPool(4)
+    remote = local(pool)
+
+    async def run():
+        process = await remote.async_run_command('sleep 1003')
+        queued = await remote.async_run_command('echo never')
+        await asyncio.sleep(0.1)
+        process.kill()
+        with pytest.raises(asyncio.CancelledError):
+            await process.wait()
+        # A command sent after it to the same session fails with it
+        with pytest.raises(SessionError):
+            await queued.wait()
+        assert pool.stats()['running'] == 0 and pool.stats()['killed'] == {'closed': 1}
+        assert left_running('1003') == []
+    asyncio.run(asyncio.wait_for(run(), 30))
+
+
+def test_fleet_refresh_that_times_out_kills_the_sessions():
+    pool = ProcessPool(4)
+    # A host that never answers
+    fleet = Fleet(['host0', 'host1'], transport=['sh', '-c', 'sleep 1004'], processes=pool)
+
+    async def run():
+        report = await fleet.refresh(retries=1, backoff=0, timeout=0.5)
+        assert sorted(report.failed) == ['host0', 'host1']
+        assert all(isinstance(e, asyncio.TimeoutError) for e in report.failed.values())
+        assert pool.stats()['running'] == 0 and pool.stats()['killed'] == {'closed': 4}
+        assert left_running('1004') == []
+        await fleet.close()
+    asyncio.run(asyncio.wait_for(run(), 30))
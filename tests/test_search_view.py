@@ -0,0 +1,213 @@
+import asyncio
+import json
+import os
+import sys
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('aiohttp_jinja2')
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from systeminfo.info import System
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web'))
+import app as webapp
+from api import keys
+from api.cache import ResponseCache
+from api.search import Search
+
+
+def image(packages):
+    system = System()
+    system.update_dict({name: {'from': 'pip', 'name': name, 'version': version} for name, version in packages.items()})
+    return system
+
+
+def test_invalid_queries_are_bad_requests():
+    application = webapp.create_app()
+    # The images are published here instead of by the background refresh
+    application.on_startup.clear()
+    application.on_cleanup.clear()
+    webapp.publish(application, {'old': image({'numpy': '1.14.0'}), 'new': image({'numpy': '1.16.2'})})
+
+    async def run():
+        async with TestClient(TestServer(application)) as client:
+            response = await client.get('/api/search', params={'query': 'numpy~=1.15', 'format': 'json'})
+            assert response.status == 200
+            assert list((await response.json())['results']) == ['new']
+            for params in ({'format': 'json'}, {'format': 'json', 'stream': '1'}, {'format': 'jsonl'}):
+                response = await client.get('/api/search', params=dict(params, query='numpy~=1'))
+                assert response.status == 400
+                assert 'two release numbers' in await response.text()
+            response = await client.post('/api/search', json={'queries': ['numpy', 'numpy~=1']})
+            assert response.status == 400
+    asyncio.run(run())
+
+
+def search_app(images, max_bytes=1024 * 1024):
+    # `create_app` mounts the api, which can only be done once
+    application = web.Application()
+    application[keys.STATE] = keys.State()
+    application[keys.RESPONSE_CACHE] = ResponseCache(max_bytes=max_bytes)
+    application.router.add_view('/search', Search)
+    webapp.publish(application, images)
+    return application
+
+
+def test_responses_are_cached_per_generation():
+    application = search_app({'old': image({'numpy': '1.14.0'}), 'new': image({'numpy': '1.16.2'})})
+    cache = application[keys.RESPONSE_CACHE]
+
+    async def run():
+        async with TestClient(TestServer(application)) as client:
+            response = await client.get('/search', params={'query': 'numpy', 'format': 'json'})
+            etag = response.headers['ETag']
+            assert list((await response.json())['results']) == ['old', 'new']
+            # Spaced differently, but the same query
+            response = await client.get('/search', params={'query': ' numpy ', 'format': 'json'})
+            assert response.headers['ETag'] == etag and (cache.hits, cache.misses) == (1, 1)
+            # The client has it already
+            for if_none_match in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+                response = await client.get('/search', params={'query': 'numpy', 'format': 'json'}, headers={'If-None-Match': if_none_match})
+                assert response.status == 304 and await response.read() == b''
+            response = await client.get('/search', params={'query': 'numpy', 'format': 'json'}, headers={'If-None-Match': '"other"'})
+            assert response.status == 200
+            # Other formats and pages are other responses
+            response = await client.get('/search', params={'query': 'numpy', 'format': 'xml'})
+            assert response.headers['ETag'] != etag and response.content_type == 'text/xml'
+            response = await client.get('/search', params={'query': 'numpy', 'format': 'json', 'limit': '1'})
+            assert list((await response.json())['results']) == ['old']
+            # A new generation changes the response and drops the cached ones
+            webapp.publish(application, {'new': image({'numpy': '1.16.2'})})
+            assert len(cache) == 0
+            response = await client.get('/search', params={'query': 'numpy', 'format': 'json'}, headers={'If-None-Match': etag})
+            assert response.status == 200 and list((await response.json())['results']) == ['new']
+            # Streamed responses aren't cached
+            response = await client.get('/search', params={'query': 'numpy', 'format': 'json', 'stream': '1'})
+            assert 'ETag' not in response.headers and list((await response.json())['results']) == ['new']
+    asyncio.run(run())
+
+
+def test_response_cache_stays_under_its_size():
+    cache = ResponseCache(max_bytes=10)
+    cache.put('a', b'1234', 'application/json')
+    cache.put('b', b'1234', 'application/json')
+    assert cache.get('a').body == b'1234'
+    # b was used least recently
+    cache.put('c', b'1234', 'application/json')
+    assert cache.get('b') is None and cache.get('a') is not None and cache.size == 8
+    # Too big to cache at all, but still gets an ETag
+    entry = cache.put('d', b'x' * 11, 'application/json')
+    assert entry.etag and cache.get('d') is None and len(cache) == 2
+    assert cache.put('e', b'1234', 'text/xml').etag == cache.get('a').etag
+
+
+def test_streamed_pages_match_the_whole_response(monkeypatch):
+    import api.search
+    # Many small writes instead of one
+    monkeypatch.setattr(api.search, 'STREAM_CHUNK', 16)
+    images = {'image{i}'.format(i=i): image({'numpy': '1.1{i}.0'.format(i=i), 'scipy': '1.0'}) for i in range(5)}
+    application = search_app(images)
+
+    async def get(client, **params):
+        response = await client.get('/search', params=dict(params, query='numpy'))
+        assert response.status == 200
+        return response
+
+    async def run():
+        async with TestClient(TestServer(application)) as client:
+            for offset, limit in ((0, None), (1, 2), (3, 10), (5, 1), (0, 0)):
+                page = {'offset': str(offset)} if limit is None else {'offset': str(offset), 'limit': str(limit)}
+                whole = await (await get(client, format='json', **page)).json()
+                expected = list(images)[offset:None if limit is None else offset + limit]
+                assert list(whole['results']) == expected
+                streamed = await get(client, format='json', stream='1', **page)
+                assert streamed.headers['Transfer-Encoding'] == 'chunked'
+                assert await streamed.json() == whole
+                xml = await (await get(client, format='xml', **page)).text()
+                assert await (await get(client, format='xml', stream='1', **page)).text() == xml
+                lines = (await (await get(client, format='jsonl', **page)).text()).splitlines()
+                assert [json.loads(line) for line in lines] == [{'image': name, 'apps': apps} for name, apps in whole['results'].items()]
+            for page in ({'offset': '-1'}, {'limit': 'ten'}, {'limit': '-2'}):
+                for format in ({'format': 'json'}, {'format': 'jsonl'}):
+                    response = await client.get('/search', params=dict(page, query='numpy', **format))
+                    assert response.status == 400
+    asyncio.run(run())
+
+
+BATCH_IMAGES = {
+    'old': {'numpy': '1.14.0', 'scipy': '1.0.0'},
+    'new': {'numpy': '1.16.2', 'pandas': '0.24.1'},
+    'newer': {'numpy': '1.17.0', 'scipy': '1.3.0'},
+}
+
+
+def test_batch_answers_like_each_query(monkeypatch):
+    import systeminfo.query
+    application = search_app({image_name: image(packages) for image_name, packages in BATCH_IMAGES.items()})
+    matched = []
+    match = systeminfo.query.Term.match
+    monkeypatch.setattr(systeminfo.query.Term, 'match', lambda self, run, systems: matched.append(self) or match(self, run, systems))
+
+    async def run():
+        async with TestClient(TestServer(application)) as client:
+            queries = ['numpy>=1.15', {'query': 'numpy>=1.15, scipy', 'limit': 1}, {'query': 'scipy | numpy>=1.15', 'offset': 1}, '"vim"']
+            response = await client.post('/search', json={'queries': queries, 'limit': 2})
+            assert response.status == 200
+            body = await response.json()
+            # Every term is matched once, however many queries it is in
+            assert sorted(map(str, matched)) == ['"vim"', 'numpy>=1.15', 'scipy']
+            assert body['generation'] == 1
+            expected = []
+            for item, limit in zip(queries, (2, 1, 2, 2)):
+                item = {'query': item} if isinstance(item, str) else item
+                params = {'query': item['query'], 'format': 'json', 'offset': str(item.get('offset', 0)), 'limit': str(limit)}
+                results = (await (await client.get('/search', params=params)).json())['results']
+                expected.append({'query': item['query'], 'results': results})
+            assert body['results'] == expected
+            assert [list(item['results']) for item in body['results']] == [['new', 'newer'], ['newer'], ['new', 'newer'], []]
+    asyncio.run(run())
+
+
+def test_batch_limits_and_bad_batches(monkeypatch):
+    monkeypatch.setenv('SYSTEMINFO_BATCH_QUERIES', '2')
+    monkeypatch.setenv('SYSTEMINFO_BATCH_LIMIT', '1')
+    application = search_app({image_name: image(packages) for image_name, packages in BATCH_IMAGES.items()})
+
+    async def run():
+        async with TestClient(TestServer(application)) as client:
+            # No query gets more than the batch limit, whatever it asks for
+            response = await client.post('/search', json={'queries': ['numpy', {'query': 'numpy', 'limit': 5}], 'limit': 10})
+            assert [list(item['results']) for item in (await response.json())['results']] == [['old'], ['old']]
+            for body in ({'queries': ['numpy'] * 3}, {'queries': []}, {'queries': 'numpy'}, ['numpy'], {'queries': [3]},
+                         {'queries': [{'limit': 1}]}, {'queries': ['numpy', '(numpy']}, {'queries': [{'query': 'numpy', 'offset': -1}]},
+                         {'queries': [{'query': 'numpy', 'limit': True}]}, {'queries': [{'query': 'numpy', 'limit': '1'}]}):
+                response = await client.post('/search', json=body)
+                assert response.status == 400, body
+            response = await client.post('/search', data=b'{"queries": [', headers={'Content-Type': 'application/json'})
+            assert response.status == 400
+    asyncio.run(run())
+
+
+def test_batch_keeps_a_retired_mapped_index_open(tmp_path, monkeypatch):
+    import types
+    import api.search
+    from systeminfo import mapped
+    application = search_app({image_name: image(packages) for image_name, packages in BATCH_IMAGES.items()})
+    path = str(tmp_path / 'index')
+    mapped.write(path, *mapped.freeze(application[keys.STATE].index))
+    index = application[keys.STATE].index = mapped.MappedIndex(path)
+
+    async def sleep(delay):
+        # A new index is adopted between the queries of the batch
+        index.retire()
+        await asyncio.sleep(delay)
+    monkeypatch.setattr(api.search, 'asyncio', types.SimpleNamespace(sleep=sleep))
+
+    async def run():
+        async with TestClient(TestServer(application)) as client:
+            response = await client.post('/search', json={'queries': ['numpy', 'scipy', 'pandas']})
+            assert response.status == 200
+            return [list(item['results']) for item in (await response.json())['results']]
+    assert asyncio.run(run()) == [['old', 'new', 'newer'], ['old', 'newer'], ['new']]
+    assert index.mmap.closed
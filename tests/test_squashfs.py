@@ -0,0 +1,189 @@
+import asyncio
+import os
+import random
+import pytest
+from systeminfo import squashfs as squashfs_module
+from systeminfo.info import Singularity, System
+from systeminfo.squashfs import SquashFS, SquashFSError, is_squashfs
+from squashfs_images import XZ, Symlink, sif, squashfs
+
+STATUS = '''Package: vim
+Status: install ok installed
+Architecture: amd64
+Version: 2:8.0.1453-1ubuntu1
+Description: Vi IMproved
+
+Package: vim-runtime
+Status: install ok installed
+Architecture: all
+Version: 2:8.0.1453-1ubuntu1
+
+Package: nano
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 2.9.3-2
+
+'''
+EXTENDED_STATES = '''Package: vim-runtime
+Architecture: all
+Auto-Installed: 1
+
+'''
+PACKAGES = '''Package: vim
+Architecture: amd64
+Version: 2:8.0.1453-1ubuntu1
+
+Package: vim-runtime
+Architecture: all
+Version: 2:8.0.1453-1ubuntu1
+
+'''
+
+
+def metadata(name, version, requires=()):
+    lines = ['Metadata-Version: 2.1', 'Name: ' + name, 'Version: ' + version] + ['Requires-Dist: ' + r for r in requires]
+    return ('\n'.join(lines) + '\n\nLong description\n').encode()
+
+
+def image_files():
+    files = {
+        '/var/lib/dpkg/status': STATUS.encode(),
+        '/var/lib/apt/extended_states': EXTENDED_STATES.encode(),
+        '/var/lib/apt/lists/archive.ubuntu.com_ubuntu_dists_bionic_main_binary-amd64_Packages': PACKAGES.encode(),
+        '/usr/bin/pip': b'#!/usr/bin/python3\nimport pip\n',
+        '/usr/bin/python3.6': b'\x7fELF',
+        '/usr/bin/python3': Symlink('python3.6'),
+        '/usr/lib/python3/dist-packages/six-1.11.0.egg-info': metadata('six', '1.11.0'),
+        '/usr/local/lib/python3.6/dist-packages/numpy-1.15.4.dist-info/METADATA': metadata('numpy', '1.15.4'),
+        '/usr/local/lib/python3.6/dist-packages/pandas-0.23.4.dist-info/METADATA': metadata('pandas', '0.23.4', ['numpy (>=1.9.0)']),
+        '/usr/lib/python2.7/dist-packages/numpy-1.13.3.egg-info': metadata('numpy', '1.13.3'),
+        # A file spanning several blocks, a sparse one and a directory whose inodes fill several metadata blocks
+        '/opt/big': bytes(random.Random(0).getrandbits(8) for _ in range(20000)),
+        '/opt/sparse': bytes(8192) + b'end',
+    }
+    for i in range(400):
+        files['/opt/many/file{i:03}'.format(i=i)] = str(i).encode()
+    return files
+
+
+def extract(files, root):
+    for path, content in files.items():
+        target = os.path.join(str(root), path.lstrip('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if isinstance(content, Symlink):
+            os.symlink(content.target, target)
+        else:
+            with open(target, 'wb') as f:
+                f.write(content)
+
+
+def write_image(tmp_path, data, name='image.sqsh'):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize('compression', [1, XZ, None])
+@pytest.mark.parametrize('fragments', [True, False])
+def test_read_files(tmp_path, compression, fragments):
+    files = image_files()
+    with SquashFS(write_image(tmp_path, squashfs(files, compression=compression, fragments=fragments))) as fs:
+        for path, content in files.items():
+            if not isinstance(content, Symlink) and not path.startswith('/opt/many/'):
+                assert fs.read(path) == content
+        assert [fs.read('/opt/many/file{i:03}'.format(i=i)) for i in range(0, 400, 40)] == [str(i).encode() for i in range(0, 400, 40)]
+        assert fs.read('/usr/bin/python3') == b'\x7fELF'
+        assert fs.realpath('/usr/bin/python3') == '/usr/bin/python3.6'
+        assert fs.isfile('/var/lib/dpkg/status') and not fs.isfile('/var/lib/dpkg')
+        assert fs.isdir('/var/lib/dpkg') and not fs.exists('/var/lib/missing')
+        assert len(fs.listdir('/opt/many')) == 400
+        assert fs.glob('/usr/local/lib/python*/dist-packages/*.dist-info/METADATA') == [
+            '/usr/local/lib/python3.6/dist-packages/numpy-1.15.4.dist-info/METADATA',
+            '/usr/local/lib/python3.6/dist-packages/pandas-0.23.4.dist-info/METADATA']
+        with pytest.raises(FileNotFoundError):
+            fs.read('/etc/missing')
+        with pytest.raises(IsADirectoryError):
+            fs.read('/opt')
+
+
+def test_sif_and_launch_script(tmp_path):
+    files = image_files()
+    filesystem = squashfs(files)
+    for name, data in (('image.sif', sif(filesystem)), ('image.img', b'#!/bin/sh\nexec singularity run "$0"\n'.ljust(4096, b'\0') + filesystem)):
+        with SquashFS(write_image(tmp_path, data, name)) as fs:
+            assert fs.read('/var/lib/dpkg/status') == files['/var/lib/dpkg/status']
+
+
+def test_inspect_matches_reading_the_extracted_image(tmp_path):
+    files = image_files()
+    extract(files, tmp_path / 'root')
+    extracted = System(root=str(tmp_path / 'root'), apt_backend='dpkg', pip_backend='metadata')
+    image = Singularity(write_image(tmp_path, sif(squashfs(files)), 'image.sif'), inspect=True)
+    try:
+        expected = extracted.get_dict()
+        assert image.get_dict() == expected
+        assert image.apt_installed() and list(image.apt_installed()) == list(extracted.apt_installed())
+        assert image.pip_list(long=False) == extracted.pip_list(long=False)
+    finally:
+        image.close()
+    assert expected['vim-runtime']['state'] == '[installed,automatic]'
+    assert expected['numpy']['version'] == '1.15.4'
+
+
+def test_not_an_image(tmp_path):
+    with pytest.raises(SquashFSError):
+        SquashFS(write_image(tmp_path, b''))
+    with pytest.raises(SquashFSError):
+        SquashFS(write_image(tmp_path, b'\0' * 100000))
+    with pytest.raises(SquashFSError):
+        SquashFS(write_image(tmp_path, b'hsqs'))
+
+
+def test_truncated(tmp_path):
+    data = squashfs(image_files())
+    for length in range(0, len(data), len(data) // 50):
+        with pytest.raises(SquashFSError):
+            SquashFS(write_image(tmp_path, data[:length]))
+
+
+def test_corrupt(tmp_path):
+    files = {'/var/lib/dpkg/status': STATUS.encode() * 50, '/opt/big': image_files()['/opt/big']}
+    data = squashfs(files)
+    rng = random.Random(0)
+    for _ in range(200):
+        corrupt = bytearray(data)
+        for _ in range(4):
+            corrupt[rng.randrange(len(corrupt))] = rng.randrange(256)
+        # Whatever a flipped byte breaks, it is never anything but an error about the image
+        try:
+            with SquashFS(write_image(tmp_path, bytes(corrupt))) as fs:
+                for path in files:
+                    fs.read(path)
+        except (SquashFSError, FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            pass
+
+
+def test_caches_stay_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(squashfs_module, 'METADATA_CACHE_BLOCKS', 2)
+    monkeypatch.setattr(squashfs_module, 'INODE_CACHE_SIZE', 8)
+    files = image_files()
+    with SquashFS(write_image(tmp_path, squashfs(files))) as fs:
+        assert [fs.read('/opt/many/file{i:03}'.format(i=i)) for i in range(400)] == [str(i).encode() for i in range(400)]
+        assert fs.read('/opt/big') == files['/opt/big']
+        assert len(fs._metadata_cache) <= 2 and len(fs._inodes) <= 8
+
+
+def test_image_is_closed_after_collecting(tmp_path):
+    image = Singularity(write_image(tmp_path, sif(squashfs(image_files())), 'image.sif'), inspect=True)
+    assert image.get_dict()['vim']['version'] == '2:8.0.1453-1ubuntu1'
+    assert image._filesystem is None
+    assert asyncio.run(image.async_get_dict())['numpy']['version'] == '1.15.4'
+    assert image._filesystem is None
+
+
+def test_only_squashfs_images_can_be_inspected(tmp_path):
+    assert is_squashfs(write_image(tmp_path, sif(squashfs(image_files())), 'image.sif'))
+    # Like the ext3 filesystem of a Singularity 2 image, after its launch script
+    ext3 = b'#!/bin/sh\nexec singularity run "$0"\n'.ljust(4096, b'\0') + bytes(1024) + b'\x53\xef'.ljust(4096, b'\0')
+    assert not is_squashfs(write_image(tmp_path, ext3, 'image.img'))
+    assert not is_squashfs(write_image(tmp_path, b'', 'empty.img'))
@@ -0,0 +1,117 @@
+import gc
+import pytest
+from systeminfo import mapped
+from systeminfo.index import GlobalIndex
+from systeminfo.info import System
+from systeminfo.store import Inventory, StringTable
+
+
+def app(name, version='1.0'):
+    return {'from': 'apt', 'name': name, 'version': version, 'arch': 'amd64', 'state': '[installed]'}
+
+
+def test_rows_stay_valid_after_removing_most_packages():
+    inventory = Inventory(app('p{i}'.format(i=i)) for i in range(300))
+    rows = {name: inventory[name] for name in inventory}
+    for i in range(200):
+        del inventory['p{i}'.format(i=i)]
+    for name in inventory:
+        assert rows[name].to_dict() == app(name)
+
+
+def test_freed_rows_are_reused_once_recycled():
+    inventory = Inventory(app('p{i}'.format(i=i)) for i in range(10))
+    view = inventory['p3']
+    del inventory['p3']
+    inventory['new'] = app('new')
+    assert len(inventory.layout) == 11
+    assert view.to_dict() == app('p3')
+    inventory.recycle()
+    del inventory['new']
+    inventory['newer'] = app('newer')
+    assert len(inventory.layout) == 11
+    assert list(inventory)[-1] == 'newer'
+    assert inventory['newer'].to_dict() == app('newer')
+    assert not view.valid
+    with pytest.raises(KeyError):
+        view.to_dict()
+
+
+def test_views_stay_valid_until_the_next_update():
+    system = System(compact=True)
+    system.update_dict({'a': app('a'), 'b': app('b')})
+    index = GlobalIndex({'image': system})
+    _, packages = mapped.freeze(index)
+    view = dict(packages)['b'][0][2]
+    index.apply('image', system.update_dict({'a': app('a')}))
+    # Whoever froze the index before the removal was published still sees b
+    assert view.to_dict() == app('b')
+    index.apply('image', system.update_dict({'a': app('a'), 'c': app('c')}))
+    # c got the row of b, and the old view of b doesn't pass it off as b
+    assert view.row == system.dict['c'].row and not view.valid
+    assert index.find('c') == {'image': [app('c')]}
+    assert index.find('b') == {}
+
+
+def test_stale_rows_are_not_written(tmp_path):
+    system = System(compact=True)
+    system.update_dict({'a': app('a'), 'b': app('b')})
+    index = GlobalIndex({'image': system})
+    systems, packages = mapped.freeze(index)
+    system.update_dict({'a': app('a')})
+    system.update_dict({'a': app('a'), 'c': app('c', '2.0')})
+    path = str(tmp_path / 'index')
+    mapped.write(path, systems, packages)
+    with mapped.MappedIndex(path) as written:
+        assert [found for _, _, found in written.entries('a')] == [app('a')]
+        assert written.count('b') == 0
+
+
+def test_strings_are_dropped_with_the_last_package_using_them():
+    strings = StringTable()
+    layouts = StringTable()
+    inventory = Inventory([app('a', '1.0'), app('b', '1.0'), app('c', '2.0')], strings=strings, layouts=layouts)
+    assert len(strings) == 9
+    del inventory['c']
+    inventory.recycle()
+    assert '2.0' not in strings.ids and 'c' not in strings.ids
+    inventory['a'] = app('a', '3.0')
+    assert '1.0' in strings.ids and '3.0' in strings.ids
+    del inventory
+    gc.collect()
+    assert len(strings) == 1 and len(layouts) == 1
+    # Removed ids are given out again
+    assert strings.intern('new') < 9
+
+
+def test_replacing_keeps_position_and_row():
+    inventory = Inventory([app('a'), app('b'), app('c')])
+    view = inventory['b']
+    inventory['b'] = app('b', '2.0')
+    assert list(inventory) == ['a', 'b', 'c']
+    assert view['version'] == '2.0'
+
+
+def test_search_after_removing_most_packages():
+    system = System(compact=True)
+    system.update_dict({'p{i}'.format(i=i): app('p{i}'.format(i=i)) for i in range(300)})
+    index = GlobalIndex({'image': system})
+    changes = system.update_dict({'p{i}'.format(i=i): app('p{i}'.format(i=i)) for i in range(200, 300)})
+    index.apply('image', changes)
+    assert len(changes.removed) == 200
+    assert index.find('p250', match=True) == {'image': [app('p250')]}
+    assert index.find('p1', match=True) == {}
+    assert [found['name'] for found in index.find('p29')['image']] == ['p290', 'p291', 'p292', 'p293', 'p294',
+                                                                       'p295', 'p296', 'p297', 'p298', 'p299']
+    assert system.search('p250', match=True) == [app('p250')]
+
+
+def test_changes_remember_old_versions():
+    system = System(compact=True)
+    system.update_dict({'a': app('a'), 'b': app('b')})
+    changes = system.update_dict({'a': app('a', '2.0'), 'c': app('c')})
+    assert changes.entries('image') == [
+        {'image': 'image', 'change': 'added', 'package': 'c', 'version': '1.0'},
+        {'image': 'image', 'change': 'removed', 'package': 'b', 'old_version': '1.0'},
+        {'image': 'image', 'change': 'changed', 'package': 'a', 'old_version': '1.0', 'version': '2.0'},
+    ]
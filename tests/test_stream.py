@@ -0,0 +1,55 @@
+import asyncio
+import json
+import pytest
+from systeminfo.info import System
+from systeminfo.stream import async_iter_json_array, async_iter_lines, iter_json_array, iter_lines
+
+
+def splits(text):
+    # The text cut in two at every position, and one character at a time
+    for i in range(len(text) + 1):
+        yield [text[:i], text[i:]]
+    yield list(text)
+
+
+async def chunks_of(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(items):
+    return [item async for item in items]
+
+
+def test_lines_split_anywhere():
+    text = 'one\ntwo\r\n\nlast without newline'
+    for chunks in splits(text):
+        assert list(iter_lines(chunks)) == text.split('\n')
+        assert asyncio.run(collect(async_iter_lines(chunks_of(chunks)))) == text.split('\n')
+    assert list(iter_lines(['one\n', 'two\n'])) == ['one', 'two']
+
+
+def test_json_array_split_anywhere():
+    items = [{'name': 'six', 'version': '1.16.0'}, {'name': 'café "quoted" ]', 'nested': [1, {'a': None}]},
+             12345, -1.5e3, True, 'text', []]
+    text = ' ' + json.dumps(items, indent=1) + '\n'
+    for chunks in splits(text):
+        assert list(iter_json_array(chunks)) == items
+        assert asyncio.run(collect(async_iter_json_array(chunks_of(chunks)))) == items
+    assert list(iter_json_array(['[', ']'])) == []
+
+
+def test_json_array_errors():
+    with pytest.raises(ValueError):
+        list(iter_json_array(['{"name": "six"}']))
+    with pytest.raises(ValueError):
+        list(iter_json_array(['[{"name": "six"}']))
+    with pytest.raises(ValueError):
+        list(iter_json_array(['[] []']))
+
+
+def test_command_chunks_split_characters():
+    system = System()
+    # Single bytes cut the two byte character in half
+    assert ''.join(system.iter_command_chunks(['printf', 'café\\n'], size=1)) == 'café\n'
+    assert asyncio.run(system.async_get_command_text(['printf', 'café\\n'])) == 'café\n'
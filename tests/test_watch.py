@@ -0,0 +1,122 @@
+import asyncio
+import os
+import sys
+import pytest
+from systeminfo import watch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web'))
+
+
+def is_image(path):
+    return path.endswith('.sif')
+
+
+def write(path, text='image'):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+async def next_changes(watcher, timeout=5):
+    changes = watcher.changes()
+    try:
+        return await asyncio.wait_for(changes.__anext__(), timeout)
+    finally:
+        await changes.aclose()
+
+
+@pytest.fixture(params=['inotify', 'poll'])
+def make_watcher(request):
+    watchers = []
+
+    def make(*args, **kwargs):
+        if request.param == 'inotify':
+            if watch._inotify_libc() is None:
+                pytest.skip("inotify is not available")
+            watcher = watch.InotifyWatcher(*args, **kwargs)
+        else:
+            watcher = watch.PollingWatcher(*args, interval=0.1, **kwargs)
+        watchers.append(watcher)
+        return watcher
+    yield make
+    for watcher in watchers:
+        watcher.close()
+
+
+def test_changes_are_reported_once_they_settle(tmp_path, make_watcher):
+    root = tmp_path / 'images'
+    (root / 'old').mkdir(parents=True)
+    write(str(root / 'old' / 'a.sif'))
+    status = str(tmp_path / 'status')
+    watcher = make_watcher([str(root)], [status], match=is_image, debounce=0.2)
+
+    async def run():
+        task = asyncio.ensure_future(next_changes(watcher))
+        await asyncio.sleep(0.3)
+        write(str(root / 'old' / 'a.sif'), 'changed')
+        write(str(root / 'b.sif'))
+        write(str(root / 'notes.txt'))
+        # A single file doesn't have to match, or exist when watching starts
+        write(status)
+        return await task
+    assert asyncio.run(run()) == {str(root / 'old' / 'a.sif'), str(root / 'b.sif'), status}
+
+
+def test_a_file_still_being_written_waits(tmp_path, make_watcher):
+    watcher = make_watcher([str(tmp_path)], match=is_image, debounce=0.5)
+    path = str(tmp_path / 'a.sif')
+
+    async def run():
+        task = asyncio.ensure_future(next_changes(watcher))
+        await asyncio.sleep(0.3)
+        started = asyncio.get_running_loop().time()
+        for i in range(5):
+            write(path, 'x' * i)
+            await asyncio.sleep(0.2)
+        assert await task == {path}
+        return asyncio.get_running_loop().time() - started
+    assert asyncio.run(run()) >= 1.0
+
+
+def test_a_directory_moved_in_reports_its_files(tmp_path):
+    if watch._inotify_libc() is None:
+        pytest.skip("inotify is not available")
+    root = tmp_path / 'images'
+    root.mkdir()
+    outside = tmp_path / 'copy' / 'nested'
+    outside.mkdir(parents=True)
+    write(str(outside / 'a.sif'))
+    watcher = watch.InotifyWatcher([str(root)], match=is_image, debounce=0.1)
+
+    async def run():
+        task = asyncio.ensure_future(next_changes(watcher))
+        await asyncio.sleep(0.1)
+        os.rename(str(tmp_path / 'copy'), str(root / 'copy'))
+        found = await task
+        # Files written in it later are seen too
+        write(str(root / 'copy' / 'nested' / 'b.sif'))
+        return found, await next_changes(watcher)
+    try:
+        assert asyncio.run(run()) == ({str(root / 'copy' / 'nested' / 'a.sif')}, {str(root / 'copy' / 'nested' / 'b.sif')})
+    finally:
+        watcher.close()
+
+
+def test_changed_paths_map_to_images(tmp_path, monkeypatch):
+    pytest.importorskip('aiohttp')
+    from aiohttp import web
+    from api import keys
+    from gen_images import changed_images
+    from systeminfo.info import Singularity
+    monkeypatch.setenv('SINGULARITY_IMAGE_DIR', str(tmp_path))
+    for image_name in ('kept.sif', 'changed.sif', 'gone.sif', 'new.sif', 'notes.txt'):
+        write(str(tmp_path / image_name))
+    app = web.Application()
+    app[keys.STATE] = keys.State()
+    for image_name in ('kept.sif', 'changed.sif', 'gone.sif'):
+        app[keys.STATE].images[str(tmp_path / image_name)] = Singularity(str(tmp_path / image_name))
+    os.remove(str(tmp_path / 'gone.sif'))
+    paths = {str(tmp_path / image_name) for image_name in ('changed.sif', 'gone.sif', 'new.sif', 'notes.txt')}
+    refreshed, removed = changed_images(app, paths)
+    assert sorted(refreshed) == [str(tmp_path / 'changed.sif'), str(tmp_path / 'new.sif')]
+    assert refreshed[str(tmp_path / 'changed.sif')] is app[keys.STATE].images[str(tmp_path / 'changed.sif')]
+    assert removed == [str(tmp_path / 'gone.sif')]
@@ -1,10 +1,12 @@
 import aiohttp
 from aiohttp import web
 from .search import searchapp
+from .changes import changesapp
 
 apiapp_routes = web.RouteTableDef()
 apiapp = web.Application()
 apiapp.add_subapp('/search', searchapp)
+apiapp.add_subapp('/changes', changesapp)
 
 @apiapp_routes.view('', name='api')
 class Api(web.View):
@@ -13,9 +15,9 @@ class Api(web.View):
     """
     @classmethod
     def gen_docstring(cls):
-        # TODO can I get searchapp automatically?
+        # TODO can I get the subapps automatically?
         # Turn this into a library if you can
-        routes = {route.get_info()['path']: route.handler.gen_docstring() for router_name in searchapp.router for route in searchapp.router[router_name]._routes}
+        routes = {route.get_info()['path']: route.handler.gen_docstring() for subapp in (searchapp, changesapp) for router_name in subapp.router for route in subapp.router[router_name]._routes}
         doc = "{doc}\n{routes}".format(doc=cls.__doc__, routes='\n\n'.join(['{path}:\n{doc}'.format(path=key, doc=value) for key, value in routes.items()]))
         return doc
 
@@ -0,0 +1,64 @@
+import collections
+import hashlib
+import systeminfo.metrics
+
+CacheEntry = collections.namedtuple('CacheEntry', ['body', 'content_type', 'etag'])
+
+
+def make_entry(body, content_type):
+    """
+    Wrap an encoded body with its content type and an ETag made from its content
+    """
+    etag = '"{digest}"'.format(digest=hashlib.blake2b(body, digest_size=16).hexdigest())
+    return CacheEntry(body, content_type, etag)
+
+
+class ResponseCache:
+    """
+    A least recently used cache of encoded response bodies
+
+    Bounded by the total size of the bodies it holds rather than the number of
+    entries. Keys should include the data generation, and the cache should be
+    cleared when new data is published so old generations don't linger.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            systeminfo.metrics.CACHE_REQUESTS.labels('response', 'miss').inc()
+            return None
+        self.hits += 1
+        systeminfo.metrics.CACHE_REQUESTS.labels('response', 'hit').inc()
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, body, content_type):
+        """
+        Store a body and return its entry, evicting the least recently used ones to stay under max_bytes
+        """
+        entry = make_entry(body, content_type)
+        if len(body) > self.max_bytes:
+            # Would evict everything else and still not fit
+            return entry
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key).body)
+        self.entries[key] = entry
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
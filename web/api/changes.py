@@ -0,0 +1,46 @@
+from aiohttp import web
+from . import keys
+
+changesapp_routes = web.RouteTableDef()
+changesapp = web.Application()
+
+
+@changesapp_routes.view('', name='changes')
+class Changes(web.View):
+    """
+    Get what changed in the images since a generation
+    Methods: GET
+
+    since:
+        Add `?since=<epoch>:<generation>` with the `epoch` and `generation` of
+        the last response you got, or `?since=0` to start. Every change
+        published after it is returned along with the current epoch and
+        generation.
+
+        Changes are one of `added`, `removed` or `changed` for a package, or
+        `image_added` or `image_removed` for a whole image.
+
+        If changes that old were already forgotten, or the epoch is another
+        one because the server restarted and its generations started over,
+        the response is `410 Gone`, search again to get everything.
+    """
+    @classmethod
+    def gen_docstring(cls):
+        return cls.__doc__
+
+    async def get(self):
+        request = self.request
+        epoch, _, since = request.query.get('since', '0').rpartition(':')
+        try:
+            since = int(since)
+        except ValueError:
+            raise web.HTTPBadRequest(text="since must be <epoch>:<generation>, or 0")
+        if since and not epoch:
+            raise web.HTTPBadRequest(text="since must be <epoch>:<generation>, or 0")
+        changelog = request.config_dict[keys.STATE].changelog
+        changes = changelog.since(since, epoch)
+        if changes is None:
+            raise web.HTTPGone(text="Changes since generation {since} are no longer available".format(since=since))
+        return web.json_response({'epoch': changelog.epoch, 'generation': changelog.generation, 'changes': changes})
+
+changesapp.add_routes(changesapp_routes)
@@ -0,0 +1,39 @@
+import asyncio
+from aiohttp import web
+import systeminfo.diff
+from .cache import ResponseCache
+
+
+class State:
+    """
+    What the app publishes while it serves, read by the api through `request.config_dict[STATE]`
+
+    aiohttp doesn't want an app changed once it started, so everything a
+    refresh or a new index changes is an attribute here instead of a key
+    """
+    def __init__(self):
+        self.images = {}  # Image names to the `System`s that are searched
+        self.index = None  # The `GlobalIndex` of the images, or the `MappedIndex` a worker searches
+        self.generation = 0  # Counts publishes, cached responses are keyed by it
+        self.changelog = systeminfo.diff.ChangeLog()
+        # Images refreshed for the first time, waiting to be published together, and the timer that publishes them
+        self.unpublished = {}
+        self.unpublished_handle = None
+        # Whether what is served came from the inventory cache's snapshot, and whether a refresh finished since
+        self.snapshot = False
+        self.refreshed = False
+        self.inventory_cache = None
+        self.refresh_report = None
+        self.file_watcher = None  # The task that refreshes changed images, started after the first refresh
+
+
+STATE = web.AppKey('state', State)
+RESPONSE_CACHE = web.AppKey('response_cache', ResponseCache)
+REFRESH_LOCK = web.AppKey('refresh_lock', asyncio.Lock)
+# The mapped index the refresher writes and the workers search, and the event that has it written
+INDEX_PATH = web.AppKey('index_path', str)
+INDEX_DUE = web.AppKey('index_due', asyncio.Event)
+# Background tasks
+IMAGE_WATCHER = web.AppKey('background_image_watcher', asyncio.Task)
+INDEX_WRITER = web.AppKey('background_index_writer', asyncio.Task)
+INDEX_FOLLOWER = web.AppKey('background_index_follower', asyncio.Task)
@@ -1,9 +1,22 @@
+import asyncio
+import itertools
+import json
+import os
 import urllib.parse
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 import aiohttp
 from aiohttp import web
 import aiohttp_jinja2
 import jinja2
+import systeminfo.mapped
+import systeminfo.metrics
+import systeminfo.query
+from . import keys
+from .cache import make_entry
+
+# Streamed responses are written in pieces of about this many bytes
+STREAM_CHUNK = 64 * 1024
 
 searchapp_routes = web.RouteTableDef()
 searchapp = web.Application()
@@ -18,7 +31,7 @@ aiohttp_jinja2.setup(searchapp,
 class Search(web.View):
     """
     Query the info on the images available
-    Methods: GET
+    Methods: GET, POST
 
     query:
         To search via query string, add `?query=<query>` where `<query>` is
@@ -27,15 +40,53 @@ class Search(web.View):
         
         For example, `query=vim,python3,wget=7,apt`
         
-        Names and versions are fuzzy matched, meaning they will match against
-        any package that contains the query term
+        Names are fuzzy matched, meaning they will match against any package
+        that contains the query term. `name*` only matches names starting
+        with it and `"name"` only that exact name.
+
+        `name=version` matches versions starting with `version` up to a `.`,
+        `-`, `+`, `~` or `:`, so `python=3` matches `3.6.5` but not `2.7.3`.
+        Versions can also be compared with `==`, `!=`, `<`, `<=`, `>`, `>=`
+        and `~=`, like `numpy>=1.15`; pip packages compare by PEP 440 and
+        the rest like dpkg.
+
+        Terms can be combined with `|` for or, negated with `!` and grouped
+        with parentheses, like `(vim|emacs),!python2*`. A query that can't be
+        parsed is a `400 Bad Request`.
 
     format:
         To select the format, add `&format=<format>` where `<format>` can be
-        `json` or `xml`
+        `json`, `xml` or `jsonl`
+
+        We also check the `Accept` header for `application/json`,
+        `application/xml` or `application/x-ndjson`
+
+    stream:
+        Add `&stream=1` to have `json` and `xml` sent image by image as they
+        are found, instead of all at once when the search is done. The
+        document is the same, but it isn't cached and has no `ETag`.
+        `jsonl` is always streamed, one line of
+        `{"image": <image name>, "apps": {<app name>: <app>, ...}}` per image
+
+    offset, limit:
+        Add `&limit=<n>` to only get the first `n` matching images, and
+        `&offset=<n>` to skip the first `n`. Page through a large result with
+        `offset=0&limit=100`, `offset=100&limit=100` and so on until fewer
+        than `limit` images come back
+
+    queries:
+        POST a JSON body of `{"queries": [<query>, ...], "limit": <n>}` to
+        run many queries at once. A query is a query string, or
+        `{"query": <query string>, "limit": <n>, "offset": <n>}` to page
+        through it like above. Terms that are in several queries are only
+        matched once for all of them. The response is JSON,
+        `{"results": [{"query": <query string>, "results": {...}}, ...], "generation": <n>}`
+        with the results of each query in the order they were sent.
 
-        We also check the `Accept` header for `application/json` or
-        `application/xml`
+        A batch has at most `SYSTEMINFO_BATCH_QUERIES` (100) queries, and
+        every query returns at most `SYSTEMINFO_BATCH_LIMIT` (1000) images,
+        whatever limit it asks for. A query that can't be parsed makes the
+        whole batch a `400 Bad Request`
     """
     @classmethod
     def gen_docstring(cls):
@@ -74,6 +125,9 @@ class Search(web.View):
                     elif mimetype == 'application/xml':
                         format = 'xml'
                         break
+                    elif mimetype == 'application/x-ndjson':
+                        format = 'jsonl'
+                        break
                 if format is not None:
                     # We really need a "if we broke out" clause for the for loop
                     break
@@ -88,75 +142,236 @@ class Search(web.View):
         # Fist is the query string
         if 'query' in qs:
             query = qs['query'][0]
-        # Next, we check the body for json data
-        # TODO this is actually more for POST, but we aren't implementing post
-        elif request.content_type == 'application/json':
-            if not request.can_read_body:
-                print("Got JSON but couldn't read it")
-            query = await request.json()['query']
+        # Next, we check the body for json data, POST takes a batch of them
+        elif request.content_type == 'application/json' and request.can_read_body:
+            try:
+                body = await request.json()
+            except ValueError:
+                raise web.HTTPBadRequest(text="The body isn't valid JSON")
+            query = body.get('query', '') if isinstance(body, dict) else ''
         else:
             query = ''
         #print('query: ', query)
         _help = True if 'help' in query else False  # TODO print docstring if ?help
         
-        # Terms are query criteria as (package name, version)
-        terms = [(term.split('=')[0], '' if len(term.split('=')) == 1 else term.split('=')[1]) for term in query.split(',') if query]
-        #print(terms)
-        
-        # Perform the search
-        if 'images' in request.config_dict:
-            images = request.config_dict['images']  # config_dict searches through the partent modules until it hits the first match; its how we get stuff on the root app
-        else:
-            images = {}
-        term_results = {}
-        
-        for image_name, info in images.items():
-            for package_name, package_version in terms:
-                result = await info.async_search(package_name, version=package_version)
-                if not result:
-                    # If we did not find a a package, delete it from the results and then go to the next image
-                    app.logger.warning(f"Did not find `{package_name}` = `{package_version}`, deleting `{image_name}` from results")
-                    try:
-                        del term_results[image_name]
-                    except:
-                        pass
-                    break
-                # Try to append, if there is a key error then create the first entry
-                try:
-                    term_results[image_name].append(result)
-                except KeyError:
-                    term_results[image_name] = [result]
-        
-        #print(term_results)
-        # XXX We don't include duplicate names when making the search dict, so we don't need to think about it here
-        # TODO I'd like this to be ordered somehow, smallest image_names first because they are more likely to be the most relevant
-        # TODO but I know dicts are unordered, perhaps transform it into an ordered dict?
-        results = {image_name: {app['name']: app for term in term_results[image_name] for app in term} for image_name in term_results}
+        query = ','.join(term.strip() for term in query.split(',')) if query else ''
+        # The query is compiled into a tree of terms, see `systeminfo.query`
+        try:
+            node = systeminfo.query.parse(query) if query else None
+        except systeminfo.query.QueryError as e:
+            raise web.HTTPBadRequest(text="Invalid query: {e}".format(e=e))
+
+        try:
+            offset = int(qs['offset'][0]) if 'offset' in qs else 0
+            limit = int(qs['limit'][0]) if 'limit' in qs else None
+        except ValueError:
+            raise web.HTTPBadRequest(text="`offset` and `limit` have to be whole numbers")
+        if offset < 0 or (limit is not None and limit < 0):
+            raise web.HTTPBadRequest(text="`offset` and `limit` can't be negative")
+        stream = format == 'jsonl' or qs.get('stream', [''])[0].lower() in ('1', 'true', 'yes')
         
-        response = {'results': results, 'query': query}
-        if format == 'json':
-            return web.json_response(response)
-        elif format == 'xml':
-            root = ET.Element('results')
-            root.set('query', str(query))
-            for image_name, value in results.items():
-                image = ET.SubElement(root, 'image')
-                image.set('name', str(image_name))
-                #print(image)
-                for app_name, info in value.items():
-                    app = ET.SubElement(image, 'app')
-                    for key, value in info.items():
-                        app.set(str(key), str(value))
-                    #print(app)
-            text = ET.tostring(root, encoding="unicode")
-            #print(text)
-            #print('hi')
-            return web.Response(text=text, content_type='text/xml')
-        elif format == 'html':
+        if stream and format in ('json', 'xml', 'jsonl'):
+            with systeminfo.metrics.SEARCH_DURATION.labels(format).time():
+                return await self.stream(node, query, format, offset, limit)
+        if format in ('json', 'xml'):
+            with systeminfo.metrics.SEARCH_DURATION.labels(format).time():
+                # The data only changes when a new generation is published, so encoded responses are cached
+                cache = request.config_dict.get(keys.RESPONSE_CACHE)
+                # Queries that parse the same are the same, however they were spaced
+                key = (str(node), format, offset, limit, request.config_dict[keys.STATE].generation)
+                entry = cache.get(key) if cache is not None else None
+                if entry is None:
+                    results = await self.search(node, offset, limit)
+                    body, content_type = self.encode({'results': results, 'query': query}, format)
+                    entry = cache.put(key, body, content_type) if cache is not None else make_entry(body, content_type)
+                return self.cached_response(entry)
+        if format == 'html':
             response = aiohttp_jinja2.render_template('index.j2',
                                               self.request,
                                               {})
             return response
         return web.Response(text="unknown format")
 
+    async def post(self):
+        """
+        Run a batch of queries, see `queries` above
+        """
+        request = self.request
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="The body has to be JSON")
+        queries = body.get('queries') if isinstance(body, dict) else None
+        if not isinstance(queries, list) or not queries:
+            raise web.HTTPBadRequest(text="`queries` has to be a list of queries")
+        max_queries = int(os.environ.get('SYSTEMINFO_BATCH_QUERIES', 100))
+        if len(queries) > max_queries:
+            raise web.HTTPBadRequest(text="A batch can have at most {max_queries} queries".format(max_queries=max_queries))
+        max_limit = int(os.environ.get('SYSTEMINFO_BATCH_LIMIT', 1000))
+        default_limit = body.get('limit', max_limit)
+
+        batch = []
+        for i, item in enumerate(queries):
+            if isinstance(item, str):
+                item = {'query': item}
+            if not isinstance(item, dict) or not isinstance(item.get('query'), str):
+                raise web.HTTPBadRequest(text="Query {i} has to be a query string or have one in `query`".format(i=i))
+            try:
+                node = systeminfo.query.parse(item['query'])
+            except systeminfo.query.QueryError as e:
+                raise web.HTTPBadRequest(text="Invalid query {i}: {e}".format(i=i, e=e))
+            offset = item.get('offset', 0)
+            limit = item.get('limit', default_limit)
+            if any(not isinstance(value, int) or isinstance(value, bool) or value < 0 for value in (offset, limit)):
+                raise web.HTTPBadRequest(text="`offset` and `limit` of query {i} have to be whole numbers, at least 0".format(i=i))
+            batch.append((item['query'], node, offset, min(limit, max_limit)))
+
+        with systeminfo.metrics.SEARCH_DURATION.labels('batch').time():
+            generation = request.config_dict[keys.STATE].generation
+            results = await self.search_batch([(node, offset, limit) for _, node, offset, limit in batch])
+        return web.json_response({'results': [{'query': query, 'results': found} for (query, _, _, _), found in zip(batch, results)],
+                                  'generation': generation})
+
+    async def search_batch(self, batch):
+        """
+        Find the images matching each of a list of (parsed query, offset, limit)
+
+        Returns a list with the dictionary `search` would return for each
+        """
+        index = self.request.config_dict[keys.STATE].index
+        if index is None:
+            return [await self.search(node, offset, limit) for node, offset, limit in batch]
+        results = []
+        # A mapped index that is swapped out between queries stays open until the batch is done
+        with systeminfo.mapped.using(index):
+            generators = systeminfo.query.iter_batch([node for node, _, _ in batch], index)
+            for (node, offset, limit), generator in zip(batch, generators):
+                results.append(dict(itertools.islice(generator, offset, offset + limit)))
+                # Other requests get a turn between queries, however big the batch is
+                await asyncio.sleep(0)
+        return results
+
+    async def iter_search(self, node, offset=0, limit=None):
+        """
+        Find the images matching a parsed query, one at a time
+
+        Generates the (image name, dictionary of the matching apps) of the
+        matching images from offset on, at most limit of them
+        """
+        request = self.request
+        if node is None or limit == 0:
+            return
+        stop = None if limit is None else offset + limit
+        state = request.config_dict[keys.STATE]  # config_dict searches through the parent apps until it hits the first match; its how we get stuff on the root app
+        if state.index is not None:
+            index = state.index
+            # The index searches every image at once, only the results are built one at a time
+            # A mapped index that is swapped out meanwhile stays open until the results are sent
+            with systeminfo.mapped.using(index):
+                for item in itertools.islice(index.iter_query(node), offset, stop):
+                    yield item
+            return
+        matched = 0
+        for image_name, info in list(state.images.items()):
+            result = await info.async_query(node)
+            if result is None:
+                request.app.logger.debug(f"`{image_name}` does not match `{node}`")
+                continue
+            matched += 1
+            if matched > offset:
+                yield image_name, result
+            if stop is not None and matched >= stop:
+                return
+
+    async def search(self, node, offset=0, limit=None):
+        """
+        Find the images matching a parsed query
+
+        Returns a dictionary of image names to a dictionary of the matching apps
+        """
+        return {image_name: apps async for image_name, apps in self.iter_search(node, offset, limit)}
+
+    async def stream(self, node, query, format, offset=0, limit=None):
+        """
+        Send the images matching a parsed query as they are found
+
+        `json` and `xml` are the same documents `encode` makes, written a
+        piece at a time. Pieces are gathered into writes of about `STREAM_CHUNK`
+        bytes, and every write waits for the client if it is falling behind
+        """
+        content_type = {'json': 'application/json', 'xml': 'text/xml', 'jsonl': 'application/x-ndjson'}[format]
+        response = web.StreamResponse(headers={'Content-Type': content_type + '; charset=utf-8'})
+        response.enable_chunked_encoding()
+        await response.prepare(self.request)
+        pieces = []
+        size = 0
+        if format == 'json':
+            pieces.append('{"results": {')
+        elif format == 'xml':
+            pieces.append('<results query="{query}">'.format(query=escape(str(query), {'"': '&quot;', '\r': '&#13;', '\n': '&#10;', '\t': '&#09;'})))
+        first = True
+        async for image_name, apps in self.iter_search(node, offset, limit):
+            if format == 'jsonl':
+                piece = json.dumps({'image': image_name, 'apps': apps}) + '\n'
+            elif format == 'json':
+                piece = ('' if first else ', ') + json.dumps(image_name) + ': ' + json.dumps(apps)
+            else:
+                piece = ET.tostring(self.image_element(image_name, apps), encoding='unicode')
+            first = False
+            pieces.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK:
+                await response.write(''.join(pieces).encode('utf-8'))
+                pieces = []
+                size = 0
+        if format == 'json':
+            pieces.append('}, "query": ' + json.dumps(query) + '}')
+        elif format == 'xml':
+            if first:
+                # Nothing was found, nothing was written yet either, so the empty element `encode` makes
+                pieces[0] = pieces[0][:-1] + ' />'
+            else:
+                pieces.append('</results>')
+        if pieces:
+            await response.write(''.join(pieces).encode('utf-8'))
+        await response.write_eof()
+        return response
+
+    def image_element(self, image_name, apps):
+        """
+        The `<image>` element of one image and its apps
+        """
+        image = ET.Element('image')
+        image.set('name', str(image_name))
+        for app_name, info in apps.items():
+            app = ET.SubElement(image, 'app')
+            for key, value in info.items():
+                app.set(str(key), str(value))
+        return image
+
+    def encode(self, response, format):
+        """
+        Encode a response as `json` or `xml`, returns the body and content type
+        """
+        if format == 'json':
+            return json.dumps(response).encode('utf-8'), 'application/json'
+        results = response['results']
+        query = response['query']
+        root = ET.Element('results')
+        root.set('query', str(query))
+        for image_name, value in results.items():
+            root.append(self.image_element(image_name, value))
+        text = ET.tostring(root, encoding="unicode")
+        return text.encode('utf-8'), 'text/xml'
+
+    def cached_response(self, entry):
+        """
+        Respond with an encoded body, or with 304 if the client already has it
+        """
+        headers = {'ETag': entry.etag}
+        if_none_match = [tag.strip() for tag in self.request.headers.get('If-None-Match', '').split(',')]
+        if '*' in if_none_match or entry.etag in if_none_match or 'W/' + entry.etag in if_none_match:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=entry.body, content_type=entry.content_type, headers=headers)
+
 searchapp.add_routes(searchapp_routes)
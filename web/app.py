@@ -1,26 +1,326 @@
+import argparse
 import asyncio
 import datetime
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
 import aiohttp
 from aiohttp import web
 import aiohttp_jinja2
 import jinja2
-from api import apiapp
+from api import apiapp, keys
 from api.search import Search
-from gen_images import generate_images
+from api.cache import ResponseCache
+from gen_images import changed_images, discover_images, generate_images, image_dirs, is_image
+import systeminfo.diff
+import systeminfo.index
+import systeminfo.mapped
+import systeminfo.metrics
+import systeminfo.process
+import systeminfo.refresh
+import systeminfo.watch
 
+GENERATION = systeminfo.metrics.REGISTRY.gauge('systeminfo_generation', "Generation of the published data")
+IMAGES = systeminfo.metrics.REGISTRY.gauge('systeminfo_images', "Images that are published")
+RESPONSE_CACHE_BYTES = systeminfo.metrics.REGISTRY.gauge('systeminfo_response_cache_bytes', "Size of the cached response bodies")
 
-async def update_images_periodically(app, timedelta=datetime.timedelta(minutes=5)):
+
+def publish(app, data):
+    """
+    Publish freshly refreshed images, applying only what changed to the index
+
+    Nothing here awaits, so requests never see a half published generation
+    """
+    state = app[keys.STATE]
+    previous = state.images
+    entries = []
+    for image_name in previous.keys() - data.keys():
+        entries.append({'image': image_name, 'change': 'image_removed'})
+        systeminfo.metrics.REFRESH_LAST.remove(image_name)
+    for image_name, info in data.items():
+        if image_name not in previous:
+            entries.append({'image': image_name, 'change': 'image_added'})
+        elif info.changes:
+            entries.extend(info.changes.entries(image_name))
+
+    if state.index is None:
+        state.index = systeminfo.index.GlobalIndex(data)
+    else:
+        index = state.index
+        for image_name in previous.keys() - data.keys():
+            index.remove(image_name)
+        for image_name, info in data.items():
+            if image_name not in previous:
+                index.apply(image_name, systeminfo.diff.diff_inventories({}, info.dict or {}))
+            elif info.changes:
+                index.apply(image_name, info.changes)
+        # Images published as they finished are put back in the usual order
+        index.reorder(data)
+    for image_name, info in data.items():
+        # Changes are applied once
+        info.changes = None
+        # The images search the global index, none builds an index of its own too
+        info.share_index(state.index, image_name)
+    state.images = data
+    for image_name in data:
+        state.unpublished.pop(image_name, None)
+    if not state.unpublished and state.unpublished_handle is not None:
+        # Everything waiting was published with this generation
+        state.unpublished_handle.cancel()
+        state.unpublished_handle = None
+
+    state.generation += 1
+    state.changelog.record(state.generation, entries)
+    app.logger.info("Published generation {generation} with {count} changes".format(generation=state.generation, count=len(entries)))
+    # Cached responses are keyed by generation, drop the old ones
+    app[keys.RESPONSE_CACHE].clear()
+    if keys.INDEX_DUE in app:
+        # Workers search what the refresher writes, they get this generation too
+        app[keys.INDEX_DUE].set()
+
+
+def publish_refreshed(app, image_name, info):
+    """
+    Publish an image that isn't served yet soon after its first refresh is done
+
+    Every publish copies the served images and starts a generation, so
+    images that finish within `SYSTEMINFO_PUBLISH_DELAY` seconds of the first
+    one are published together. Images that are already served are
+    published with the rest of the cycle
+    """
+    state = app[keys.STATE]
+    if image_name in state.images:
+        return
+    state.unpublished[image_name] = info
+    if state.unpublished_handle is None:
+        delay = float(os.environ.get('SYSTEMINFO_PUBLISH_DELAY', 1))
+        state.unpublished_handle = asyncio.get_event_loop().call_later(delay, publish_unpublished, app)
+
+
+def publish_unpublished(app):
+    """
+    Publish the images `publish_refreshed` held back, after the ones served already
+    """
+    state = app[keys.STATE]
+    state.unpublished_handle = None
+    if not state.unpublished:
+        return
+    data = dict(state.images)
+    data.update(state.unpublished)
+    publish(app, data)
+
+
+async def load_snapshots(app):
+    """
+    Publish the images the inventory cache already knows, before they are checked
+
+    A restarted server answers from these right away. The first refresh then
+    publishes what changed, like any other
+    """
+    data = discover_images(app)
+    loop = asyncio.get_event_loop()
+    loaded = {}
+    for image_name, info in data.items():
+        # One at a time in a thread, the cache's connection isn't shared
+        if await loop.run_in_executor(None, info.load_snapshot):
+            loaded[image_name] = info
+    if loaded:
+        publish(app, loaded)
+        app[keys.STATE].snapshot = True
+    app.logger.info("Loaded the snapshots of {loaded}/{total} images".format(loaded=len(loaded), total=len(data)))
+
+
+def watching():
+    """
+    How changed files are noticed: `inotify`, `poll` or `off`, from `SYSTEMINFO_WATCH`
+
+    `inotify` falls back to polling where it isn't available
+    """
+    return os.environ.get('SYSTEMINFO_WATCH', 'inotify')
+
+
+def sweep_interval():
+    """
+    Time between full refreshes, `SYSTEMINFO_SWEEP_INTERVAL` seconds
+
+    While files are watched a full refresh only catches what the watcher
+    can't see, like pip packages, so it is done far less often
+    """
+    if os.environ.get('SYSTEMINFO_SWEEP_INTERVAL'):
+        return datetime.timedelta(seconds=float(os.environ['SYSTEMINFO_SWEEP_INTERVAL']))
+    return datetime.timedelta(minutes=5 if watching() == 'off' else 60)
+
+
+async def refresh_changed(app, paths):
+    """
+    Refresh only the images that changed paths belong to, and publish them
+    """
+    refreshed, removed = changed_images(app, paths)
+    if not refreshed and not removed:
+        return
+    app.logger.info("Files changed, refreshing {refreshed} and removing {removed} images".format(refreshed=len(refreshed), removed=len(removed)))
+    if refreshed:
+        await systeminfo.refresh.refresh(refreshed, timeout=float(os.environ.get('SYSTEMINFO_REFRESH_TIMEOUT', 600)))
+    data = {image_name: info for image_name, info in app[keys.STATE].images.items() if image_name not in removed}
+    # Known images keep their place, new ones go last until the next full refresh sorts them
+    data.update(refreshed)
+    publish(app, data)
+
+
+async def watch_images(app):
+    """
+    Refresh images as soon as their files change, instead of waiting for the next full refresh
+
+    Files have to be left alone for `SYSTEMINFO_WATCH_DEBOUNCE` seconds
+    first, so images that are still being copied aren't read half written
+    """
+    files = [path for info in app[keys.STATE].images.values() for path in info.watch_paths]
+    watcher = systeminfo.watch.watcher(image_dirs(app), files, match=is_image,
+                                       debounce=float(os.environ.get('SYSTEMINFO_WATCH_DEBOUNCE', 10)),
+                                       polling=watching() == 'poll')
+    app.logger.info("Watching for changes with `{watcher}`".format(watcher=type(watcher).__name__))
+    try:
+        async for paths in watcher.changes():
+            async with app[keys.REFRESH_LOCK]:
+                try:
+                    if paths is None:
+                        # The watcher lost track, only a full refresh knows what changed
+                        publish(app, await generate_images(app))
+                    else:
+                        await refresh_changed(app, paths)
+                except Exception as e:
+                    app.logger.exception("Refreshing changed images failed: `{e}`".format(e=e))
+    except asyncio.CancelledError:
+        pass
+    finally:
+        watcher.close()
+
+
+def index_path():
+    """
+    Where the refresher writes the mapped index the workers search, `SYSTEMINFO_INDEX_PATH`
+
+    Defaults to a file in `/dev/shm`, so it is shared memory that never
+    touches a disk, named after `SYSTEMINFO_PORT`. The refresher and the
+    workers of one server agree on it, and servers on other ports don't
+    read each other's
+    """
+    if os.environ.get('SYSTEMINFO_INDEX_PATH'):
+        return os.environ['SYSTEMINFO_INDEX_PATH']
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'systeminfo-{port}.index'.format(port=int(os.environ.get('SYSTEMINFO_PORT', 8080))))
+
+
+async def write_index(app):
+    """
+    Write the mapped index for the workers whenever a generation was published
+
+    Publishes that follow each other quickly, like images published as they
+    finish, are written once, `SYSTEMINFO_INDEX_DELAY` seconds after the
+    first. The index is copied on the loop and written in a thread, so
+    refreshing goes on meanwhile
+    """
+    loop = asyncio.get_event_loop()
+    state = app[keys.STATE]
+    path = app[keys.INDEX_PATH]
+    delay = float(os.environ.get('SYSTEMINFO_INDEX_DELAY', 1))
+    try:
+        while True:
+            await app[keys.INDEX_DUE].wait()
+            await asyncio.sleep(delay)
+            app[keys.INDEX_DUE].clear()
+            generation = state.generation
+            systems, packages = systeminfo.mapped.freeze(state.index)
+            meta = {
+                'snapshot': state.snapshot,
+                'refreshed': state.refreshed,
+                # Only what a worker can still be asked for, not the whole history
+                'changelog': state.changelog.state(recent=int(os.environ.get('SYSTEMINFO_INDEX_CHANGES', 10000))),
+            }
+            start = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, systeminfo.mapped.write, path, systems, packages, generation, meta)
+            except Exception as e:
+                app.logger.exception("Writing the index to `{path}` failed: `{e}`".format(path=path, e=e))
+                continue
+            app.logger.info("Wrote generation {generation} to `{path}` in {seconds:.2f} s".format(
+                generation=generation, path=path, seconds=time.perf_counter() - start))
+    except asyncio.CancelledError:
+        pass
+
+
+def adopt_index(app, index):
+    """
+    Serve a mapped index the refresher wrote, in place of the one served until now
+
+    Nothing here awaits, so requests never see half of each. The old map is
+    retired, a search that is still streaming from it finishes on the
+    generation it started with and the map is closed after
+    """
+    state = app[keys.STATE]
+    previous = state.index
+    state.index = index
+    state.generation = index.generation
+    state.changelog = systeminfo.diff.ChangeLog.from_state(index.meta['changelog'])
+    state.snapshot = index.meta.get('snapshot', False)
+    state.refreshed = index.meta.get('refreshed', False)
+    app[keys.RESPONSE_CACHE].clear()
+    if isinstance(previous, systeminfo.mapped.MappedIndex) and previous is not index:
+        previous.retire()
+
+
+async def follow_index(app):
+    """
+    Serve every new mapped index the refresher writes, checking for one each `SYSTEMINFO_INDEX_POLL` seconds
+    """
+    loop = asyncio.get_event_loop()
+    path = app[keys.INDEX_PATH]
+    interval = float(os.environ.get('SYSTEMINFO_INDEX_POLL', 1))
+    seen = None
+    try:
+        while True:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and (stat.st_ino, stat.st_mtime_ns) != seen:
+                try:
+                    index = await loop.run_in_executor(None, systeminfo.mapped.MappedIndex, path)
+                except (OSError, ValueError) as e:
+                    # Tried again once it is replaced
+                    app.logger.warning("Can't read the index `{path}`: `{e}`".format(path=path, e=e))
+                    seen = (stat.st_ino, stat.st_mtime_ns)
+                else:
+                    adopt_index(app, index)
+                    seen = (index.stat.st_ino, index.stat.st_mtime_ns)
+                    app.logger.info("Serving generation {generation} from `{path}`".format(generation=index.generation, path=path))
+            await asyncio.sleep(interval)
+    except asyncio.CancelledError:
+        pass
+
+
+async def update_images_periodically(app, timedelta=None):
     app.logger.critical("Starting search image task")
+    if timedelta is None:
+        timedelta = sweep_interval()
     try:
+        await load_snapshots(app)
         while True:
             start = datetime.datetime.now()
             next = start + timedelta
             app.logger.info("Starting image check at `{start}`".format(start=start))
-            data = await generate_images(app)
-            app.logger.info("Pre-searching images to prime them")
-            for image_name, info in data.items():
-                await info.async_search('vim')
-            app['images'] = data
+            async with app[keys.REFRESH_LOCK]:
+                data = await generate_images(app, on_refreshed=lambda image_name, info: publish_refreshed(app, image_name, info))
+                publish(app, data)
+            state = app[keys.STATE]
+            state.refreshed = True
+            if watching() != 'off' and state.file_watcher is None:
+                # Watched from when every image is known
+                state.file_watcher = app.loop.create_task(watch_images(app))
             end = datetime.datetime.now()
 
             duration = (end - start).total_seconds()
@@ -33,29 +333,188 @@ async def update_images_periodically(app, timedelta=datetime.timedelta(minutes=5
         pass
 
 
+async def metrics(request):
+    """
+    Every metric in the Prometheus text format
+    """
+    app = request.app
+    state = app[keys.STATE]
+    GENERATION.set(state.generation)
+    IMAGES.set(len(state.index.system_names()) if state.index is not None else 0)
+    RESPONSE_CACHE_BYTES.set(app[keys.RESPONSE_CACHE].size)
+    return web.Response(body=systeminfo.metrics.REGISTRY.exposition().encode('utf-8'),
+                        headers={'Content-Type': systeminfo.metrics.CONTENT_TYPE})
+
+
+async def live(request):
+    """
+    Whether the server is up, answered as long as the event loop runs
+    """
+    return web.json_response({'live': True})
+
+
+async def ready(request):
+    """
+    Whether the server has something to search, `503` until the first images are published
+
+    Images are published from the inventory cache's snapshot at startup, and
+    each new image as soon as it is refreshed, so this doesn't wait for a
+    whole refresh cycle. `refreshed` tells if one has finished yet
+    """
+    state = request.app[keys.STATE]
+    body = {
+        'ready': state.generation > 0,
+        'generation': state.generation,
+        'images': len(state.index.system_names()) if state.index is not None else 0,
+        'snapshot': state.snapshot,
+        'refreshed': state.refreshed,
+    }
+    return web.json_response(body, status=200 if body['ready'] else 503)
+
+
 async def start_background_tasks(app):
-    app['background_image_watcher'] = app.loop.create_task(update_images_periodically(app))
+    # Every command is started from this loop, so asyncio can wait for them all without a thread each
+    systeminfo.process.pin_child_watcher(app.loop)
+    # Full refreshes and refreshes of changed images take turns
+    app[keys.REFRESH_LOCK] = asyncio.Lock()
+    app[keys.IMAGE_WATCHER] = app.loop.create_task(update_images_periodically(app))
+    if keys.INDEX_PATH in app:
+        app[keys.INDEX_DUE] = asyncio.Event()
+        app[keys.INDEX_WRITER] = app.loop.create_task(write_index(app))
 
 async def cleanup_background_tasks(app):
-    app['background_image_watcher'].cancel()
-    await app['background_image_watcher']
+    app[keys.IMAGE_WATCHER].cancel()
+    await app[keys.IMAGE_WATCHER]
+    state = app[keys.STATE]
+    if state.unpublished_handle is not None:
+        state.unpublished_handle.cancel()
+    for task in (state.file_watcher, app.get(keys.INDEX_WRITER)):
+        if task is not None:
+            task.cancel()
+            await task
 
 
+async def start_worker_tasks(app):
+    app[keys.INDEX_FOLLOWER] = app.loop.create_task(follow_index(app))
 
-def create_app(argv=''):
+async def cleanup_worker_tasks(app):
+    app[keys.INDEX_FOLLOWER].cancel()
+    await app[keys.INDEX_FOLLOWER]
+
+
+def create_app(argv='', role='single'):
     """
     Create and return the aiohttp app
     Used for `adev runserver`
+
+    role: `single` refreshes the images and searches them in one process,
+        `refresher` also writes them to the mapped index and `worker` only
+        searches the mapped index a refresher wrote
     """
+    # The library leaves logging alone, the server shows what it is doing
+    logging.basicConfig(level=logging.INFO)
     app = web.Application()
+    app[keys.STATE] = keys.State()
+    app[keys.RESPONSE_CACHE] = ResponseCache(max_bytes=int(os.environ.get('SYSTEMINFO_RESPONSE_CACHE_BYTES', 64 * 1024 * 1024)))
     aiohttp_jinja2.setup(app,
         loader=jinja2.FileSystemLoader('.'))
-    app.add_routes([web.get('/', Search)])
+    app.add_routes([web.get('/', Search), web.get('/metrics', metrics), web.get('/live', live), web.get('/ready', ready)])
     app.add_subapp('/api', apiapp)
-    app.on_startup.append(start_background_tasks)
-    app.on_cleanup.append(cleanup_background_tasks)
+    if role == 'worker':
+        app[keys.INDEX_PATH] = index_path()
+        app.on_startup.append(start_worker_tasks)
+        app.on_cleanup.append(cleanup_worker_tasks)
+    else:
+        if role == 'refresher':
+            app[keys.INDEX_PATH] = index_path()
+        app.on_startup.append(start_background_tasks)
+        app.on_cleanup.append(cleanup_background_tasks)
     return app
 
+
+async def worker_app():
+    """
+    A worker's app, for gunicorn's `aiohttp.GunicornWebWorker`
+    """
+    return create_app(role='worker')
+
+
+async def run_worker(app, sock, number):
+    """
+    Run one worker process on the listening socket, starting it again whenever it exits
+    """
+    env = dict(os.environ, SYSTEMINFO_INDEX_PATH=app[keys.INDEX_PATH])
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), '--worker', str(sock.fileno()),
+                                                       pass_fds=(sock.fileno(),), env=env)
+        try:
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            process.terminate()
+            await process.wait()
+            raise
+        app.logger.error("Worker {number} exited with `{returncode}`, starting it again".format(number=number, returncode=returncode))
+        await asyncio.sleep(1)
+
+
+async def run_refresher(app, sock=None, workers=0):
+    """
+    Refresh the images and write the mapped index, while workers search it
+
+    The refresher only answers requests itself, like `/metrics` for its
+    refreshes, when `SYSTEMINFO_REFRESHER_PORT` is set
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        if os.environ.get('SYSTEMINFO_REFRESHER_PORT'):
+            await web.TCPSite(runner, port=int(os.environ['SYSTEMINFO_REFRESHER_PORT'])).start()
+        if workers:
+            await asyncio.gather(*(run_worker(app, sock, number) for number in range(workers)))
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def serve(workers=0):
+    """
+    Run a refresher and workers processes that search what it publishes
+
+    The workers share one listening socket on `SYSTEMINFO_HOST` and
+    `SYSTEMINFO_PORT`, the kernel hands every connection to one of them.
+    Without workers only the refresher runs, for workers started some other way
+    """
+    app = create_app(role='refresher')
+    sock = None
+    if workers:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((os.environ.get('SYSTEMINFO_HOST', '0.0.0.0'), int(os.environ.get('SYSTEMINFO_PORT', 8080))))
+        sock.listen(128)
+        sock.set_inheritable(True)
+
+    async def main():
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        await run_refresher(app, sock, workers)
+
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
 if __name__ == '__main__':
-    app = create_app()
-    web.run_app(app)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--worker', type=int, metavar='FD', help=argparse.SUPPRESS)
+    parser.add_argument('--refresher', action='store_true',
+                        help="only refresh and write the mapped index, for workers run by gunicorn")
+    args = parser.parse_args()
+    workers = int(os.environ.get('SYSTEMINFO_WORKERS', 1))
+    if args.worker is not None:
+        web.run_app(create_app(role='worker'), sock=socket.socket(fileno=args.worker))
+    elif args.refresher or workers > 1:
+        serve(0 if args.refresher else workers)
+    else:
+        app = create_app()
+        web.run_app(app)
@@ -4,39 +4,133 @@ import os
 import sys
 import os
 import systeminfo
+import systeminfo.refresh
+import systeminfo.squashfs
+from api import keys
 
-async def generate_images(app):
+def discover_images(app):
     """
-    This function creates and initalizes info objects that will be used for
-    the web server
-    
+    Create the info objects of every image, without collecting anything yet
+
     This function should be changed to fit your needs
     """
+    state = app[keys.STATE]
+    if state.inventory_cache is None:
+        # Keeps image inventories across refreshes and restarts
+        state.inventory_cache = systeminfo.InventoryCache(cache_path())
+    # Images we already know are refreshed in place, so only their changes are applied
+    previous = state.images
     if 'SINGULARITY_IMAGE_DIR' in os.environ:
-        data = singularity_images(os.environ['SINGULARITY_IMAGE_DIR'])
+        data = singularity_images(os.environ['SINGULARITY_IMAGE_DIR'], cache=state.inventory_cache, previous=previous)
     else:
         app.logger.warning("SINGULARITY_IMAGE_DIR envvar not set; Using local system info")
-        data = local_test()
+        data = local_test(previous=previous)
+    return data
+
+def cache_path():
+    """
+    SYSTEMINFO_CACHE, or a file in the user's cache directory, never one relative to where the server started
+
+    Not next to the images, the directory may be read only and is watched for new images
+    """
+    if 'SYSTEMINFO_CACHE' in os.environ:
+        return os.path.abspath(os.environ['SYSTEMINFO_CACHE'])
+    directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'systeminfo')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, 'inventory.sqlite3')
+
+async def generate_images(app, on_refreshed=None):
+    """
+    This function creates and initalizes info objects that will be used for
+    the web server
+
+    on_refreshed: called with the name and info of each image as soon as it
+        is refreshed, see `systeminfo.refresh.refresh`
+    """
+    data = discover_images(app)
     app.logger.info(data)
     app.logger.debug("getting data for {len} images".format(len=len(data)))
     
     # Async worked much better here, 10 images took about 120 seconds using sync, 50 seconds using async
+    # Too many `singularity exec` at once thrashes the storage, so the concurrency is bounded
     start = time.time()
-    #await asyncio.gather(*[info.async_get_dict() for info in data.values()])
+    # SYSTEMINFO_REFRESH_CONCURRENCY overrides how many images are collected at once
+    report = await systeminfo.refresh.refresh(data, timeout=float(os.environ.get('SYSTEMINFO_REFRESH_TIMEOUT', 600)),
+                                              on_refreshed=on_refreshed)
+    app[keys.STATE].refresh_report = report
     end = time.time()
     app.logger.debug("Took {seconds} seconds".format(seconds=end-start))
     return data
 
-def local_test(num=1):
-    return {image_name: systeminfo.System() for image_name in ('localhost' + str(i) for i in range(num))}
+def local_test(num=1, previous=None):
+    previous = previous or {}
+    executor = os.environ.get('SYSTEMINFO_PARSE_EXECUTOR') or None
+    return {image_name: previous.get(image_name) or systeminfo.System(executor=executor, compact=compact())
+            for image_name in ('localhost' + str(i) for i in range(num))}
+
+def compact():
+    # SYSTEMINFO_COMPACT=0 keeps plain dictionaries, images share their strings otherwise
+    return os.environ.get('SYSTEMINFO_COMPACT', '1') != '0'
+
+def singularity_images(path, cache=None, previous=None):
+    """
+    Find every image under path
 
-def singularity_images(path):
+    previous: the images of the last run, those that still exist are reused
+    """
+    previous = previous or {}
     # Find all images, symlink and all
-    images = [os.path.join(path, file) for path, folers, files in os.walk(path) for file in files if file.endswith('img')]
+    images = [os.path.join(path, file) for path, folers, files in os.walk(path) for file in files if is_image(file)]
     images.sort(key=lambda key: len(key))
-    # TODO Get hashes of each
-    # TODO Compare against previous under app['singularity_images']
-    # TODO Report new images, deleted images, and changed hash values
-    # Create a Singularity info for every image
-    data = {image_name: systeminfo.Singularity(image_name) for image_name in images}
+    # Create a Singularity info for every new image
+    # Unchanged images are loaded from the cache instead of being executed
+    data = {image_name: previous.get(image_name) or singularity_image(image_name, cache=cache)
+            for image_name in images}
     return data
+
+def is_image(path):
+    return path.endswith(('img', '.sif'))
+
+def singularity_image(image_name, cache=None):
+    # SYSTEMINFO_INSPECT_IMAGES reads the images' files instead of executing them
+    # Only squashfs can be read that way, Singularity 2 ext3 `.img` images are still executed
+    inspect = bool(os.environ.get('SYSTEMINFO_INSPECT_IMAGES')) and systeminfo.squashfs.is_squashfs(image_name)
+    # SYSTEMINFO_PARSE_EXECUTOR (`thread` or `process`) parses output off of the event loop
+    executor = os.environ.get('SYSTEMINFO_PARSE_EXECUTOR') or None
+    return systeminfo.Singularity(image_name, cache=cache, inspect=inspect, executor=executor, compact=compact())
+
+def image_dirs(app):
+    """
+    The directories new images show up in, watched along with the files of the images already known
+    """
+    return [os.environ['SINGULARITY_IMAGE_DIR']] if 'SINGULARITY_IMAGE_DIR' in os.environ else []
+
+def changed_images(app, paths):
+    """
+    Work out which images changed paths belong to, without walking the image directories
+
+    Returns a dictionary of the images to refresh, new ones included, and a
+    list of the names of the images that are gone
+    """
+    state = app[keys.STATE]
+    images = state.images
+    refreshed = {}
+    removed = []
+    for image_name, info in images.items():
+        if not paths.intersection(os.path.abspath(path) for path in info.watch_paths):
+            continue
+        if isinstance(info, systeminfo.Singularity):
+            if not os.path.isfile(info.image):
+                removed.append(image_name)
+                continue
+            # A replaced image has to be opened again
+            info.close()
+        refreshed[image_name] = info
+    for directory in image_dirs(app):
+        prefix = os.path.abspath(directory) + os.sep
+        for path in paths:
+            # Named like the walk of the directory names them
+            image_name = os.path.join(directory, path[len(prefix):])
+            if path.startswith(prefix) and is_image(path) and image_name not in images and os.path.isfile(path):
+                refreshed[image_name] = singularity_image(image_name, cache=state.inventory_cache)
+    return refreshed, removed